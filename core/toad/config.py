@@ -56,6 +56,11 @@ class Config(object):
         else:
             config.set('arguments', 'reinitialize', 'False')
 
+        if arguments.qaOnly:
+            config.set('arguments', 'qa_only', 'True')
+        else:
+            config.set('arguments', 'qa_only', 'False')
+
         if arguments.debug:
             config.set('arguments', 'debug', 'True')
         else:
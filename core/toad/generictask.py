@@ -10,7 +10,10 @@ import os
 from lib.images import Images
 from core.toad.logger import Logger
 from core.toad.qa import Qa
+from core.toad.manifest import Manifest
 from load import Load
+from lib import metrics
+from lib import runner
 from lib import util
 
 
@@ -19,7 +22,7 @@ __copyright__ = "Copyright (C) 2014, TOAD"
 __credits__ = ["Mathieu Desrosiers"]
 
 
-class GenericTask(Logger, Load, Qa):
+class GenericTask(Logger, Load, Qa, Manifest):
 
     def __init__(self, subject, *args):
         """Set up a TASK child class environment.
@@ -38,6 +41,8 @@ class GenericTask(Logger, Load, Qa):
         self.__name = self.__class__.__name__.lower()
         self.__moduleName = self.__class__.__module__.split(".")[-1]
         self.__cleanupBeforeImplement = True
+        self.__running = False
+        self.__commandsMaxrss = 0
         self.config = subject.getConfig()
         self.subject = subject
         self.subjectDir = self.subject.getDir()
@@ -49,6 +54,7 @@ class GenericTask(Logger, Load, Qa):
         Logger.__init__(self, subject.getLogDir())
         Load.__init__(self, self.config)
         Qa.__init__(self)
+        Manifest.__init__(self)
         self.dependencies = []
         self.__dependenciesDirNames = {}
         for arg in args:
@@ -202,7 +208,7 @@ class GenericTask(Logger, Load, Qa):
 
             def wrapper(*args):
                 arguments = [self.config, directory] + list(args)
-                return util.getImages(*arguments)
+                return util.getImages(*arguments, cache=self.__isCacheable(directory))
             return wrapper
 
         elif items.startswith('get') and items.endswith('Image'):
@@ -217,12 +223,27 @@ class GenericTask(Logger, Load, Qa):
 
             def wrapper(*args):
                 arguments = [self.config, directory] + list(args)
-                return util.getImage(*arguments)
+                return util.getImage(*arguments, cache=self.__isCacheable(directory))
             return wrapper
         else:
             return False
 
 
+    def __isCacheable(self, directory):
+        """Determine if the listing of a directory could be kept in memory by getImages
+
+        The working directory of this task is never cached while the task is running because it
+        is writing into it. Other directories belong to tasks that are already completed.
+
+        Args:
+            directory: the directory where looking for image(s)
+
+        Returns:
+            True if the directory could be cached, False otherwise
+        """
+        return not (self.__running and directory == self.workingDir)
+
+
     def __implement(self):
         """Generic implementation of a tasks
 
@@ -247,8 +268,14 @@ class GenericTask(Logger, Load, Qa):
                 self.subjectDir, '00-backup', 'configRunning.cfg')
         self.subject.writeConfigRunning(configRunningPath)
 
-        self.info("Create and supply images to the qa report ")
-        if "qaSupplier" in dir(self):
+        if self.get('general', 'manifest'):
+            self.createManifest(self.meetRequirement())
+
+        if "qaSupplier" in dir(self) and self.isQaDeferred():
+            self.info("Queue the qa report of task {} for a later rendering".format(self.getName()))
+            self.enqueueQa()
+        elif "qaSupplier" in dir(self):
+            self.info("Create and supply images to the qa report ")
             self.createQaReport(self.qaSupplier())
         else:
             self.info("task {} does not implement qaSupplier method".format(self.getName()))
@@ -348,6 +375,10 @@ class GenericTask(Logger, Load, Qa):
             else:
                 self.error("Illegal value return by isDirty method for task {}".format(self.getName()))
 
+            #outputs are completed, look if the inputs, the config or the softwares changed since
+            if not result and self.get('general', 'manifest'):
+                result = self.isManifestChanged(self.meetRequirement())
+
             self.logFooter("isDirty", result)
             return result
 
@@ -394,22 +425,32 @@ class GenericTask(Logger, Load, Qa):
             self.info("Cleaning up \"deleting\" {} directory".format(self.workingDir))
             os.chdir(self.subjectDir)
             shutil.rmtree(self.workingDir)
+            util.invalidateImagesCache(self.workingDir)
+
+
+    def isStopBeforeTask(self):
+        """Determine if the user request to stop the pipeline before this task
+        through stop_before_task option
+
+        Returns:
+            True if the pipeline should stop before this task, False otherwise
+        """
+        if self.config.has_option("arguments", "stop_before_task"):
+            stopTaskName = self.config.get("arguments", "stop_before_task")
+            return stopTaskName in [self.__name, self.__moduleName.lower()]
+        return False
 
 
     def stopBeforeTask(self):
         """Method to stop the pipeline before the task set by the user through
         stop_before_task option
         """
-        if self.config.has_option("arguments", "stop_before_task"):
-            stopTaskName = self.config.get("arguments", "stop_before_task")
-            if (   stopTaskName == self.__name
-                or stopTaskName == self.__moduleName.lower()
-               ):
-                msg = (
-                        "\033[92mReach {} which is the value set by "
-                        "stop_before_task. Stopping the pipeline as user "
-                        "request\033[0m").format(stopTaskName)
-                self.quit(msg)
+        if self.isStopBeforeTask():
+            msg = (
+                    "\033[92mReach {} which is the value set by "
+                    "stop_before_task. Stopping the pipeline as user "
+                    "request\033[0m").format(self.config.get("arguments", "stop_before_task"))
+            self.quit(msg)
 
 
     def run(self):
@@ -432,10 +473,14 @@ class GenericTask(Logger, Load, Qa):
             except ValueError:
                 nbSubmission = 3
 
+            #this task is about to write into its working directory, see __isCacheable
+            self.__running = True
             while(attempt < nbSubmission):
                 if self.__cleanupBeforeImplement:
                     self.__cleanup()
 
+                usage = metrics.getUsage()
+                self.__commandsMaxrss = 0
                 try:
                     self.__implement()
                 except (KeyboardInterrupt, SystemExit):
@@ -450,14 +495,19 @@ class GenericTask(Logger, Load, Qa):
                     self.error("I already execute this task {} time and failed, exiting the pipeline")
 
                 elif self.isTaskDirty():
+                    self.__recordTaskMetrics(attempt + 1, usage, False)
                     self.info("A problems occur during the execution of this task, resubmitting this task again")
                     attempt += 1
                 else:
+                    self.__recordTaskMetrics(attempt + 1, usage, True)
                     finish = datetime.now()
                     self.info("Time to finish the task = {} seconds".format(str(timedelta(seconds=(finish - start).seconds))))
                     self.logFooter("implement")
                     break
 
+            self.__running = False
+            util.invalidateImagesCache(self.workingDir)
+
 
     def getName(self):
         """Return the name of this class into lower case
@@ -509,8 +559,11 @@ class GenericTask(Logger, Load, Qa):
 
         """
         if len(args) < 3:
+            self.recordRuntimeOption(args[0])
             value = self.config.set(self.getName(), args[0], args[1])
         else:
+            if args[0] == self.getName():
+                self.recordRuntimeOption(args[1])
             value = self.config.set(args[0], args[1], args[2])
 
         if value in ["True", "true"]:
@@ -521,18 +574,20 @@ class GenericTask(Logger, Load, Qa):
             return value
 
 
-    def launchCommand(self, cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=None, nice=0):
+    def launchCommand(self, cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=None, nice=0, env=None):
         """Execute a program in a new process
 
+        The outputs of the program are written into the log of the task as they are produced.
+        The wall time, cpu time and maximum memory consumed are appended into the metrics file
+        of the subject, see metrics_file_name
+
         Args:
             command: a string representing a unix command to execute
             stdout: this attribute is a file object that provides output from the child process
             stderr: this attribute is a file object that provides error from the child process
-            timeout: Number of seconds before a process is consider inactive, usefull against deadlock
+            timeout: Number of seconds before the process is killed, usefull against deadlock
             nice: run cmd  with  an  adjusted  niceness, which affects process scheduling
-
-        Returns
-            return a 3 elements tuples representing the command execute, the standards output and the standard error message
+            env: a dictionary of environment variables added to the environment of the program
 
         Raises
             OSError:      the function trying to execute a non-existent file.
@@ -546,15 +601,77 @@ class GenericTask(Logger, Load, Qa):
         self.info("Launch {} command line...".format(binary))
         self.info("Command line submit: {}".format(cmd))
 
-        (executedCmd, output, error)= util.launchCommand(cmd, stdout, stderr, timeout, nice)
-        if not (output is "" or output is "None" or output is None):
-            self.info("Output produce by {}: {} \n".format(binary, output))
+        def __logLine(stream, line):
+            if stream == 'stdout':
+                self.info("Output produce by {}: {}".format(binary, line.rstrip('\n')))
+            else:
+                self.info("Error produce by {}: {}".format(binary, line.rstrip('\n')))
+
+        try:
+            inactivity = int(self.get('general', 'command_inactivity_timeout'))
+        except ValueError:
+            inactivity = None
+
+        if env is not None:
+            env = dict(os.environ, **env)
 
-        if not (error is '' or error is "None" or error is None):
-            self.info("Error produce by {}: {}\n".format(binary, error))
+        result = runner.run(cmd, stdout, stderr, timeout, inactivity, nice, __logLine, env)
+        if result['timeout'] is not None:
+            self.warning("Command {} killed after a {} timeout".format(binary, result['timeout']))
+
+        self.info("Command {} exit with status {} after {:.1f} seconds, cpu {:.1f} seconds, max memory {} KB"
+                  .format(binary, result['returncode'], result['wall'],
+                          (result['user'] or 0) + (result['system'] or 0), result['maxrss']))
+        self.__recordCommandMetrics(binary, result)
+        self.__commandsMaxrss = max(self.__commandsMaxrss, result['maxrss'] or 0)
         self.info("------------------------\n")
 
 
+    def __recordCommandMetrics(self, binary, result):
+        """Append the resources consumed by a command into the metrics file of the subject
+
+        Args:
+            binary: the name of the program
+            result: the dictionary return by runner.run
+
+        """
+        record = {'type': 'command',
+                  'task': self.getName(),
+                  'binary': binary,
+                  'timestamp': datetime.now().strftime("%Y-%m-%dT%H:%M:%S")}
+        for key in ['command', 'returncode', 'timeout', 'wall', 'user', 'system', 'maxrss', 'read_bytes', 'write_bytes']:
+            record[key] = result[key]
+        self.__recordMetrics(record)
+
+
+    def __recordTaskMetrics(self, attempt, before, success):
+        """Append the resources consumed by an attempt of this task into the metrics file of the subject
+
+        Args:
+            attempt: the number of the attempt, starting at 1
+            before: the value return by metrics.getUsage before the attempt
+            success: a boolean, True if the attempt produced every images of the task
+
+        """
+        record = metrics.getUsageDifference(before, metrics.getUsage(), self.__commandsMaxrss)
+        record.update({'type': 'task',
+                       'task': self.getName(),
+                       'attempt': attempt,
+                       'success': success,
+                       'dependencies': self.getDependencies()})
+        self.__recordMetrics(record)
+
+
+    def __recordMetrics(self, record):
+        """Append a record as a json line into the metrics file of the subject, see metrics_file_name
+
+        """
+        try:
+            metrics.append(os.path.join(self.logDir, self.get('general', 'metrics_file_name')), record)
+        except IOError:
+            self.warning("Unable to record metrics into the log directory")
+
+
     def launchMatlabCommand(self, source, stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=None, nice=0):
         """Execute a Matlab script in a new process
 
@@ -1,4 +1,5 @@
 # -*- coding: utf-8 -*-
+import multiprocessing
 import os
 
 __author__ = "Mathieu Desrosiers"
@@ -160,3 +161,49 @@ class Load(object):
 
         """
         return self.__getNTreads()
+
+
+    def getNParallelTasks(self):
+        """Define the number of tasks that could be executed concurrently without stressing the server too much
+
+        Every task may deploy up to getNTreads() threads, so the cores of the server are shared between tasks
+
+        Returns:
+            the suggested number of tasks that could run at the same time
+
+        """
+        try:
+            value = int(self.__config.get('general', 'nb_parallel_tasks'))
+        except ValueError:
+            value = multiprocessing.cpu_count() / int(self.__getNTreads())
+
+        if self.isSystemOverloaded(self.__config.get('general', 'server')):
+            value = 1
+
+        return max(1, value)
+
+
+    def getNLocalSubjects(self):
+        """Define the number of subjects that could be process at the same time on the local server
+
+        The value is bound by the numbers of subjects submitted, the numbers of cores of the server
+        and the memory available for each subject, see memory_per_subject
+
+        Returns:
+            the suggested number of subjects that could be process at the same time
+
+        """
+        try:
+            value = int(self.__config.get('general', 'nb_local_subjects'))
+        except ValueError:
+            value = multiprocessing.cpu_count()
+            try:
+                memory = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') / float(1024 ** 3)
+                value = min(value, int(memory / float(self.__config.get('general', 'memory_per_subject'))))
+            except (ValueError, OSError):
+                pass
+
+        if self.isSystemOverloaded(self.__config.get('general', 'server')):
+            value = 1
+
+        return max(1, min(value, self.nbSubjects))
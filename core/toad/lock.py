@@ -1,4 +1,5 @@
 # -*- coding: utf-8 -*-
+import fcntl
 import os
 
 __author__ = "Mathieu Desrosiers"
@@ -66,4 +67,47 @@ class Lock(object):
         """
         if self.isLock():
             return self.__lockFile
-        return False
\ No newline at end of file
+        return False
+
+    def setRunningTask(self, name, running=True):
+        """Register into the lock file the name of a task that start or finish for this subject
+
+        Many tasks of the same subject may run concurrently, so the lock file is lock during the update
+
+        Args:
+            name: the name of the task
+            running: True if the task start, False if the task is finish
+
+        Returns:
+            False if the subject is not lock, True otherwise
+
+        """
+        if not self.isLock():
+            return False
+        try:
+            with open(self.__lockFile, 'r+') as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                tasks = [line.strip() for line in f if line.strip() and line.strip() != name]
+                if running:
+                    tasks.append(name)
+                f.seek(0)
+                f.write("".join("{}\n".format(task) for task in tasks))
+                f.truncate()
+                fcntl.flock(f, fcntl.LOCK_UN)
+        except IOError:
+            return False
+        return True
+
+    def getRunningTasks(self):
+        """return the names of the tasks currently running for this subject
+
+        Returns:
+            a list of tasks names, empty if the subject is not lock
+        """
+        if not self.isLock():
+            return []
+        try:
+            with open(self.__lockFile, 'r') as f:
+                return [line.strip() for line in f if line.strip()]
+        except IOError:
+            return []
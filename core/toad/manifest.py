@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import json
+import os
+
+from lib.images import Images
+from lib import xmlhelper
+
+__author__ = "Mathieu Desrosiers"
+__copyright__ = "Copyright (C) 2014, TOAD"
+__credits__ = ["Mathieu Desrosiers"]
+
+
+class Manifest(object):
+
+    def __init__(self):
+        """Record what a task have been build from, like make does
+
+        A manifest is written into the log directory each time a task is implemented. It contains
+        the signature of the images return by meetRequirement, the config section of the task
+        and the versions of the softwares listed into manifest_softwares.
+        A completed task is resubmitted, with all the tasks of its workflow, only if one of those changed.
+        Options the task write itself into its config section with set are not compared, their values
+        come from the previous implementation and not from the config files.
+
+        """
+        self.manifestFile = os.path.join(self.logDir, "{}.manifest".format(self.getName()))
+        self.__runtimeOptions = set()
+
+
+    def recordRuntimeOption(self, option):
+        """Exclude an option the task write into its config section from the manifest
+
+        Args:
+            option: the name of the option
+
+        """
+        self.__runtimeOptions.add(option.lower())
+
+
+    def createManifest(self, requirements):
+        """Write the manifest of this task into the log directory
+
+        Args:
+            requirements: the value return by meetRequirement, an Images or a boolean
+
+        """
+        previous = self.__readManifest()
+        runtime = self.__runtimeOptions.union([] if previous is None else previous.get('runtime', []))
+        manifest = {'inputs': self.__getInputs(requirements, previous),
+                    'config': self.__getConfigSection(runtime),
+                    'runtime': sorted(runtime),
+                    'softwares': self.__getSoftwaresVersions()}
+        self.__writeManifest(manifest)
+
+
+    def isManifestChanged(self, requirements):
+        """Compare the inputs, the config section and the softwares versions with the manifest of this task
+
+        If no manifest is found, the task was produced before manifests existed. The current state
+        is then recorded as the reference and the task is not consider changed.
+        When an input have been touched without its content being changed, its new modification
+        time is recorded so it will not be read again.
+
+        Args:
+            requirements: the value return by meetRequirement, an Images or a boolean
+
+        Returns:
+            True if something changed since the task have been implemented, False otherwise
+
+        """
+        manifest = self.__readManifest()
+        if manifest is None:
+            self.info("No manifest found for task {}, recording the current state as reference".format(self.getName()))
+            self.createManifest(requirements)
+            return False
+
+        changes = []
+        refreshed = False
+        inputs = manifest.get('inputs', {})
+        images = self.__getImages(requirements)
+        for image in set(inputs.keys()) ^ set(images):
+            changes.append("input {} added or removed".format(image))
+        for image in set(inputs.keys()) & set(images):
+            mtime = inputs[image].get('mtime')
+            if self.__isSignatureChanged(image, inputs[image]):
+                changes.append("input {} changed".format(image))
+            elif inputs[image].get('mtime') != mtime:
+                refreshed = True
+
+        if refreshed:
+            self.__writeManifest(manifest)
+
+        runtime = set(manifest.get('runtime', []))
+        for label, recorded, current in [('config option', manifest.get('config', {}), self.__getConfigSection(runtime)),
+                                         ('software', manifest.get('softwares', {}), self.__getSoftwaresVersions())]:
+            for name in set(recorded.keys()) | set(current.keys()):
+                if recorded.get(name) != current.get(name):
+                    changes.append("{} {} changed from {} to {}".format(label, name, recorded.get(name), current.get(name)))
+
+        for change in changes:
+            self.info("Task {}: {}".format(self.getName(), change))
+        return len(changes) > 0
+
+
+    def __readManifest(self):
+        """Read the manifest of this task
+
+        Returns:
+            a dictionary, None if no valid manifest is found
+        """
+        if not os.path.isfile(self.manifestFile):
+            return None
+        try:
+            with open(self.manifestFile, 'r') as f:
+                return json.load(f)
+        except ValueError:
+            return None
+
+
+    def __writeManifest(self, manifest):
+        """Write a manifest into the log directory
+
+        """
+        with open(self.manifestFile, 'w') as f:
+            json.dump(manifest, f, indent=4, sort_keys=True)
+
+
+    def __getImages(self, requirements):
+        """Return the list of existing images from the value return by meetRequirement
+
+        """
+        images = []
+        if isinstance(requirements, Images):
+            for image, description in requirements:
+                if image and os.path.isfile(image):
+                    images.append(image)
+        return images
+
+
+    def __getInputs(self, requirements, previous):
+        """Compute the signature of every input image
+
+        the checksum of a previous manifest is reuse if the image did not change since
+
+        """
+        inputs = {}
+        known = {} if previous is None else previous.get('inputs', {})
+        for image in self.__getImages(requirements):
+            stat = os.stat(image)
+            signature = {'size': stat.st_size, 'mtime': stat.st_mtime, 'sha1': None}
+            if self.get('general', 'manifest_checksum'):
+                if (image in known
+                        and known[image].get('size') == stat.st_size
+                        and known[image].get('mtime') == stat.st_mtime):
+                    signature['sha1'] = known[image].get('sha1')
+                if signature['sha1'] is None:
+                    signature['sha1'] = self.__checksum(image)
+            inputs[image] = signature
+        return inputs
+
+
+    def __isSignatureChanged(self, image, signature):
+        """Compare an image with a signature recorded into a manifest
+
+        The modification time is compare first, the content is read only if the modification time changed.
+        If the content is the same, the new modification time is set into the signature
+
+        """
+        stat = os.stat(image)
+        if stat.st_size != signature.get('size'):
+            return True
+        if stat.st_mtime == signature.get('mtime'):
+            return False
+        if signature.get('sha1') is None:
+            return True
+        if self.__checksum(image) != signature.get('sha1'):
+            return True
+        signature['mtime'] = stat.st_mtime
+        return False
+
+
+    def __checksum(self, source, blockSize=2**20):
+        """Compute the sha1 of the content of a file
+
+        """
+        sha1 = hashlib.sha1()
+        with open(source, 'rb') as f:
+            for block in iter(lambda: f.read(blockSize), b''):
+                sha1.update(block)
+        return sha1.hexdigest()
+
+
+    def __getConfigSection(self, excluded):
+        """Return the options of the config section of this task, ignore option and excluded options are left out
+
+        Args:
+            excluded: names of the options the task write itself
+
+        """
+        if not self.config.has_section(self.getName()):
+            return {}
+        return {name: value for name, value in self.config.items(self.getName(), raw=True)
+                if name != 'ignore' and name not in excluded}
+
+
+    def __getSoftwaresVersions(self):
+        """Return the versions of the softwares listed into manifest_softwares
+
+        Versions are read from the newest application tag of the versions file of the subject
+
+        """
+        versions = {}
+        xmlFilename = os.path.join(self.logDir, self.get('general', 'versions_file_name'))
+        applicationTag = xmlhelper.getNewestApplicationTag(xmlFilename)
+        if applicationTag is None:
+            return versions
+
+        softwares = [software.strip().lower()
+                     for software in self.get('general', 'manifest_softwares').split(',') if software.strip()]
+        for software in applicationTag.getElementsByTagName('software'):
+            name = str(software.getElementsByTagName('name')[0].firstChild.data)
+            if name.lower() in softwares:
+                versions[name] = str(software.getElementsByTagName('version')[0].firstChild.data)
+        return versions
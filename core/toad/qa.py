@@ -1,4 +1,6 @@
 # -*- coding: utf-8 -*-
+import ConfigParser
+import fcntl
 import os
 import shutil
 import xml.dom.minidom as minidom
@@ -54,7 +56,8 @@ class Qa(object):
         """
         target = self.buildName(source, None, ext='gif')
         frameFormat = ".{}".format(self.qaImagesFormat)
-        qaPlot = qautil.Plot4dVolume(source, fov=fov, frameFormat=frameFormat)
+        qaPlot = qautil.Plot4dVolume(
+                source, fov=fov, frameFormat=frameFormat, nbProcesses=int(self.getNTreads()))
         qaPlot.saveGif(target)
         return target
 
@@ -65,7 +68,8 @@ class Qa(object):
         target = self.buildName(source1, 'compare', ext='gif')
         frameFormat = ".{}".format(self.qaImagesFormat)
         qaPlot = qautil.Plot4dVolume(
-        source1, source2=source2, fov=fov, frameFormat=frameFormat)
+                source1, source2=source2, fov=fov, frameFormat=frameFormat,
+                nbProcesses=int(self.getNTreads()))
         qaPlot.saveGif(target)
         return target
 
@@ -80,7 +84,8 @@ class Qa(object):
         csf = self.buildName(source, 'csf', ext=frameFormat)
         pt = self.buildName(source, 'pt', ext=frameFormat)
         targets = [cgm, scgm, wm, csf, pt]
-        qaPlot = qautil.Plot4dVolume(source, fov=fov, frameFormat=frameFormat)
+        qaPlot = qautil.Plot4dVolume(
+                source, fov=fov, frameFormat=frameFormat, nbProcesses=int(self.getNTreads()))
         qaPlot.saveFrames(targets)
         return targets
 
@@ -111,13 +116,16 @@ class Qa(object):
         qautil.plotSigma(sigma, target)
         return target
 
-    def noiseAnalysis(self, source, maskNoise, maskCc):
-        """
+    def noiseAnalysis(self, sources, maskNoise, maskCc):
+        """Plot the SNR and the noise histogram of several dwi images in a single pass
+
+        Returns:
+            a list of tuples (SNR plot, histogram plot), one for each source
         """
-        targetSnr = self.buildName(source, 'snr', ext=self.qaImagesFormat)
-        targetHist = self.buildName(source, 'hist', ext=self.qaImagesFormat)
-        qautil.noiseAnalysis(source, maskNoise, maskCc, targetSnr, targetHist)
-        return targetSnr, targetHist
+        targets = [(self.buildName(source, 'snr', ext=self.qaImagesFormat),
+                    self.buildName(source, 'hist', ext=self.qaImagesFormat)) for source in sources]
+        qautil.noiseAnalysis(sources, maskNoise, maskCc, targets)
+        return targets
 
     def plotReconstruction(self, data, mask, cc, model, basename):
         """
@@ -179,19 +187,133 @@ class Qa(object):
                 '<li><a id="{0}" href="{0}.html" target="_top">{0}</a></li>\n'
 
         #Add task link in qa menu if not already present
-        with open(menuFile, 'r') as f:
+        #the menu is shared by all tasks that may run concurrently, lock it during the update
+        with open(menuFile, 'r+') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
             lines = f.readlines()
-        if not any(taskName in line for line in lines):
-            lines.insert(-1, menuLinkTemplate.format(taskName))
-        with open(menuFile, 'w') as f:
+            if not any(taskName in line for line in lines):
+                lines.insert(-1, menuLinkTemplate.format(taskName))
+            f.seek(0)
             for line in lines:
                 f.write(line)
+            f.truncate()
+            fcntl.flock(f, fcntl.LOCK_UN)
 
         #Create temporary html
         message = "Task is being processed. Refresh to check completion."
         self.createTaskHtml({'taskInfo':message})
 
 
+    def isQaDeferred(self):
+        """Return True if the qa report of this task should be queued instead of rendered after implement
+
+        see mode into the qa section of the config file
+        """
+        return self.config.get('qa', 'mode') in ['background', 'deferred']
+
+
+    def enqueueQa(self):
+        """Add this task to the qa queue of the subject, the report will be rendered later by renderQa
+
+        """
+        self.__saveQaState()
+        self.__updateQaQueue(lambda names: names if self.getName() in names else names + [self.getName()])
+        message = "Task completed, the qa report is queued for rendering. Refresh to check completion."
+        self.createTaskHtml({'taskInfo':message})
+
+
+    def getQaQueue(self):
+        """Return the names of the tasks queued for qa rendering, in submission order
+
+        """
+        queueFile = os.path.join(self.qaDir, self.config.get('qa', 'queue'))
+        if not os.path.exists(queueFile):
+            return []
+        with open(queueFile, 'r') as f:
+            fcntl.flock(f, fcntl.LOCK_SH)
+            names = [line.strip() for line in f if line.strip()]
+            fcntl.flock(f, fcntl.LOCK_UN)
+        return names
+
+
+    def renderQa(self):
+        """Render the qa report of this task from the images into its working directory and dequeue it
+
+        qaSupplier must not rely on values produced in memory by implement, the report may be
+        rendered by another process or by a later toad --qaOnly pass. The config values set by
+        the tasks are reloaded from configRunning.cfg and from the state saved by enqueueQa
+
+        """
+        self.__loadQaState()
+        os.chdir(self.workingDir)
+        try:
+            self.createQaReport(self.qaSupplier())
+        finally:
+            os.chdir(self.subjectDir)
+        self.__updateQaQueue(lambda names: [name for name in names if name != self.getName()])
+
+
+    def __getQaStateFileName(self):
+        return os.path.join(self.logDir, "{}_qa_state.cfg".format(self.getName()))
+
+
+    def __saveQaState(self):
+        """Save the config section of this task, with the values set during implement, for renderQa
+
+        """
+        state = ConfigParser.RawConfigParser()
+        if self.config.has_section(self.getName()):
+            state.add_section(self.getName())
+            for name, value in self.config.items(self.getName(), raw=True):
+                state.set(self.getName(), name, value)
+        with open(self.__getQaStateFileName(), 'w') as f:
+            state.write(f)
+
+
+    def __loadQaState(self):
+        """Merge the values set at runtime by the tasks of the subject into the config
+
+        configRunning.cfg hold the values of every task executed so far, the state saved by
+        enqueueQa hold the values of this task even if configRunning.cfg is not updated yet
+
+        """
+        sources = [os.path.join(self.subjectDir, '00-backup', 'configRunning.cfg'), self.__getQaStateFileName()]
+        for source in sources:
+            if not os.path.exists(source):
+                continue
+            state = ConfigParser.RawConfigParser()
+            try:
+                state.read(source)
+            except ConfigParser.Error, exception:
+                self.warning("Unable to reload {}: {}".format(source, exception))
+                continue
+            for section in state.sections():
+                if section == 'arguments':
+                    continue
+                if not self.config.has_section(section):
+                    self.config.add_section(section)
+                for name, value in state.items(section):
+                    self.config.set(section, name, value)
+
+
+    def __updateQaQueue(self, update):
+        """Rewrite the qa queue of the subject under a lock
+
+        Args:
+            update: a function that receive the queued names and return the new ones
+        """
+        queueFile = os.path.join(self.qaDir, self.config.get('qa', 'queue'))
+        with open(queueFile, 'a+') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            f.seek(0)
+            names = update([line.strip() for line in f if line.strip()])
+            f.seek(0)
+            f.truncate()
+            for name in names:
+                f.write("{}\n".format(name))
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
     def createQaReport(self, images):
         """create html report for a task with qaSupplier implemented
         Args:
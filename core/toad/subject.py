@@ -104,6 +104,9 @@ class Subject(Logger, Lock, Validation):
     def createXmlSoftwareVersionConfig(self, xmlSoftwaresTags):
         """ Write software versions into a source filename
 
+        When the newest application tag already record the same versions, only its
+        timestamp is updated, so a submission does not grow the file
+
         Args:
             xmlDocument: a minidom document
             source: file name to write configuration into
@@ -113,11 +116,27 @@ class Subject(Logger, Lock, Validation):
         """
         xmlFilename = os.path.join(self.getLogDir(), self.__config.get('general', 'versions_file_name'))
         xmlToadTag = xmlhelper.createOrParseXmlDocument(xmlFilename)
-        xmlToadTag.appendChild(xmlhelper.createApplicationTags(xmlSoftwaresTags))
+        applicationTag = xmlhelper.createApplicationTags(xmlSoftwaresTags)
+
+        applicationTags = xmlToadTag.getElementsByTagName("application")
+        newestTag = sorted(applicationTags, key=lambda tag: tag.getAttribute('timestamp'))[-1] if applicationTags else None
+        if newestTag is not None and self.__getSoftwareVersions(newestTag) == self.__getSoftwareVersions(applicationTag):
+            newestTag.setAttribute("timestamp", applicationTag.getAttribute("timestamp"))
+        else:
+            xmlToadTag.appendChild(applicationTag)
         with open(xmlFilename, 'w') as w:
             xmlToadTag.writexml(w)
         return True
 
+    def __getSoftwareVersions(self, applicationTag):
+        """Return the (name, version) pairs of the softwares recorded into an application tag
+
+        """
+        versions = []
+        for software in applicationTag.getElementsByTagName('software'):
+            versions.append(tuple(software.getElementsByTagName(name)[0].toxml() for name in ['name', 'version']))
+        return sorted(versions)
+
     def writeConfigRunning(self, target):
         """
         Write a snapshot of the configuration to the target file
@@ -1,10 +1,13 @@
 # -*- coding: utf-8 -*-
+import multiprocessing
 import glob
 import copy
+import time
 import os
 
 from core.toad.tasksmanager import TasksManager
 from subject import Subject
+from load import Load
 from logger import Logger
 from config import Config
 from lib import util
@@ -124,9 +127,25 @@ class SubjectManager(Logger, Config):
 
         """
         name = subject.getName()
+
+        #log versions that will be use for the pipeline execution, the tasks manifests compare them
+        if not subject.isLock():
+            subject.createXmlSoftwareVersionConfig(self.softwareVersions)
+
         self.info("Evaluating which task subject {} should process".format(name))
         tasksmanager = TasksManager(subject)
 
+        if subject.getConfig().getboolean('arguments', 'qa_only'):
+            if subject.isLock():
+                self.__processLocksSubjects([subject])
+            else:
+                try:
+                    subject.lock()
+                    self.info("{} qa report(s) rendered for subject {}".format(tasksmanager.runQa(), name))
+                finally:
+                    subject.removeLock()
+            return
+
         if tasksmanager.getNumberOfRunnableTasks():
             message = "Tasks : "
             for task in tasksmanager.getRunnableTasks():
@@ -137,20 +156,83 @@ class SubjectManager(Logger, Config):
                 try:
                     self.info("Starting subject {} at task {}".format(name, tasksmanager.getFirstRunnableTasks().getName()))
                     subject.lock()
-
-                    #log versions that will be use for the pipeline execution
-                    subject.createXmlSoftwareVersionConfig(self.softwareVersions)
                     tasksmanager.run()
 
                 finally:
                     subject.removeLock()
                     self.info("Pipeline finish at {}, have a nice day!".format(self.getTimestamp()))
             else:
-                self.__processLocksSubjects(subject)
+                self.__processLocksSubjects([subject])
         else:
             self.info("Subject {} already completed, it will not be submitted!".format(name))
 
 
+    def __submitLocalSubjects(self, subjects, nbProcesses):
+        """Submit execution of many subjects locally, up to nbProcesses subjects at the same time
+
+        Each subject is process into is own process with is own log directory and lock file.
+        While subjects are running, a summary of the tasks each subject is processing is display
+        everytime it change.
+
+        Args:
+            subjects: a list of subjects
+            nbProcesses: the maximum number of subjects process at the same time
+
+        """
+        if nbProcesses < 2:
+            for subject in subjects:
+                self.__submitLocal(subject)
+            return
+
+        self.info("Up to {} subjects will be process at the same time".format(nbProcesses))
+        pending = list(subjects)
+        running = {}
+        completed = []
+        failed = []
+        summary = None
+
+        try:
+            while pending or running:
+                while pending and len(running) < nbProcesses:
+                    subject = pending.pop(0)
+                    process = multiprocessing.Process(target=self.__submitLocal, args=(subject,), name=subject.getName())
+                    process.start()
+                    running[subject] = process
+
+                for subject, process in running.items():
+                    if not process.is_alive():
+                        process.join()
+                        del running[subject]
+                        if process.exitcode == 0:
+                            completed.append(subject)
+                        else:
+                            failed.append(subject)
+
+                status = []
+                for subject in sorted(running.keys(), key=lambda subject: subject.getName()):
+                    tasks = subject.getRunningTasks()
+                    status.append("{}: {}".format(subject.getName(), ", ".join(tasks) if tasks else "evaluating"))
+                status = "Subjects running: {}. {} pending, {} completed, {} failed".format(
+                        "; ".join(status), len(pending), len(completed), len(failed))
+                if status != summary:
+                    self.info(status)
+                    summary = status
+
+                time.sleep(5)
+
+        except KeyboardInterrupt:
+            #subjects received the interruption too, let them remove their locks
+            for process in running.values():
+                process.join()
+            raise
+
+        if failed:
+            self.warning("Subject(s) {} did not complete, please look at their logs".format(
+                    ", ".join(subject.getName() for subject in failed)))
+
+        self.info("Pipeline finish at {}, have a nice day!".format(self.getTimestamp()))
+
+
     def __submitGridEngine(self, subject):
         """Submit execution of the subject into the grid engine
            this function will wrap a toad call with proper parameters for submission into a Sun or Torque Grid Engine
@@ -174,6 +256,9 @@ class SubjectManager(Logger, Config):
         if not subject.getConfig().getboolean('arguments', 'tractography'):
             toadFlags += " --noTractography "
 
+        if subject.getConfig().getboolean('arguments', 'qa_only'):
+            toadFlags += " --qaOnly "
+
         cmd = "echo {0}/bin/toad {1} {2} | qsub -V -N {3} -o {4} -e {4} {5}".format(self.config.get('arguments', 'toad_dir'),
               subject.getDir(), toadFlags , subject.getName(), subject.getLogDir(), gridFlags)
         self.info("Command launch: {}".format(cmd))
@@ -282,14 +367,22 @@ class SubjectManager(Logger, Config):
         subjects = self.__processLocksSubjects(subjects)
 
         #configure how many subjects will be submit. This information is sensitive for load balancing the grid
+        nbSubjects = len(subjects)
+        nbProcesses = 1
+        if self.config.getboolean('arguments', 'local') and subjects:
+            self.config.set("general", "nb_subjects", str(nbSubjects))
+            nbProcesses = Load(self.config).getNLocalSubjects()
+            if nbProcesses > 1:
+                #locally, the threads are share only between subjects that are process at the same time
+                nbSubjects = nbProcesses
+
         for subject in subjects:
-            subject.setConfigItem("general", "nb_subjects", str(len(subjects)))
+            subject.setConfigItem("general", "nb_subjects", str(nbSubjects))
 
         if self.config.getboolean('arguments', 'reinitialize'):
             self.__reinitialize(subjects)
+        elif self.config.getboolean('arguments', 'local'):
+            self.__submitLocalSubjects(subjects, nbProcesses)
         else:
             for subject in subjects:
-                    if self.config.getboolean('arguments', 'local'):
-                        self.__submitLocal(subject)
-                    else:
-                        self.__submitGridEngine(subject)
+                self.__submitGridEngine(subject)
@@ -1,11 +1,16 @@
 # -*- coding: utf-8 -*-
+import multiprocessing
 import functools
 import importlib
 import inspect
+import Queue
 import glob
 import sys
 import os
 
+from core.toad.load import Load
+from lib import util
+
 __author__ = "Mathieu Desrosiers"
 __copyright__ = "Copyright (C) 2014, TOAD"
 __credits__ = ["Mathieu Desrosiers"]
@@ -88,9 +93,209 @@ class TasksManager(object):
     def run(self):
         """Execute the run() methods of every runnable tasks
 
+        If parallel_tasks is activate into the config file, tasks that do not depend on each other
+        are executed concurrently, see __runConcurrently
+
         """
-        for task in self.__runnableTasks:
+        qaWorker = None
+        if self.__subject.getConfig().get('qa', 'mode') == 'background':
+            finished = multiprocessing.Event()
+            qaWorker = multiprocessing.Process(target=self.__renderQaInBackground, args=(finished,), name='qa')
+            qaWorker.start()
+
+        try:
+            if self.__subject.getConfig().getboolean('general', 'parallel_tasks'):
+                self.__runConcurrently()
+            else:
+                for task in self.__runnableTasks:
+                    self.__execute(task)
+        finally:
+            if qaWorker is not None:
+                self.__subject.info("Waiting for the qa reports queued to be rendered")
+                finished.set()
+                qaWorker.join()
+
+
+    def runQa(self, failed=None):
+        """Render the qa reports queued by the tasks of this subject
+
+        A report that could not be rendered stay into the queue so it could be retried by a later pass
+
+        Args:
+            failed: a set of tasks names that will not be retried, names of reports that fail are added to it
+
+        Returns:
+            the number of reports rendered
+        """
+        if failed is None:
+            failed = set()
+        tasks = self.getQaTasks()
+        if not tasks:
+            return 0
+
+        rendered = 0
+        for name in tasks[0].getQaQueue():
+            for task in tasks:
+                if task.getName() == name and name not in failed:
+                    self.__subject.info("Rendering the qa report of task {}".format(name))
+                    try:
+                        task.renderQa()
+                        rendered += 1
+                    except (Exception, SystemExit), exception:
+                        self.__subject.warning("Unable to render the qa report of task {}: {}".format(name, exception))
+                        failed.add(name)
+        return rendered
+
+
+    def __renderQaInBackground(self, finished):
+        """Entry point of the process that render the qa reports while the tasks are executed
+
+        Args:
+            finished: a multiprocessing Event set once all the tasks are executed
+
+        """
+        failed = set()
+        while True:
+            isFinished = finished.is_set()
+            self.runQa(failed)
+            if isFinished:
+                break
+            finished.wait(5)
+
+
+    def __execute(self, task):
+        """Execute the run() method of a task and register it as running into the subject lock file
+
+        Args:
+            task: the task to execute
+
+        """
+        self.__subject.setRunningTask(task.getName())
+        try:
             task.run()
+        finally:
+            self.__subject.setRunningTask(task.getName(), False)
+
+
+    def __runConcurrently(self):
+        """Execute the run() methods of every runnable tasks into a bounded pool of processes
+
+        A task is started as soon as all its dependencies have finished. Each task run into
+        is own process because tasks move into their working directory during implementation.
+        Config values set by a task are send back to this process so tasks submitted later,
+        and the configRunning.cfg snapshot, see the same values as a sequential execution.
+
+        If a task fail, no more task are submitted and the pipeline stop once the running tasks
+        are finished. Like a sequential execution, tasks that come after stop_before_task in the
+        order of execution are never submitted, even if they do not depend on it.
+
+        """
+        config = self.__subject.getConfig()
+        nbProcesses = Load(config).getNParallelTasks()
+        self.__subject.info("Up to {} tasks will be executed concurrently".format(nbProcesses))
+
+        names = [task.getName() for task in self.__runnableTasks]
+        pending = list(self.__runnableTasks)
+        completed = []
+        failed = []
+        running = {}
+        messages = multiprocessing.Queue()
+
+        stopTask = None
+        for task in self.__runnableTasks:
+            if task.isStopBeforeTask():
+                stopTask = task
+                pending = [candidate for candidate in pending if candidate.getOrder() < task.getOrder()]
+                break
+
+        try:
+            while pending or running:
+                if not failed:
+                    for task in pending[:]:
+                        if len(running) >= nbProcesses:
+                            break
+                        if any(dependency in names and dependency not in completed
+                               for dependency in task.getDependencies()):
+                            continue
+                        pending.remove(task)
+                        process = multiprocessing.Process(target=self.__runTask,
+                                                          args=(task, messages),
+                                                          name=task.getName())
+                        process.start()
+                        running[task] = process
+                        self.__subject.info("Starting task {}, {} task(s) running"
+                                            .format(task.getName(), len(running)))
+
+                if not running:
+                    break
+
+                #wait until a task send back its config section, a finished task is join right away
+                try:
+                    section, items = messages.get(True, 1)
+                    while True:
+                        self.__mergeConfigSection(section, items)
+                        for task, process in running.items():
+                            if task.getName() == section:
+                                process.join()
+                        section, items = messages.get_nowait()
+                except Queue.Empty:
+                    pass
+
+                for task, process in running.items():
+                    if not process.is_alive():
+                        process.join()
+                        del running[task]
+                        if process.exitcode == 0:
+                            completed.append(task.getName())
+                        else:
+                            self.__subject.warning("Task {} exit with status {}, no more tasks will be submitted"
+                                                   .format(task.getName(), process.exitcode))
+                            failed.append(task)
+
+        except (KeyboardInterrupt, SystemExit):
+            for process in running.values():
+                process.terminate()
+            raise
+
+        if failed:
+            self.__subject.error("Task(s) {} failed, exiting the pipeline".format(", ".join(map(str, failed))))
+
+        if stopTask is not None:
+            stopTask.stopBeforeTask()
+
+
+    def __runTask(self, task, messages):
+        """Entry point of the process that execute a single task
+
+        Args:
+            task: the task to execute
+            messages: a multiprocessing Queue where the config section of the task is send once finished
+
+        """
+        self.__execute(task)
+        items = []
+        if task.config.has_section(task.getName()):
+            items = task.config.items(task.getName(), raw=True)
+        messages.put((task.getName(), items))
+
+
+    def __mergeConfigSection(self, section, items):
+        """Register the config values produced by a task executed into another process
+
+        Args:
+            section: the name of the section, usually the name of the task
+            items: a list of (name, value) pairs
+
+        """
+        if not items:
+            return
+        config = self.__subject.getConfig()
+        if not config.has_section(section):
+            config.add_section(section)
+        for name, value in items:
+            config.set(section, name, value)
+        self.__subject.writeConfigRunning(
+                os.path.join(self.__subject.getDir(), '00-backup', 'configRunning.cfg'))
 
 
     def __initialize(self):
@@ -206,6 +411,9 @@ class TasksManager(object):
         for task in tasks:
             task.initializeTasksAsReferences(tasks)
 
+        #directories listing recorded while looking for dirty tasks will be outdated once tasks run
+        util.invalidateImagesCache()
+
         return tasks
 
 
@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+import numpy
+import os
+
+__author__ = "Mathieu Desrosiers"
+__copyright__ = "Copyright (C) 2014, TOAD"
+__credits__ = ["Mathieu Desrosiers"]
+
+
+def getCacheName(source):
+    """Return the name of the binary copy of a connectome stored alongside its csv file
+
+    Args:
+        source: a connectome .csv file
+
+    Returns:
+        the .npz file name
+    """
+    return "{}.npz".format(os.path.splitext(source)[0])
+
+
+def load(source):
+    """Load a connectome matrix, from its binary copy when it is up to date
+
+    The binary copy is created the first time a csv file is loaded
+
+    Args:
+        source: a connectome .csv or .npz file
+
+    Returns:
+        the matrix as a numpy array
+    """
+    if source.endswith('.npz'):
+        return numpy.load(source)['matrix']
+
+    cache = getCacheName(source)
+    if os.path.exists(cache) and os.path.getmtime(cache) >= os.path.getmtime(source):
+        return numpy.load(cache)['matrix']
+
+    matrix = numpy.atleast_2d(numpy.loadtxt(source))
+    numpy.savez_compressed(cache, matrix=matrix, **summarize(matrix))
+    return matrix
+
+
+def save(matrix, target, fmt='%0.4f'):
+    """Write a connectome matrix as csv, with a binary copy that hold the matrix at full precision and its summaries
+
+    Args:
+        matrix: a square numpy array
+        target: the output .csv file name
+        fmt: the format of the values into the csv file
+
+    Returns:
+        the binary .npz file name
+    """
+    numpy.savetxt(target, matrix, delimiter=' ', fmt=fmt)
+    cache = getCacheName(target)
+    numpy.savez_compressed(cache, matrix=matrix, **summarize(matrix))
+    return cache
+
+
+def normalize(matrix):
+    """Symmetrize a connectome matrix then normalize each row, the sum of the elements of a row equal 1.00
+
+    Rows without any connection stay at 0
+
+    Args:
+        matrix: a square numpy array
+
+    Returns:
+        the normalized matrix
+    """
+    matrix = matrix + matrix.T
+    sums = matrix.sum(axis=1, keepdims=True)
+    return numpy.divide(matrix, sums, out=numpy.zeros_like(matrix, dtype=numpy.float64), where=sums != 0)
+
+
+def summarize(matrix):
+    """Compute the graph summaries of a connectome matrix
+
+    Args:
+        matrix: a square numpy array of edge weights
+
+    Returns:
+        a dictionary with the keys: strength and degree of every node, density and total_weight of the graph
+    """
+    edges = matrix != 0
+    nbNodes = matrix.shape[0]
+    offDiagonal = nbNodes * (nbNodes - 1)
+    return {'strength': matrix.sum(axis=1),
+            'degree': edges.sum(axis=1),
+            'density': numpy.float64(edges.sum() - numpy.trace(edges)) / offDiagonal if offDiagonal else 0.0,
+            'total_weight': numpy.float64(matrix.sum())}
+
+
+def aggregate(sources):
+    """Average connectome matrices of several subjects, read from their binary copies
+
+    Args:
+        sources: a list of connectome .csv or .npz files sharing the same nodes
+
+    Returns:
+        the mean matrix
+    """
+    mean = None
+    for source in sources:
+        matrix = load(source)
+        mean = matrix.astype(numpy.float64) if mean is None else mean + matrix
+    return mean / len(sources) if mean is not None else None
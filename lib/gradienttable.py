@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+import numpy
+
+__author__ = "Mathieu Desrosiers"
+__copyright__ = "Copyright (C) 2014, TOAD"
+__credits__ = ["Mathieu Desrosiers"]
+
+
+def readMrtrixEncoding(source):
+    """Read a mrtrix gradient encoding file, values may be separated by spaces or commas
+
+    Args:
+        source: a mrtrix .b encoding file
+
+    Returns:
+        a numpy array of n directions by 4 columns: x, y, z and the b value
+    """
+    with open(source, 'r') as f:
+        rows = [line.replace(',', ' ').split() for line in f if line.strip() and not line.startswith('#')]
+    return numpy.array(rows, dtype=numpy.float64).reshape(-1, 4)
+
+
+def writeMrtrixEncoding(table, target):
+    """Write a gradient table as a mrtrix encoding file, values are separated by commas like the other .b files
+
+    Args:
+        table: a numpy array of n directions by 4 columns
+        target: the output file name
+
+    Returns:
+        the output file name
+    """
+    numpy.savetxt(target, table, fmt='%.10g', delimiter=',')
+    return target
+
+
+def writeFslEncoding(table, affine, bVecsTarget, bValsTarget):
+    """Write a gradient table as fsl bvecs and bvals files, like mrinfo -export_grad_fsl does
+
+    The mrtrix directions are in scanner space, fsl directions are relative to the axes
+    of the image, with the x axis flipped when the image use a neurological convention
+
+    Args:
+        table: a numpy array of n directions by 4 columns
+        affine: the voxels to world affine of the dwi image
+        bVecsTarget: a output vector file name.
+        bValsTarget: a output value file name.
+
+    Returns:
+        a tuple of the two output file names
+    """
+    linear = numpy.asarray(affine, dtype=numpy.float64)[:3, :3]
+    rotation = linear / numpy.sqrt((linear ** 2).sum(axis=0))
+    vectors = numpy.dot(table[:, :3], rotation)
+    if numpy.linalg.det(linear) > 0:
+        vectors[:, 0] = -vectors[:, 0]
+    numpy.savetxt(bVecsTarget, vectors.T, fmt='%.10g', delimiter=' ')
+    numpy.savetxt(bValsTarget, table[:, 3][numpy.newaxis], fmt='%.10g', delimiter=' ')
+    return bVecsTarget, bValsTarget
+
+
+def readEddyParameters(source):
+    """Read the movement parameters produce by eddy
+
+    Args:
+        source: an eddy_parameters file
+
+    Returns:
+        a numpy array with a row for every volume, the columns 3 to 5 are the rotations around x, y and z in radians
+    """
+    return numpy.atleast_2d(numpy.loadtxt(source))
+
+
+def getRotationMatrices(angles):
+    """Build the rotation matrices z * y * x of every rows of angles at once
+
+    Args:
+        angles: a numpy array of n rows by 3 columns, the rotations around x, y and z in radians
+
+    Returns:
+        a numpy array of n 3x3 matrices
+    """
+    cosines, sines = numpy.cos(angles), numpy.sin(angles)
+    ones, zeros = numpy.ones(len(angles)), numpy.zeros(len(angles))
+    x = numpy.array([[ones, zeros, zeros],
+                     [zeros, cosines[:, 0], sines[:, 0]],
+                     [zeros, -sines[:, 0], cosines[:, 0]]])
+    y = numpy.array([[cosines[:, 1], zeros, sines[:, 1]],
+                     [zeros, ones, zeros],
+                     [-sines[:, 1], zeros, cosines[:, 1]]])
+    z = numpy.array([[cosines[:, 2], sines[:, 2], zeros],
+                     [-sines[:, 2], cosines[:, 2], zeros],
+                     [zeros, zeros, ones]])
+    return numpy.einsum('ijn,jkn,kln->nil', z, y, x)
+
+
+def rotate(table, parameters):
+    """Apply the inverse of the movements estimated by eddy to the directions of a gradient table
+
+    Args:
+        table: a numpy array of n directions by 4 columns
+        parameters: the eddy parameters, see readEddyParameters
+
+    Returns:
+        a new gradient table
+    """
+    rotations = getRotationMatrices(parameters[:len(table), 3:6])
+    corrected = table.copy()
+    #the inverse of a rotation is its transpose
+    corrected[:, :3] = numpy.einsum('nji,nj->ni', rotations, table[:, :3])
+    return corrected
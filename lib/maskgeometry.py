@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+import scipy.ndimage
+import numpy
+
+__author__ = "Mathieu Desrosiers"
+__copyright__ = "Copyright (C) 2014, TOAD"
+__credits__ = ["Mathieu Desrosiers"]
+
+
+def getBoundingBox(data, margin=0):
+    """Find the smallest box containing every non zero voxels of a mask
+
+    Args:
+        data: a numpy array
+        margin: a number of voxels added on each side of the box, the box is clipped to the array
+
+    Returns:
+        a tuple of slices, one for each dimension, None if the mask is empty
+    """
+    box = []
+    for axis in range(data.ndim):
+        others = tuple(index for index in range(data.ndim) if index != axis)
+        indices = numpy.flatnonzero(numpy.any(data, axis=others) if others else data)
+        if indices.size == 0:
+            return None
+        box.append(slice(max(indices[0] - margin, 0), min(indices[-1] + 1 + margin, data.shape[axis])))
+    return tuple(box)
+
+
+def dilate(data, distance):
+    """Grow a mask by every voxels within an euclidean distance of it
+
+    A single distance transform is computed, restricted to the bounding box of the mask
+
+    Args:
+        data: a numpy array, non zero voxels belong to the mask
+        distance: the radius of the dilation in voxels
+
+    Returns:
+        a boolean numpy array of the same shape
+    """
+    mask = numpy.asarray(data) != 0
+    result = numpy.zeros(mask.shape, dtype=bool)
+    box = getBoundingBox(mask, int(numpy.ceil(distance)))
+    if box is None:
+        return result
+    result[box] = scipy.ndimage.distance_transform_edt(~mask[box]) <= distance
+    return result
+
+
+def erode(data, distance):
+    """Shrink a mask by every voxels within an euclidean distance of its background
+
+    Voxels outside the array are considered as background, like binary_erosion does
+
+    Args:
+        data: a numpy array, non zero voxels belong to the mask
+        distance: the radius of the erosion in voxels
+
+    Returns:
+        a boolean numpy array of the same shape
+    """
+    mask = numpy.asarray(data) != 0
+    result = numpy.zeros(mask.shape, dtype=bool)
+    box = getBoundingBox(mask)
+    if box is None:
+        return result
+    padded = numpy.pad(mask[box], 1, mode='constant', constant_values=False)
+    inner = (slice(1, -1),) * mask.ndim
+    result[box] = scipy.ndimage.distance_transform_edt(padded)[inner] > distance
+    return result
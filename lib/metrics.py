@@ -0,0 +1,236 @@
+# -*- coding: utf-8 -*-
+import resource
+import glob
+import json
+import time
+import os
+
+__author__ = "Mathieu Desrosiers"
+__copyright__ = "Copyright (C) 2014, TOAD"
+__credits__ = ["Mathieu Desrosiers"]
+
+
+def getUsage():
+    """Take a snapshot of the resources consumed by the current process and its terminated children
+
+    Returns:
+        a dictionary with the keys: time, user and system cpu times in seconds, maxrss the maximum
+        resident set size of the current process in kilobytes, read_bytes and write_bytes the bytes
+        read and written on disk
+
+    """
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return {'time': time.time(),
+            'user': own.ru_utime + children.ru_utime,
+            'system': own.ru_stime + children.ru_stime,
+            'maxrss': own.ru_maxrss,
+            'read_bytes': (own.ru_inblock + children.ru_inblock) * 512,
+            'write_bytes': (own.ru_oublock + children.ru_oublock) * 512}
+
+
+def getUsageDifference(before, after, commandsMaxrss=0):
+    """Compute the resources consumed between two snapshots return by getUsage
+
+    The peak of the current process can not be reset, it is only accounted when it grew
+    between the two snapshots. Otherwise the peak is the one of the commands launched in between
+
+    Args:
+        before: the snapshot taken first
+        after: the snapshot taken last
+        commandsMaxrss: the largest maxrss of the commands launched between the snapshots, see runner.run
+
+    Returns:
+        a dictionary with the keys: start, end, wall, user, system, maxrss, read_bytes and write_bytes
+
+    """
+    maxrss = commandsMaxrss or 0
+    if after['maxrss'] > before['maxrss']:
+        maxrss = max(maxrss, after['maxrss'])
+    return {'start': __timestamp(before['time']),
+            'end': __timestamp(after['time']),
+            'wall': after['time'] - before['time'],
+            'user': after['user'] - before['user'],
+            'system': after['system'] - before['system'],
+            'maxrss': maxrss,
+            'read_bytes': after['read_bytes'] - before['read_bytes'],
+            'write_bytes': after['write_bytes'] - before['write_bytes']}
+
+
+def append(filename, record):
+    """Append a record as a json line into a metrics file
+
+    A single line is written at once, so concurrent tasks could append to the same file
+
+    Args:
+        filename: the metrics file
+        record: a dictionary
+
+    """
+    with open(filename, 'a') as f:
+        f.write(json.dumps(record, sort_keys=True) + "\n")
+
+
+def read(filename):
+    """Read the records of a metrics file, invalid lines are skipped
+
+    Args:
+        filename: the metrics file
+
+    Returns:
+        a list of dictionary
+    """
+    records = []
+    with open(filename, 'r') as f:
+        for line in f:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                pass
+    return records
+
+
+def findMetricsFiles(directories, logDir='99-logs', fileName='metrics.jsonl'):
+    """Find the metrics files of subjects
+
+    Args:
+        directories: a list of subjects directories or studies directories containing subjects
+        logDir: the name of the log directory of a subject
+        fileName: the name of the metrics file
+
+    Returns:
+        a list of tuples (subject name, metrics file)
+    """
+    files = []
+    for directory in directories:
+        directory = os.path.abspath(directory)
+        candidate = os.path.join(directory, logDir, fileName)
+        if os.path.isfile(candidate):
+            files.append((os.path.basename(directory), candidate))
+        else:
+            for candidate in sorted(glob.glob(os.path.join(directory, '*', logDir, fileName))):
+                files.append((os.path.basename(os.path.dirname(os.path.dirname(candidate))), candidate))
+    return files
+
+
+def getTasksSummary(records):
+    """Keep the last attempt of every task of a subject and attach the commands it launched
+
+    Args:
+        records: the records of a single subject, see read
+
+    Returns:
+        a dictionary of task name: the record of the last attempt with the extra keys attempts, the number
+        of attempts of the last execution of the task, and commands
+    """
+    tasks = {}
+    for record in records:
+        if record.get('type') == 'task':
+            tasks[record['task']] = dict(record, attempts=record.get('attempt', 1), commands=[])
+    for record in records:
+        if record.get('type') == 'command' and record.get('task') in tasks:
+            tasks[record['task']]['commands'].append(record)
+    return tasks
+
+
+def getCriticalPath(tasks):
+    """Find the longest chain of dependent tasks of a subject
+
+    Args:
+        tasks: a dictionary return by getTasksSummary
+
+    Returns:
+        a tuple (the list of tasks names of the chain, the wall time of the chain in seconds)
+    """
+    longest = {}
+
+    def walk(name, visiting):
+        if name in longest:
+            return longest[name]
+        best = ([], 0.0)
+        for dependency in tasks[name].get('dependencies', []):
+            if dependency in tasks and dependency not in visiting:
+                candidate = walk(dependency, visiting | set([name]))
+                if candidate[1] > best[1]:
+                    best = candidate
+        longest[name] = (best[0] + [name], best[1] + tasks[name].get('wall', 0.0))
+        return longest[name]
+
+    path = ([], 0.0)
+    for name in tasks:
+        candidate = walk(name, set())
+        if candidate[1] > path[1]:
+            path = candidate
+    return path
+
+
+def report(files, limit=10):
+    """Produce a human readable report of the resources consumed by tasks and commands across subjects
+
+    Args:
+        files: a list of tuples (subject name, metrics file), see findMetricsFiles
+        limit: the number of entries of the rankings
+
+    Returns:
+        a string
+    """
+    studyTasks = {}
+    studyCommands = {}
+    paths = []
+    lines = []
+
+    for subject, filename in files:
+        tasks = getTasksSummary(read(filename))
+        for name, task in tasks.iteritems():
+            studyTasks.setdefault(name, []).append((subject, task))
+            for command in task['commands']:
+                binary = command.get('binary')
+                summary = studyCommands.setdefault(binary, {'count': 0, 'wall': 0.0, 'cpu': 0.0, 'maxrss': 0})
+                summary['count'] += 1
+                summary['wall'] += command.get('wall') or 0.0
+                summary['cpu'] += (command.get('user') or 0.0) + (command.get('system') or 0.0)
+                summary['maxrss'] = max(summary['maxrss'], command.get('maxrss') or 0)
+        path, wall = getCriticalPath(tasks)
+        paths.append((wall, subject, path))
+
+    lines.append("Resources consumed by {} subject(s)".format(len(files)))
+    lines.append("")
+    lines.append("{:<24}{:>9}{:>13}{:>13}{:>13}{:>13}{:>12}{:>12}{:>9}".format(
+        "task", "subjects", "mean wall", "max wall", "mean cpu", "max rss MB", "read MB", "write MB", "retries"))
+    rows = []
+    for name, entries in studyTasks.iteritems():
+        walls = [task.get('wall', 0.0) for subject, task in entries]
+        cpus = [task.get('user', 0.0) + task.get('system', 0.0) for subject, task in entries]
+        rows.append((sum(walls) / len(walls), name, entries, walls, cpus))
+    for meanWall, name, entries, walls, cpus in sorted(rows, reverse=True):
+        lines.append("{:<24}{:>9}{:>13}{:>13}{:>13}{:>13.0f}{:>12.0f}{:>12.0f}{:>9}".format(
+            name, len(entries), __duration(meanWall), __duration(max(walls)), __duration(sum(cpus) / len(cpus)),
+            max(task.get('maxrss', 0) for subject, task in entries) / 1024.0,
+            sum(task.get('read_bytes', 0) for subject, task in entries) / 1024.0 ** 2,
+            sum(task.get('write_bytes', 0) for subject, task in entries) / 1024.0 ** 2,
+            sum(task['attempts'] - 1 for subject, task in entries)))
+
+    lines.append("")
+    lines.append("Slowest commands")
+    lines.append("{:<24}{:>9}{:>13}{:>13}{:>13}".format("command", "count", "total wall", "total cpu", "max rss MB"))
+    commands = sorted(studyCommands.iteritems(), key=lambda item: item[1]['wall'], reverse=True)
+    for binary, summary in commands[:limit]:
+        lines.append("{:<24}{:>9}{:>13}{:>13}{:>13.0f}".format(
+            binary, summary['count'], __duration(summary['wall']), __duration(summary['cpu']),
+            summary['maxrss'] / 1024.0))
+
+    lines.append("")
+    lines.append("Critical paths")
+    for wall, subject, path in sorted(paths, reverse=True)[:limit]:
+        lines.append("{:<24}{:>13}  {}".format(subject, __duration(wall), " -> ".join(path)))
+
+    return "\n".join(lines)
+
+
+def __timestamp(value):
+    return time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(value))
+
+
+def __duration(seconds):
+    seconds = int(seconds)
+    return "{}:{:02d}:{:02d}".format(seconds / 3600, (seconds % 3600) / 60, seconds % 60)
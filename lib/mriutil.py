@@ -1,9 +1,10 @@
 # -*- coding: utf-8 -*-
 import nibabel
 import random
-import scipy
 import numpy
 import util
+import maskgeometry
+import gradienttable
 import os
 from shutil import rmtree
 from collections import OrderedDict
@@ -148,6 +149,83 @@ def __getMrinfoFieldValues(text, field, delimiter=""):
     return output
 
 
+__headersCache = {}
+
+
+def getMriHeader(source):
+    """Read the header of an image and return its structured information
+
+    NIfTI and MGH images are read in process with nibabel, others format fallback to a single mrinfo call.
+    Axes are reported the way mrinfo does, realigned as close as possible to RAS, so strides reflect
+    the order of the axes into the file. The header is cache until the size or the modification time
+    of the file change.
+
+    Args:
+        source: A mri image
+
+    Returns:
+        a dictionary with keys 'dimensions' a list of int, 'voxel_size' a list of float and 'strides' a list of int
+
+    """
+    filename = os.path.abspath(source)
+    stat = os.stat(filename)
+    signature = (stat.st_mtime, stat.st_size)
+    if filename in __headersCache and __headersCache[filename][0] == signature:
+        return __headersCache[filename][1]
+
+    if filename.endswith(('.nii', '.nii.gz', '.mgz', '.mgh')):
+        header = __readNibabelHeader(filename)
+    else:
+        header = __readMrinfoHeader(filename)
+    __headersCache[filename] = (signature, header)
+    return header
+
+
+def __readNibabelHeader(source):
+    """Read the header of an image with nibabel and realign its axes like mrinfo does
+
+    Args:
+        source: A NIfTI or MGH image
+
+    Returns:
+        a dictionary with keys 'dimensions', 'voxel_size' and 'strides'
+
+    """
+    image = nibabel.load(source)
+    shape = list(image.shape)
+    zooms = list(image.header.get_zooms())
+    orientations = nibabel.orientations.io_orientation(image.affine)
+
+    dimensions = list(shape)
+    voxelSize = [float(zoom) for zoom in zooms]
+    strides = range(1, len(shape) + 1)
+    for axis, (world, flip) in enumerate(orientations[:len(shape)]):
+        world = int(world)
+        dimensions[world] = int(shape[axis])
+        voxelSize[world] = float(zooms[axis])
+        strides[world] = int(flip) * (axis + 1)
+    return {'dimensions': [int(dimension) for dimension in dimensions],
+            'voxel_size': voxelSize,
+            'strides': strides}
+
+
+def __readMrinfoHeader(source):
+    """Read the header of an image with a single mrinfo call
+
+    Args:
+        source: A mri image
+
+    Returns:
+        a dictionary with keys 'dimensions', 'voxel_size' and 'strides'
+
+    """
+    text = mrinfo(source)
+    strides = __getMrinfoFieldValues(text, "Data strides:")
+    return {'dimensions': [int(value) for value in __getMrinfoFieldValues(text, "Dimensions:", "x")],
+            'voxel_size': [float(value) for value in __getMrinfoFieldValues(text, "Voxel size:", "x")],
+            'strides': [int(value) for value in strides.strip("[]").split()] if strides else []}
+
+
 def getMriDimensions(source):
     """get the image dimension along each axis of the source image
 
@@ -155,10 +233,10 @@ def getMriDimensions(source):
         source: A mri image
 
     Returns:
-        the image dimension along each axis
+        a list of int, the image dimension along each axis
 
     """
-    return __getMrinfoFieldValues(mrinfo(source), "Dimensions:", "x")
+    return list(getMriHeader(source)['dimensions'])
 
 
 def getMriVoxelSize(source):
@@ -168,10 +246,10 @@ def getMriVoxelSize(source):
         source: A mri image
 
     Returns:
-        the voxel size of the source image
+        a list of float, the voxel size of the source image
 
     """
-    return __getMrinfoFieldValues(mrinfo(source), "Voxel size:", "x")
+    return list(getMriHeader(source)['voxel_size'])
 
 
 def getNbDirectionsFromDWI(source):
@@ -186,7 +264,7 @@ def getNbDirectionsFromDWI(source):
     """
     dimensions =  getMriDimensions(source)
     if len(dimensions) == 4:
-            return int(dimensions[3])
+            return dimensions[3]
     return 0
 
 
@@ -197,10 +275,10 @@ def getDataStridesOrientation(source):
         source: A mri image
 
     Returns:
-        An array of string elements representing the layout of the image
+        a comma separated string representing the layout of the image, like stride_orientation
 
     """
-    return ",".join(__getMrinfoFieldValues(mrinfo(source), "Data strides:").strip("[]").split())
+    return ",".join(str(stride) for stride in getMriHeader(source)['strides'])
 
 
 def isDataStridesOrientationExpected(source, layouts):
@@ -247,43 +325,15 @@ def applyGradientCorrection(bFilename, eddyFilename, target):
     Args:
         bFilename: the original gradient encoding file.
         eddyFilename:  corrected gradient file after an eddy correction
+        target: the output file name
 
     Returns:
         the resulting gradient encoding file
 
     """
-    f = open(eddyFilename, 'r')
-    g = open(bFilename, 'r')
-    eddys = f.readlines()
-    b_line = g.readlines()
-    f.close()
-    g.close()
-
-    h = open(target, 'w')
-
-    for index, line in enumerate(eddys):
-        row_four_to_six_eddy = line.split('  ')[3:6]
-        x= numpy.matrix([[1, 0, 0],
-                         [0,numpy.cos(float(row_four_to_six_eddy[0])), numpy.sin(float(row_four_to_six_eddy[0]))],
-                         [0,-numpy.sin(float(row_four_to_six_eddy[0])), numpy.cos(float(row_four_to_six_eddy[0]))]])
-
-        y= numpy.matrix([[numpy.cos(float(row_four_to_six_eddy[1])), 0, numpy.sin(float(row_four_to_six_eddy[1]))],
-                     [0, 1, 0],
-                     [-numpy.sin(float(row_four_to_six_eddy[1])), 0, numpy.cos(float(row_four_to_six_eddy[1]))]])
-
-        z= numpy.matrix([[numpy.cos(float(row_four_to_six_eddy[1])), numpy.sin(float(row_four_to_six_eddy[1])), 0],
-                     [-numpy.sin(float(row_four_to_six_eddy[1])), numpy.cos(float(row_four_to_six_eddy[1])), 0],
-                     [0, 0, 1]])
-        matrix = (z*y*x).I
-        b_values = b_line[index].split(',')
-        gradient = numpy.matrix([[float(b_values[0]), float(b_values[1]),float(b_values[2])]])
-        new_gradient = matrix*gradient.T
-
-        values = str(float(new_gradient[0]))+','+str(float(new_gradient[1]))+','+str(float(new_gradient[2]))+','+b_values[3].strip()+'\n'
-        h.write(values)
-
-    h.close()
-    return target
+    table = gradienttable.rotate(gradienttable.readMrtrixEncoding(bFilename),
+                                 gradienttable.readEddyParameters(eddyFilename))
+    return gradienttable.writeMrtrixEncoding(table, target)
 
 
 def fslToMrtrixEncoding(dwi, bVecs, bVals, target):
@@ -330,24 +380,79 @@ def extractStructure(values, source, target):
     """
     image = nibabel.load(source)
     data = image.get_data()
-    c = []
-    for value in values:
-        c.append(numpy.where(data==value))
-
-    data.fill(0)
-    for i in range(len(values)):
-        data[c[i]] = 1
+    mask = getLabelsMasks(data, [values])[0]
 
     if not os.path.exists(target):
-        nibabel.save(nibabel.Nifti1Image(data, image.get_affine()), target)
-        return target
+        nibabel.save(nibabel.Nifti1Image(mask.astype(data.dtype), image.get_affine()), target)
+    return target
+
+
+def createLabelsLookup(labels, values, default=0):
+    """ Build a lookup table from integer labels to values, see lookupLabels
+
+    Args:
+        labels: a list of non negative integer labels
+        values: the value of every label, scalars or rows like colors
+        default: the value of the labels not specified
+
+    returns:
+        the lookup table, its last entry hold the default value
+    """
+    labels = numpy.asarray(labels, dtype=numpy.intp)
+    values = numpy.asarray(values)
+    lut = numpy.empty((labels.max() + 2,) + values.shape[1:], dtype=values.dtype)
+    lut[...] = default
+    lut[labels] = values
+    return lut
+
+
+def lookupLabels(data, lut):
+    """ Map every voxel of a labels image to the entry of its label into a lookup table, in a single pass
+
+    Labels greater than the table map to its last entry, negative labels to its first one
+
+    Args:
+        data: an array of labels
+        lut: a lookup table, see createLabelsLookup
+
+    returns:
+        an array of the shape of data, extended by the shape of the entries of lut
+    """
+    data = numpy.asarray(data)
+    if not numpy.issubdtype(data.dtype, numpy.integer):
+        data = numpy.rint(data)
+    return numpy.take(lut, data.astype(numpy.intp), axis=0, mode='clip')
+
+
+def getLabelsMasks(data, groups):
+    """ Create a mask for every group of labels with a single lookup over a labels image
+
+    A label could belong to several groups, every group is a bit of the lookup table
+
+    Args:
+        data: an array of labels, like a parcellation
+        groups: a list of lists of integer labels
+
+    returns:
+        a list of boolean arrays, one for each group
+    """
+    if len(groups) > 64:
+        raise ValueError("getLabelsMasks support up to 64 groups, {} specified".format(len(groups)))
+    dtype = [dtype for dtype in [numpy.uint8, numpy.uint16, numpy.uint32, numpy.uint64]
+             if numpy.dtype(dtype).itemsize * 8 >= len(groups)][0]
+    size = max([max(group) for group in groups if len(group)] + [0]) + 2
+    lut = numpy.zeros(size, dtype=dtype)
+    for index, group in enumerate(groups):
+        lut[numpy.asarray(group, dtype=numpy.intp)] |= dtype(1 << index)
+    bits = lookupLabels(data, lut)
+    return [(bits & dtype(1 << index)) != 0 for index in range(len(groups))]
 
 
 def plotConnectome(source, target,  lutFile=None, title=None, label=None, skiprows=0, usecols=None, useGrid=False):
     """ Create a imshow plot
 
     Args:
-        source: an input source file
+        source: an input source file, a text file or a connectome .npz file
 
     Return:
         A png image of the plot
@@ -379,7 +484,10 @@ def plotConnectome(source, target,  lutFile=None, title=None, label=None, skipro
         return locations, labels
 
     import matplotlib.pylab as plt
-    data = numpy.loadtxt(source, skiprows=skiprows, usecols=usecols)
+    if source.endswith('.npz'):
+        data = numpy.load(source)['matrix']
+    else:
+        data = numpy.loadtxt(source, skiprows=skiprows, usecols=usecols)
     figure = plt.figure(figsize=(18,14), dpi=120)
     #figure.clf()
     ax = figure.add_subplot(111)
@@ -449,64 +557,139 @@ def read_mrtrix_header(in_file):
 
 
 def read_mrtrix_streamlines(in_file, header, as_generator=True):
-    offset = header['offset']
-    stream_count = header['count']
-    fileobj = open(in_file,'r')
-    fileobj.seek(offset)
-    endianness = nibabel.volumeutils.native_code
-    f4dt = numpy.dtype(endianness + 'f4')
-    pt_cols = 3
-    bytesize = pt_cols*4
-    def points_per_track(offset):
-        track_points = []
-        all_str = fileobj.read()
-        num_triplets = len(all_str)/bytesize
-        pts = numpy.ndarray(shape=(num_triplets,pt_cols), dtype='f4',buffer=all_str)
-        nonfinite_list = numpy.where(numpy.isfinite(pts[:,2]) == False)
-        nonfinite_list = list(nonfinite_list[0])[0:-1]
-        for idx, value in enumerate(nonfinite_list):
-            if idx == 0:
-                track_points.append(nonfinite_list[idx])
-            else:
-                track_points.append(nonfinite_list[idx]-nonfinite_list[idx-1]-1)
-        return track_points, nonfinite_list
-
-    def track_gen(track_points):
-        n_streams = 0
-        while True:
-            try:
-                n_pts = track_points[n_streams]
-            except IndexError:
-                break
-            pts_str = fileobj.read(n_pts * bytesize)
-            nan_str = fileobj.read(bytesize)
-            if len(pts_str) < (n_pts * bytesize):
-                if not n_streams == stream_count:
-                    raise StandardError
+    """Read the streamlines of an MRtrix tck file
+
+    Args:
+        in_file: an mrtrix tractography file
+        header: the header of the file, see read_mrtrix_header
+        as_generator: return a lazy iterator instead of a list
+
+    Returns:
+        the streamlines as arrays of points of shape (n, 3), views over the memory mapped file
+    """
+    streamlines = TckStreamlines(in_file, header)
+    if not as_generator:
+        return list(streamlines)
+    return iter(streamlines)
+
+
+class TckStreamlines(object):
+    """Streamlines of an MRtrix tck file, memory mapped instead of loaded
+
+    The data section is mapped as an array of points. The delimiters are located by a single scan
+    over the points, then every streamline is a view into the points from its offset and length.
+    Nothing is read from the disk until a streamline is accessed.
+
+    """
+
+    def __init__(self, in_file, header=None, chunkSize=1000000):
+        """
+        Args:
+            in_file: an mrtrix tractography file
+            header: the header of the file, read from in_file if not specified
+            chunkSize: the number of points scanned at once to locate the delimiters
+        """
+        if header is None:
+            header = read_mrtrix_header(in_file)
+        self.header = header
+
+        dtype = numpy.dtype(nibabel.volumeutils.native_code + 'f4')
+        datatype = header.get('datatype', '').strip()
+        if datatype.endswith('LE'):
+            dtype = dtype.newbyteorder('<')
+        elif datatype.endswith('BE'):
+            dtype = dtype.newbyteorder('>')
+
+        nbPoints = (os.path.getsize(in_file) - header['offset']) / (3 * dtype.itemsize)
+        if nbPoints > 0:
+            self.points = numpy.memmap(
+                    in_file, dtype=dtype, mode='r', offset=header['offset'], shape=(nbPoints, 3))
+        else:
+            self.points = numpy.zeros((0, 3), dtype=dtype)
+
+        #a triplet of NaN end a streamline, a triplet of Inf end the file
+        ends = []
+        for start in range(0, nbPoints, chunkSize):
+            column = numpy.asarray(self.points[start:start + chunkSize, 0])
+            nonFinites = numpy.flatnonzero(~numpy.isfinite(column))
+            infinites = nonFinites[numpy.isinf(column[nonFinites])]
+            if len(infinites):
+                ends.append(nonFinites[nonFinites < infinites[0]] + start)
                 break
-            pts = numpy.ndarray(
-                shape = (n_pts, pt_cols),
-                dtype = f4dt,
-                buffer = pts_str)
-            nan_pt = numpy.ndarray(
-                shape = (1, pt_cols),
-                dtype = f4dt,
-                buffer = nan_str)
-            if numpy.isfinite(nan_pt[0][0]):
-                raise ValueError
+            ends.append(nonFinites + start)
+        ends = numpy.concatenate(ends) if ends else numpy.zeros(0, dtype=numpy.intp)
+        ends = ends[:header.get('count', len(ends))]
+
+        self.offsets = numpy.concatenate(([0], ends[:-1] + 1)).astype(numpy.intp) if len(ends) else ends
+        self.lengths = ends - self.offsets
+
+
+    def __len__(self):
+        return len(self.offsets)
+
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("streamline index out of range")
+        offset = self.offsets[index]
+        return self.points[offset:offset + self.lengths[index]]
+
+
+    def __iter__(self):
+        for index in xrange(len(self)):
+            offset = self.offsets[index]
+            yield self.points[offset:offset + self.lengths[index]]
+
+
+def concatenate_mrtrix_tracks(sources, target, chunkSize=1000000):
+    """Concatenate MRtrix tck files into a single one, streaming their data sections
+
+    The header of the first file is kept with the counts updated
+
+    Args:
+        sources: a list of mrtrix tractography files
+        target: the output tractography file
+        chunkSize: the number of points copied at once
+
+    Returns:
+        the output tractography file
+    """
+    tractograms = [TckStreamlines(source) for source in sources]
+    count = sum(len(tractogram) for tractogram in tractograms)
+    totalCount = sum(int(tractogram.header.get('total_count', len(tractogram))) for tractogram in tractograms)
+    dtype = tractograms[0].points.dtype
+
+    lines = []
+    with open(sources[0], 'r') as f:
+        for line in f:
+            if line == 'END\n':
                 break
-            xyz = pts[:,:3]
-            yield xyz
-            n_streams += 1
-            if n_streams == stream_count:
-                raise StopIteration
-
-    track_points, nonfinite_list = points_per_track(offset)
-    fileobj.seek(offset)
-    streamlines = track_gen(track_points)
-    if not as_generator:
-        streamlines = list(streamlines)
-    return streamlines
+            key = line.split(':')[0]
+            if key not in ['file', 'count', 'total_count']:
+                lines.append(line)
+    lines.append("count: {}\n".format(count))
+    lines.append("total_count: {}\n".format(totalCount))
+
+    #the offset is written into the header, grow it until the header fit before the data
+    offset = 0
+    while True:
+        header = "".join(lines) + "file: . {}\nEND\n".format(offset)
+        if len(header) <= offset:
+            break
+        offset = len(header)
+
+    with open(target, 'wb') as f:
+        f.write(header.ljust(offset, '\0'))
+        for tractogram in tractograms:
+            if not len(tractogram):
+                continue
+            end = tractogram.offsets[-1] + tractogram.lengths[-1] + 1
+            for start in range(0, end, chunkSize):
+                f.write(numpy.asarray(tractogram.points[start:min(start + chunkSize, end)], dtype=dtype).tostring())
+        f.write(numpy.full((1, 3), numpy.inf, dtype=dtype).tostring())
+    return target
 
 
 def get_data_dims(volume):
@@ -527,29 +710,227 @@ def get_vox_dims(volume):
     return [float(voxdims[0]), float(voxdims[1]), float(voxdims[2])]
 
 
-def tck2trk(tractogram, anatomy ,target):
-    """ Converts MRtrix (.tck) tract files into TrackVis (.trk) format using Nibabel API
+def tck2trk(tractogram, anatomy ,target, variants=None, chunkSize=10000):
+    """ Converts MRtrix (.tck) tract files into TrackVis (.trk) format
+
+    The tractogram is memory mapped and converted chunk by chunk, so the memory use does not
+    depend on the number of streamlines. Variants of the tractogram, like the streamlines
+    crossing a region of interest, are written within the same pass over the source.
 
     Args:
 
         source: an mrtrix tractography file
         anatomical: a high resolution image
         target: an output Trackvis format image
+        variants: a list of tuples (target, function) where function receive a list of streamlines
+                  and return the streamlines to write into target, see StreamlinesFilter
+        chunkSize: the number of streamlines converted at once
 
     """
+    streamlines = TckStreamlines(tractogram)
+    writers = [(TrkWriter(target, anatomy), None)]
+    for variantTarget, function in (variants or []):
+        writers.append((TrkWriter(variantTarget, anatomy), function))
+
+    try:
+        for start in range(0, len(streamlines), chunkSize):
+            chunk = [streamlines[index] for index in range(start, min(start + chunkSize, len(streamlines)))]
+            for writer, function in writers:
+                writer.write(chunk if function is None else function(chunk))
+    finally:
+        for writer, function in writers:
+            writer.close()
 
-    nii = nibabel.load(anatomy)
+    return target
 
-    header = {}
-    header[nibabel.streamlines.Field.VOXEL_TO_RASMM] = nii.affine.copy()
-    header[nibabel.streamlines.Field.VOXEL_SIZES] = nii.header.get_zooms()[:3]
-    header[nibabel.streamlines.Field.DIMENSIONS] = nii.shape[:3]
-    header[nibabel.streamlines.Field.VOXEL_ORDER] = "".join(nibabel.orientations.aff2axcodes(nii.affine))
 
-    tck = nibabel.streamlines.load(tractogram)
-    nibabel.streamlines.save(tck.tractogram, target, header=header)
+class TrkWriter(object):
+    """Write streamlines into a TrackVis file as they are produced
 
-    return target
+    The header is written first then rewritten with the number of streamlines when the writer is closed
+
+    """
+
+    def __init__(self, target, anatomy):
+        """
+        Args:
+            target: an output Trackvis format image
+            anatomy: the image that define the space of the streamlines
+        """
+        from nibabel.streamlines.trk import TrkFile, get_affine_rasmm_to_trackvis
+        Field = nibabel.streamlines.Field
+
+        nii = nibabel.load(anatomy)
+        self.header = TrkFile.create_empty_header()
+        self.header[Field.VOXEL_TO_RASMM] = nii.affine.copy()
+        self.header[Field.VOXEL_SIZES] = nii.header.get_zooms()[:3]
+        self.header[Field.DIMENSIONS] = nii.shape[:3]
+        self.header[Field.VOXEL_ORDER] = "".join(nibabel.orientations.aff2axcodes(nii.affine))
+        self.affine = get_affine_rasmm_to_trackvis(self.header)
+        self.count = 0
+        self.file = open(target, 'wb')
+        self.file.write(self.header.tostring())
+
+
+    def write(self, streamlines):
+        """Append streamlines, in rasmm, to the file
+
+        Args:
+            streamlines: a list of arrays of points of shape (n, 3)
+        """
+        buffers = []
+        for points in streamlines:
+            points = numpy.dot(points, self.affine[:3, :3].T) + self.affine[:3, 3]
+            buffers.append(numpy.array([len(points)], dtype='<i4').tostring())
+            buffers.append(points.astype('<f4').tostring())
+        self.file.write("".join(buffers))
+        self.count += len(streamlines)
+
+
+    def close(self):
+        self.header[nibabel.streamlines.Field.NB_STREAMLINES] = self.count
+        self.file.seek(0)
+        self.file.write(self.header.tostring())
+        self.file.close()
+
+
+class StreamlinesFilter(object):
+    """Select streamlines with regions of interest and downsample them, as tckedit then tckresample
+
+    A chunk of streamlines is processed at once: the points are concatenated, mapped to voxels
+    once, and every mask is tested with a single array lookup. The segments between two points
+    are sampled every half voxel, so a region is not missed when the points are sparse.
+
+    """
+
+    def __init__(self, include=None, exclude=None, start=None, stop=None, downsample=1):
+        """
+        Args:
+            include: a binary mask image or a list of them, a streamline must cross every one of them
+            exclude: a binary mask image or a list of them, a streamline crossing one of them is rejected
+            start: a binary mask image where an end of the streamline must be
+            stop: a binary mask image where the other end of the streamline must be
+            downsample: keep one point every downsample points, the last point is always kept
+
+        All masks must share the same grid
+        """
+        self.rasToVoxel = None
+        self.shapes = set()
+        self.include = [self.__load(image) for image in self.__asList(include)]
+        self.exclude = [self.__load(image) for image in self.__asList(exclude)]
+        self.start = self.__load(start) if start else None
+        self.stop = self.__load(stop) if stop else None
+        self.downsample = int(downsample)
+
+        if not self.shapes:
+            raise ValueError("StreamlinesFilter need at least one mask")
+        if len(self.shapes) > 1:
+            raise ValueError("StreamlinesFilter masks do not share the same grid: {}".format(list(self.shapes)))
+        self.shape = self.shapes.pop()
+
+
+    def __asList(self, images):
+        if not images:
+            return []
+        if isinstance(images, basestring):
+            return [images]
+        return list(images)
+
+
+    def __load(self, image):
+        """Load a mask as a flat array of booleans, indexed by __lookup"""
+        nii = nibabel.load(image)
+        if self.rasToVoxel is None:
+            self.rasToVoxel = numpy.linalg.inv(nii.affine)
+        self.shapes.add(nii.shape[:3])
+        return numpy.ascontiguousarray(numpy.asarray(nii.dataobj) > 0).ravel()
+
+
+    def __lookup(self, voxels):
+        """Map voxel coordinates to flat indices into the masks, -1 outside of the grid"""
+        voxels = numpy.rint(voxels).astype(numpy.intp)
+        inside = numpy.all((voxels >= 0) & (voxels < self.shape), axis=1)
+        indices = numpy.full(len(voxels), -1, dtype=numpy.intp)
+        indices[inside] = numpy.ravel_multi_index(voxels[inside].T, self.shape)
+        return indices
+
+
+    def __test(self, mask, indices):
+        values = numpy.zeros(len(indices), dtype=bool)
+        inside = indices >= 0
+        values[inside] = mask[indices[inside]]
+        return values
+
+
+    def __call__(self, streamlines):
+        streamlines = [points for points in streamlines if len(points)]
+        if not streamlines:
+            return []
+        lengths = numpy.array([len(points) for points in streamlines], dtype=numpy.intp)
+        offsets = numpy.concatenate(([0], numpy.cumsum(lengths)[:-1]))
+        points = numpy.concatenate(streamlines).astype(numpy.float64)
+        voxels = numpy.dot(points, self.rasToVoxel[:3, :3].T) + self.rasToVoxel[:3, 3]
+        keep = numpy.ones(len(streamlines), dtype=bool)
+
+        if self.include or self.exclude:
+            samples, owners = self.__sample(voxels, lengths)
+            indices = self.__lookup(samples)
+            for mask in self.include:
+                keep &= numpy.bincount(owners, weights=self.__test(mask, indices), minlength=len(keep)) > 0
+            for mask in self.exclude:
+                keep &= numpy.bincount(owners, weights=self.__test(mask, indices), minlength=len(keep)) == 0
+
+        if self.start is not None or self.stop is not None:
+            firsts = self.__lookup(voxels[offsets])
+            lasts = self.__lookup(voxels[offsets + lengths - 1])
+            if self.start is not None and self.stop is not None:
+                keep &= ((self.__test(self.start, firsts) & self.__test(self.stop, lasts)) |
+                         (self.__test(self.start, lasts) & self.__test(self.stop, firsts)))
+            else:
+                mask = self.start if self.start is not None else self.stop
+                keep &= self.__test(mask, firsts) | self.__test(mask, lasts)
+
+        return self.__downsample(points, lengths, keep, streamlines[0].dtype)
+
+
+    def __sample(self, voxels, lengths):
+        """Sample the segments of the streamlines every half voxel
+
+        Returns:
+            the sampled voxel coordinates and the index of the streamline owning each of them
+        """
+        owners = numpy.repeat(numpy.arange(len(lengths)), lengths)
+        if len(voxels) < 2:
+            return voxels, owners
+
+        #segments joining two different streamlines are discarded
+        segments = voxels[1:] - voxels[:-1]
+        valid = owners[1:] == owners[:-1]
+        segments[~valid] = 0
+        ratio = min(32, int(numpy.ceil(2 * numpy.sqrt((segments ** 2).sum(axis=1)).max())))
+        if ratio < 2:
+            return voxels, owners
+
+        fractions = numpy.arange(1, ratio, dtype=numpy.float64) / ratio
+        between = voxels[:-1][valid][:, None, :] + segments[valid][:, None, :] * fractions[None, :, None]
+        samples = numpy.concatenate((voxels, between.reshape(-1, 3)))
+        owners = numpy.concatenate((owners, numpy.repeat(owners[:-1][valid], ratio - 1)))
+        return samples, owners
+
+
+    def __downsample(self, points, lengths, keep, dtype):
+        """Keep one point every downsample points of the selected streamlines, and their last point"""
+        selected = points[numpy.repeat(keep, lengths)]
+        lengths = lengths[keep]
+        if not len(lengths):
+            return []
+        if self.downsample > 1:
+            positions = numpy.arange(lengths.sum()) - numpy.repeat(numpy.cumsum(lengths) - lengths, lengths)
+            retained = (positions % self.downsample == 0) | (positions == numpy.repeat(lengths, lengths) - 1)
+            selected = selected[retained]
+            lengths = numpy.bincount(numpy.repeat(numpy.arange(len(lengths)), lengths)[retained],
+                                     minlength=len(lengths))
+        return numpy.split(selected.astype(dtype), numpy.cumsum(lengths)[:-1])
 
 
 def isAfreesurferStructure(directory):
@@ -654,14 +1035,172 @@ def getlmax(dwi):
 
     return order
 
-def computeNoiseMask(source, target):
+
+def computePeaksMetrics(peakDirs, peakValues=None, thresholds=None):
+    """Compute per voxel summaries of the peaks extract from a fODF in a single pass over the volume
+
+    A peak is consider present when its direction is not null, the way dipy fill the unused peaks.
+
+    Args:
+        peakDirs: an array of shape (x, y, z, npeaks, 3) of peaks directions, like PeaksAndMetrics.peak_dirs
+        peakValues: an array of shape (x, y, z, npeaks) of peaks values, like PeaksAndMetrics.peak_values
+        thresholds: a list of peak values, the number of peaks greater than each of them is computed
+
+    Returns:
+        an OrderedDict of float32 3d arrays: 'nufo' the number of fibers orientations,
+        'npeaks_<threshold>' the number of peaks above each threshold and 'mean_peak' the mean
+        value of the peaks present. The last two require peakValues.
+
+    """
+    peakDirs = numpy.asarray(peakDirs)
+    present = numpy.any(peakDirs != 0, axis=-1)
+    nufo = present.sum(axis=-1)
+
+    metrics = OrderedDict()
+    metrics['nufo'] = nufo.astype(numpy.float32)
+
+    if peakValues is not None:
+        peakValues = numpy.nan_to_num(numpy.asarray(peakValues, dtype=numpy.float32))
+        if thresholds is not None:
+            for threshold in thresholds:
+                metrics['npeaks_{}'.format(threshold)] = \
+                    numpy.logical_and(present, peakValues > threshold).sum(axis=-1).astype(numpy.float32)
+
+        total = numpy.where(present, peakValues, 0).sum(axis=-1)
+        meanPeak = numpy.zeros(nufo.shape, dtype=numpy.float32)
+        numpy.divide(total, nufo, out=meanPeak, where=nufo > 0, casting='unsafe')
+        metrics['mean_peak'] = meanPeak
+
+    return metrics
+
+def getSlabs(depth, size):
+    """Split an axis into consecutive slabs
+
+    Args:
+        depth: the number of slices along the axis
+        size: the number of slices of each slab, the last slab may be smaller
+
+    Returns:
+        a list of tuples (first slice, last slice exclusive)
+
+    """
+    size = max(1, int(size))
+    return [(start, min(start + size, depth)) for start in range(0, depth, size)]
+
+
+def computeSurfacePartialVolume(vertices, triangles, affine, shape, subdiv=4, chunkSize=100000):
+    """Compute the fraction of every voxel inside a closed triangulated surface
+
+    Every voxel is supersampled subdiv times along each axis. Rays along the z axis are cast through
+    the samples of each column, their crossings with the triangles are sorted and paired inside/outside,
+    and the samples between a pair are accumulated directly into the voxels. The supersampled grid is
+    never allocated, the memory depends on the number of crossings only.
+
+    Args:
+        vertices: an array of shape (n, 3) of the vertices in world coordinates
+        triangles: an array of shape (m, 3) of the vertices indices of every triangle
+        affine: the voxel to world transformation of the grid
+        shape: the shape of the grid
+        subdiv: the number of samples per voxel along each axis
+        chunkSize: the number of triangles intersected at once
+
+    Returns:
+        an array of shape shape with the partial volume, between 0 and 1, as float32
+    """
+    shape = tuple(int(value) for value in shape[:3])
+    #samples coordinates, a small offset keep the rays away from the edges and the vertices
+    samples = numpy.dot(vertices, numpy.linalg.inv(affine)[:3, :3].T) + numpy.linalg.inv(affine)[:3, 3]
+    samples = samples * subdiv - numpy.array([1.37e-4, 2.71e-4, 0])
+    triangles = numpy.asarray(triangles)
+
+    columns = []
+    depths = []
+    for start in range(0, len(triangles), chunkSize):
+        corners = samples[triangles[start:start + chunkSize]]
+        lows = numpy.ceil(corners[:, :, :2].min(axis=1)).astype(numpy.int64)
+        highs = numpy.floor(corners[:, :, :2].max(axis=1)).astype(numpy.int64)
+        sizes = numpy.maximum(highs - lows + 1, 0)
+        counts = sizes[:, 0] * sizes[:, 1]
+        owners = numpy.repeat(numpy.arange(len(corners)), counts)
+        if not len(owners):
+            continue
+
+        #enumerate the rays crossing the bounding box of every triangle
+        ranks = numpy.arange(len(owners)) - numpy.repeat(numpy.cumsum(counts) - counts, counts)
+        x = lows[owners, 0] + ranks // sizes[owners, 1]
+        y = lows[owners, 1] + ranks % sizes[owners, 1]
+
+        #barycentric coordinates of the rays into the projection of the triangles
+        a, b, c = corners[owners, 0], corners[owners, 1], corners[owners, 2]
+        denominator = (b[:, 1] - c[:, 1]) * (a[:, 0] - c[:, 0]) + (c[:, 0] - b[:, 0]) * (a[:, 1] - c[:, 1])
+        valid = denominator != 0
+        denominator[~valid] = 1
+        w0 = ((b[:, 1] - c[:, 1]) * (x - c[:, 0]) + (c[:, 0] - b[:, 0]) * (y - c[:, 1])) / denominator
+        w1 = ((c[:, 1] - a[:, 1]) * (x - c[:, 0]) + (a[:, 0] - c[:, 0]) * (y - c[:, 1])) / denominator
+        w2 = 1 - w0 - w1
+        inside = valid & (w0 >= 0) & (w1 >= 0) & (w2 >= 0)
+
+        columns.append(x[inside] * shape[1] * subdiv + y[inside])
+        depths.append((w0 * a[:, 2] + w1 * b[:, 2] + w2 * c[:, 2])[inside])
+
+    pve = numpy.zeros(shape[0] * shape[1] * (shape[2] + 1), dtype=numpy.float64)
+    if not columns:
+        return pve.reshape(shape[0], shape[1], shape[2] + 1)[:, :, :-1].astype(numpy.float32)
+    columns = numpy.concatenate(columns)
+    depths = numpy.concatenate(depths)
+
+    #pair the crossings of every column, a column with an odd number of crossings lose its last one
+    order = numpy.lexsort((depths, columns))
+    columns = columns[order]
+    depths = depths[order]
+    firsts = numpy.flatnonzero(numpy.concatenate(([True], columns[1:] != columns[:-1])))
+    counts = numpy.diff(numpy.concatenate((firsts, [len(columns)])))
+    ranks = numpy.arange(len(columns)) - numpy.repeat(firsts, counts)
+    entering = (ranks % 2 == 0) & (ranks + 1 < numpy.repeat(counts, counts))
+    entering = numpy.flatnonzero(entering)
+
+    #samples k of the column are inside when entry <= k < exit
+    nbSamples = shape[2] * subdiv
+    starts = numpy.clip(numpy.ceil(depths[entering]), 0, nbSamples).astype(numpy.int64)
+    stops = numpy.clip(numpy.ceil(depths[entering + 1]), 0, nbSamples).astype(numpy.int64)
+    columns = columns[entering]
+    x = columns // (shape[1] * subdiv)
+    y = columns % (shape[1] * subdiv)
+    inGrid = (starts < stops) & (x >= 0) & (x < shape[0] * subdiv) & (y >= 0) & (y < shape[1] * subdiv)
+    starts, stops = starts[inGrid], stops[inGrid]
+    base = ((x[inGrid] // subdiv) * shape[1] + y[inGrid] // subdiv) * (shape[2] + 1)
+
+    #partial voxels at both ends, full voxels in between through a difference along z
+    first, last = starts // subdiv, stops // subdiv
+    same = first == last
+    size = len(pve)
+    pve += numpy.bincount(base[same] + first[same], weights=stops[same] - starts[same], minlength=size)
+    other = ~same
+    pve += numpy.bincount(base[other] + first[other],
+                          weights=subdiv - starts[other] % subdiv, minlength=size)
+    pve += numpy.bincount(base[other] + last[other], weights=stops[other] % subdiv, minlength=size)
+    full = numpy.bincount(base[other] + first[other] + 1, minlength=size) - \
+           numpy.bincount(base[other] + last[other], minlength=size)
+    pve = pve.reshape(shape[0], shape[1], shape[2] + 1)
+    pve += numpy.cumsum(full.reshape(pve.shape), axis=2) * subdiv
+    return (pve[:, :, :-1] / float(subdiv ** 3)).astype(numpy.float32)
+
+
+def computeNoiseMask(source, target, distance=25):
+    """Create a mask of the background voxels far from the brain, into the upper half of the volume
+
+    Args:
+        source: a brain mask
+        target: the output noise mask file name
+        distance: the minimal distance in voxels between the brain and a noise voxel
+
+    Returns:
+        the noise mask file name
+    """
     brainImage = nibabel.load(source)
-    brainData = brainImage.get_data()
-    brainData[brainData>0] = 1
-    maskNoise = scipy.ndimage.morphology.binary_dilation(brainData, iterations=25)
-    maskNoise[..., :maskNoise.shape[-1]//2] = 1
-    maskNoise = ~maskNoise
-    nibabel.save(nibabel.Nifti1Image(maskNoise.astype(numpy.uint8), brainImage.get_affine()), target)
+    maskNoise = maskgeometry.dilate(brainImage.get_data(), distance)
+    maskNoise[..., :maskNoise.shape[-1]//2] = True
+    nibabel.save(nibabel.Nifti1Image((~maskNoise).astype(numpy.uint8), brainImage.get_affine()), target)
     return target
 
 
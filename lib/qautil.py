@@ -1,20 +1,32 @@
 # -*- coding: utf-8 -*-
 
+import bz2
 import functools
+import gzip
+import multiprocessing
+import os
+import shutil
+import StringIO
 import matplotlib
 matplotlib.use('Agg')
 import matplotlib.pyplot
 import mpl_toolkits.mplot3d
 import nibabel
+import nibabel.openers
 import numpy
 import tempfile
 import dipy.data
+import dipy.direction
 import dipy.reconst.dti
 import dipy.segment.mask
 import dipy.viz.colormap
 import dipy.viz.fvtk 
 from dipy.viz import actor, window
-from lib import util
+from lib import util, mriutil, maskgeometry
+try:
+    import PIL.Image
+except ImportError:
+    PIL = None
 
 __author__ = "Christophe Bedetti"
 __copyright__ = "Copyright (C) 2014, TOAD"
@@ -25,78 +37,209 @@ __credits__ = ["Christophe Bedetti"]
 # HELPER functions #
 #~~~~~~~~~~~~~~~~~~#
 
-def imageSlicer(image3dData, minNbrSlices, fov=None):
+def imageSlicer(image3dData, minNbrSlices, fov=None, sample=None):
     """Slice a 3D image
+
+    The image is read slab by slab along the z axis, so a nibabel array proxy could be
+    given instead of an array: only a slab is hold in memory at once and nothing
+    else than the slices is kept. A compressed image can not be read at an offset
+    without decompressing everything before it, so it is decompressed once into
+    a temporary file and its slabs are read from there.
+
     Args:
-        image3dData: 3d image as numpy array
+        image3dData: 3d image as numpy array or nibabel array proxy
         minNbrSlices: minimum number of slices for one dimension
-        fov: field of view link image
+        fov: field of view link image, or its bounding box as returned by getFovBox
             Algorithm assume data>0 to be inside the fov
             default=None
+        sample: a list where a subsample of the voxels is appended,
+            use to estimate a percentile without a second reading of the image
+            default=None
     Return:
         tuple of lenght 3 with slices along the 3 axis (x, y, z)
     """
-    # Computing image width size knowing minimum number of slices
-    widthSize = max(image3dData.shape) * minNbrSlices
-
-    # Determine mins and maxs of the image boundaries
-    if fov != None:
-        fovData = nibabel.load(fov).get_data()
-        mins, maxs = dipy.segment.mask.bounding_box(fovData)
-        #image3dMasked = numpy.ma.masked_where(fovData==0, image3dData)
-    else:
-        mins, maxs = (0, 0, 0), image3dData.shape
-        #image3dMasked = image3dData
-
-    # Image to slice
-    #@TODO: try to crop the image to show more slices ?
-    #image3dCrop = dipy.segment.mask.crop(image3dMasked, mins, maxs)
-    #imageToSlice = image3dCrop
-    #@TODO: try to mask the image to show more slices ?
-    #imageToSlice = image3dMasked
-    imageToSlice = image3dData
-
-    # Number of slices in each dimension
-    x = widthSize / imageToSlice.shape[1]
-    y = widthSize / imageToSlice.shape[0]
-    z = widthSize / imageToSlice.shape[0]
-    numberOfSlices = (x, y, z)
-
-    # Compute slices indices
-    sliceIndices = []
-    for minimum, maximum, dimNbrOfSlices in zip(mins, maxs, numberOfSlices):
-        rangeSize = maximum - minimum
-        start = minimum + rangeSize / dimNbrOfSlices
-        stop = maximum
-        indices = numpy.linspace(start, stop, dimNbrOfSlices, endpoint=False)
-        sliceIndices.append(indices.astype('uint8'))
-
-    # Extract x slices
-    xSlices = imageToSlice[sliceIndices[0], :, :]
-    xNewShape = (imageToSlice.shape[1] * x, imageToSlice.shape[2])
-    xSlices = numpy.reshape(xSlices, xNewShape)
-
-    # Extract y slices
-    ySlices = imageToSlice[:, sliceIndices[1], :]
-    ySlices = numpy.rollaxis(ySlices, 1)
-    yNewShape = (imageToSlice.shape[0] * y, imageToSlice.shape[2])
-    ySlices = numpy.reshape(ySlices, yNewShape)
-
-    # Extract z slices
-    zSlices = imageToSlice[:, :, sliceIndices[2]]
-    zSlices = numpy.rollaxis(zSlices, 2)
-    zNewShape = (imageToSlice.shape[0] * z, imageToSlice.shape[1])
-    zSlices = numpy.reshape(zSlices, zNewShape)
+    temporary = None
+    if isCompressedProxy(image3dData):
+        temporary = __uncompressToTemporary(image3dData.file_like)
+        image3dData = nibabel.load(temporary).dataobj
+    try:
+        shape = image3dData.shape[:3]
+
+        # Computing image width size knowing minimum number of slices
+        widthSize = max(shape) * minNbrSlices
+
+        # Determine mins and maxs of the image boundaries
+        if fov is None:
+            mins, maxs = (0, 0, 0), shape
+        elif isinstance(fov, basestring):
+            mins, maxs = getFovBox(fov)
+        else:
+            mins, maxs = fov
+
+        # Number of slices in each dimension
+        x = widthSize / shape[1]
+        y = widthSize / shape[0]
+        z = widthSize / shape[0]
+        numberOfSlices = (x, y, z)
+
+        # Compute slices indices
+        sliceIndices = []
+        for minimum, maximum, dimNbrOfSlices in zip(mins, maxs, numberOfSlices):
+            rangeSize = maximum - minimum
+            start = minimum + rangeSize / dimNbrOfSlices
+            stop = maximum
+            indices = numpy.linspace(start, stop, dimNbrOfSlices, endpoint=False)
+            sliceIndices.append(indices.astype(int))
+
+        xSlices = ySlices = zSlices = None
+        stride = max(1, numpy.prod(shape) / 1000000)
+        slabSize = 8
+        for start in range(0, shape[2], slabSize):
+            stop = min(start + slabSize, shape[2])
+            slab = numpy.asarray(image3dData[:, :, start:stop])
+            if xSlices is None:
+                # Allocated from the first slab, the scaling of a proxy may change the type
+                xSlices = numpy.empty((x, shape[1], shape[2]), dtype=slab.dtype)
+                ySlices = numpy.empty((y, shape[0], shape[2]), dtype=slab.dtype)
+                zSlices = numpy.empty((z, shape[0], shape[1]), dtype=slab.dtype)
+
+            # Extract x and y slices
+            xSlices[:, :, start:stop] = slab[sliceIndices[0], :, :]
+            ySlices[:, :, start:stop] = numpy.rollaxis(slab[:, sliceIndices[1], :], 1)
+
+            # Extract z slices
+            for index, value in enumerate(sliceIndices[2]):
+                if start <= value < stop:
+                    zSlices[index] = slab[:, :, value - start]
+
+            if sample is not None:
+                sample.append(slab.ravel()[::stride])
+
+        xSlices = numpy.reshape(xSlices, (shape[1] * x, shape[2]))
+        ySlices = numpy.reshape(ySlices, (shape[0] * y, shape[2]))
+        zSlices = numpy.reshape(zSlices, (shape[0] * z, shape[1]))
+    finally:
+        if temporary is not None:
+            os.remove(temporary)
 
     return (xSlices, ySlices, zSlices)
 
 
+def isCompressedProxy(data):
+    """Tell if data is a nibabel array proxy reading a compressed image, like .nii.gz or .mgz
+
+    The compression is found by the opener nibabel use for the file, not from its name
+
+    Args:
+        data: a numpy array or a nibabel array proxy
+    Return:
+        True if the slices of data are decompressed from the start of the file at every reading
+    """
+    source = getattr(data, 'file_like', None)
+    if not isinstance(source, basestring):
+        return False
+    with nibabel.openers.ImageOpener(source) as opener:
+        return isinstance(opener.fobj, (gzip.GzipFile, bz2.BZ2File))
+
+
+def getFovBox(fov):
+    """Compute the bounding box of a field of view
+
+    Args:
+        fov: field of view link image, data>0 is inside the fov
+    Return:
+        tuple (mins, maxs) as dipy.segment.mask.bounding_box
+    """
+    box = maskgeometry.getBoundingBox(numpy.asarray(nibabel.load(fov).dataobj) > 0)
+    if box is None:
+        return (0, 0, 0), (0, 0, 0)
+    return tuple(int(axis.start) for axis in box[:3]), tuple(int(axis.stop) for axis in box[:3])
+
+
+def estimatePercentile(data, percentile, nbSamples=1000000):
+    """Estimate a percentile of an image from a regular subsample of its voxels
+
+    Args:
+        data: an array
+        percentile: the percentile to compute, between 0 and 100
+        nbSamples: approximative number of voxels use
+    Return:
+        the percentile
+    """
+    stride = max(1, data.size / nbSamples)
+    return numpy.percentile(data.ravel()[::stride], percentile)
+
+
 def frames2Gif(frames, target, gifSpeed):
-    cmd = 'convert -delay {} '.format(str(gifSpeed))
+    """Assemble frames into an animated gif
+
+    Frames are assembled in memory with PIL when available, with convert from imagemagick otherwise
+
+    Args:
+        frames: a list of encoded images, as produced by savefig into a StringIO
+        target: output filename
+        gifSpeed: delay between images (tens of ms)
+    """
+    if PIL is not None:
+        images = [PIL.Image.open(StringIO.StringIO(frame)).convert('RGB').convert('P', palette=PIL.Image.ADAPTIVE)
+                  for frame in frames]
+        images[0].save(target, save_all=True, append_images=images[1:], duration=gifSpeed * 10, loop=0)
+        return
+
+    files = []
     for frame in frames:
-        cmd += '{} '.format(frame.name)
+        f = tempfile.NamedTemporaryFile(suffix='.png')
+        f.write(frame)
+        f.flush()
+        files.append(f)
+    cmd = 'convert -delay {} '.format(str(gifSpeed))
+    for f in files:
+        cmd += '{} '.format(f.name)
     cmd += target
     util.launchCommand(cmd)
+    for f in files:
+        f.close()
+
+
+def renderFrames(volumes, nbProcesses=1):
+    """Render Plot3dVolume frames, across a pool of processes if nbProcesses is greater than 1
+
+    Args:
+        volumes: a list of dictionary of the arguments of renderFrame
+        nbProcesses: the number of processes rendering frames at the same time
+
+    Returns:
+        a list of encoded images, in the same order as volumes
+    """
+    nbProcesses = min(max(1, nbProcesses), len(volumes))
+    if nbProcesses < 2:
+        return [renderFrame(volume) for volume in volumes]
+    pool = multiprocessing.Pool(nbProcesses)
+    try:
+        frames = pool.map(renderFrame, volumes, chunksize=1)
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+    return frames
+
+
+def renderFrame(arguments):
+    """Render a 3D volume with Plot3dVolume into memory
+
+    Args:
+        arguments: a dictionary with the keys data, vmax, fov, grid, textData, smallSize and format
+
+    Returns:
+        the encoded image
+    """
+    frame = StringIO.StringIO()
+    plot = Plot3dVolume(
+            arguments['data'], vmax=arguments['vmax'], sourceIsData=True,
+            fov=arguments['fov'], grid=arguments.get('grid', False),
+            textData=arguments.get('textData'))
+    plot.save(frame, smallSize=arguments.get('smallSize', False), format=arguments.get('format', 'png'))
+    return frame.getvalue()
 
 
 #~~~~~~~~~#
@@ -111,7 +254,7 @@ class Plot3dVolume(object):
         """Slice and plot a 3D image
         Args:
             source : nifti file for the background
-            fov: nifti file to know where to slice the image
+            fov: nifti file to know where to slice the image, or its bounding box
                 Algorithm assume to be inside the fov when data>0
                 default=None
             textData : text data to display in the image
@@ -134,33 +277,51 @@ class Plot3dVolume(object):
         self.grid = grid
         self.colorbar = colorbar
         self.sourceIsData = sourceIsData
+        self.fovBox = self.initFovBox()
         self.imageData = self.initImageData()
-        self.vmax = self.initVmax(vmax)
+        sample = [] if vmax is None else None
         self.slices = imageSlicer(
-                self.imageData, self.minNbrSlices, fov=self.fov)
+                self.imageData, self.minNbrSlices, fov=self.fovBox, sample=sample)
+        self.vmax = self.initVmax(vmax, sample)
         self.figsize = self.initFigsize()
         self.imshow = self.initImshow()
         self.edgesSlices = None
         self.segSlices = None
+        self.segColors = None
         self.lutFile = None
         self.fig = None
         self.ax = None
 
 
+    def initFovBox(self):
+        """
+        Load the fov once, its bounding box is shared by the background, the edges and the overlay
+        """
+        if self.fov is None or not isinstance(self.fov, basestring):
+            return self.fov
+        return getFovBox(self.fov)
+
+
     def initImageData(self):
+        """
+        Return an array proxy, slices are read from the image without loading the whole volume
+        """
         if self.sourceIsData:
             return self.source
         else:
-            return nibabel.load(self.source).get_data()
+            return nibabel.load(self.source).dataobj
 
 
-    def initVmax(self, vmax):
+    def initVmax(self, vmax, sample=None):
         """
         Initialized vmax
+        Args:
+            sample: a list of subsamples of the voxels collected while slicing the image
         """
-        #@TODO: better result with self.slices ?
         if vmax == None:
-            return numpy.percentile(self.imageData, 99)
+            if sample:
+                return numpy.percentile(numpy.concatenate(sample), 99)
+            return estimatePercentile(numpy.asarray(self.imageData), 99)
         else:
             return vmax
 
@@ -197,16 +358,25 @@ class Plot3dVolume(object):
         Arg:
             edges : a nifti file
         """
-        edgesData = nibabel.load(edges).get_data()
+        edgesData = nibabel.load(edges).dataobj
         self.edgesSlices = imageSlicer(
-                edgesData, self.minNbrSlices, fov=self.fov)
+                edgesData, self.minNbrSlices, fov=self.fovBox)
 
 
     def setSegOverlay(self, segOverlay, lutFile):
-        segData = nibabel.load(segOverlay).get_data()
-        self.segSlices = imageSlicer(segData, self.minNbrSlices, fov=self.fov)
+        segData = nibabel.load(segOverlay).dataobj
+        self.segSlices = imageSlicer(segData, self.minNbrSlices, fov=self.fovBox)
         self.lutFile = lutFile
 
+        #colors of the labels, loaded once for the 3 axis, the background is transparent
+        lutData = numpy.loadtxt(self.lutFile, usecols=(0,1,2,3))
+        colors = numpy.empty((len(lutData), 4))
+        colors[:, :3] = lutData[:, 1:] / 256
+        colors[:, 3] = 0.6
+        self.segColors = mriutil.createLabelsLookup(
+                lutData[:, 0].astype(numpy.int), colors, default=(0, 0, 0, 0.6))
+        self.segColors[0] = 0
+
 
     def showSlices(self):
         self.fig = matplotlib.pyplot.figure()
@@ -222,9 +392,10 @@ class Plot3dVolume(object):
         if self.textData != None: self.__showText()
 
 
-    def save(self, target, smallSize=False):
+    def save(self, target, smallSize=False, format=None):
         """
-            target : link of the output image
+            target : link of the output image, or a file object
+            format : the format of the image, required when target is a file object
         """
         self.showSlices()
         matplotlib.pyplot.subplots_adjust(
@@ -234,7 +405,7 @@ class Plot3dVolume(object):
         else:
             self.fig.set_size_inches(self.figsize)
         if self.colorbar: self.__showColorbar()
-        self.fig.savefig(target, facecolor='black')
+        self.fig.savefig(target, facecolor='black', format=format)
         matplotlib.pyplot.close()
 
 
@@ -244,20 +415,8 @@ class Plot3dVolume(object):
 
 
     def __showSeg(self, dim):
-        lutDataOrigin = numpy.loadtxt(self.lutFile, usecols=(0,1,2,3))
-        lutData = numpy.zeros((
-            lutDataOrigin[-1,0].astype(numpy.int)+1,
-            lutDataOrigin.shape[1]))
-        lutData[:,0] = range(0,lutDataOrigin[-1,0].astype(numpy.int)+1,1)
-        lutData[lutDataOrigin[:,0].astype(numpy.int),1:] = lutDataOrigin[:,1:]
-        lutCmap = matplotlib.colors.ListedColormap(lutData[:,1:]/256)
-        norm = matplotlib.colors.BoundaryNorm(lutData[:,0], lutCmap.N)
-        segImshow = functools.partial(
-                matplotlib.pyplot.imshow, alpha=0.6,
-                norm=norm, cmap=lutCmap)
-        segSlices = numpy.ma.masked_where(
-                self.segSlices[dim] == 0, self.segSlices[dim])
-        segImshow(numpy.rot90(segSlices))
+        segColors = mriutil.lookupLabels(self.segSlices[dim], self.segColors)
+        matplotlib.pyplot.imshow(numpy.rot90(segColors))
 
 
     def __showGrid(self, dim):
@@ -292,18 +451,20 @@ class Plot4dVolume(object):
 
     def __init__(
             self, source, source2=None, gifSpeed=30, vmax=None, fov=None,
-            frameFormat='.jpg'):
+            frameFormat='.jpg', nbProcesses=1):
         """Create a animated gif from a 4d NIfTI image
         Args:
             source: 4D NIfTI image
             target: outputfile gif name
             gifSpeed: delay between images (tens of ms), default=30
+            nbProcesses: number of processes rendering frames at the same time, default=1
         """
         self.gifSpeed = gifSpeed
-        self.fov = fov
+        self.fov = getFovBox(fov) if fov is not None else None
         self.imageData = nibabel.load(source).get_data()
         self.vmax = self.initVmax(vmax)
         self.frameFormat = frameFormat
+        self.nbProcesses = nbProcesses
         self.compareVolumes = False
         if source2 != None:
             self.gifSpeed = 100
@@ -319,13 +480,13 @@ class Plot4dVolume(object):
         Initialized vmax
         """
         if vmax == None:
-            return numpy.percentile(self.imageData, 99)
+            return estimatePercentile(self.imageData, 99)
         else:
             return vmax
 
 
     def saveGif(self, target):
-        """Generate animated gif with convert from imagemagick
+        """Generate animated gif, frames are rendered in parallel and assembled in memory
         Args:
             target: output filename
         """
@@ -334,45 +495,37 @@ class Plot4dVolume(object):
         else:
             frameList = self.__createFrames()
         frames2Gif(frameList, target, self.gifSpeed)
-        for frame in frameList: frame.close
 
 
     def saveFrames(self, targets):
-        """Generate images for each frames with convert from imagemagick
+        """Generate images for each frames
         Args:
             target: output filename
         """
-        from shutil import copyfile
-        frameList = self.__createFrames(smallSize=False, grid=False)
+        frameList = self.__createFrames(
+                smallSize=False, grid=False, format=self.frameFormat.lstrip('.'))
         for frame, target in zip(frameList, targets):
-            copyfile(frame.name, target)
-            frame.close
+            with open(target, 'wb') as f:
+                f.write(frame)
 
 
-    def __createFrames(self, smallSize=True, grid=True):
-        frameList = []
+    def __createFrames(self, smallSize=True, grid=True, format='png'):
+        volumes = []
         for num in range(self.imageData.shape[-1]):
-            frame = tempfile.NamedTemporaryFile(suffix=self.frameFormat)
-            plot = Plot3dVolume(
-                    self.imageData[:,:,:,num], vmax=self.vmax,
-                    sourceIsData=True, fov=self.fov, grid=grid)
-            plot.save(frame.name, smallSize=smallSize)
-            frameList.append(frame)
-        return frameList
+            volumes.append({'data': self.imageData[:,:,:,num], 'vmax': self.vmax,
+                            'fov': self.fov, 'grid': grid,
+                            'smallSize': smallSize, 'format': format})
+        return renderFrames(volumes, self.nbProcesses)
 
 
     def __createCompareFrames(self):
-        frameList = []
+        volumes = []
         for imageData, textData in (
                 [self.imageData, 'before'], [self.imageData2, 'after']):
-            frame = tempfile.NamedTemporaryFile(suffix=self.frameFormat)
-            volume = imageData[:,:,:,2]
-            plot = Plot3dVolume(
-                    volume, vmax=self.vmax,
-                    sourceIsData=True, fov=self.fov, textData=textData)
-            plot.save(frame.name, smallSize=True)
-            frameList.append(frame)
-        return frameList
+            volumes.append({'data': imageData[:,:,:,2], 'vmax': self.vmax,
+                            'fov': self.fov, 'textData': textData,
+                            'smallSize': True, 'format': 'png'})
+        return renderFrames(volumes, self.nbProcesses)
 
 
 def plotMovement(parametersFile, targetTranslations, targetRotations):
@@ -433,16 +586,15 @@ def plotVectors(bvecsFile, bvecsCorrected, target, frameFormat='.jpg'):
 
     frameList = []
     for num in range(0,360,3):
-        frame = tempfile.NamedTemporaryFile(suffix=frameFormat)
+        frame = StringIO.StringIO()
         ax.view_init(elev=10., azim=num)
-        matplotlib.pyplot.savefig(frame.name)
-        frameList.append(frame)
+        matplotlib.pyplot.savefig(frame, format='png')
+        frameList.append(frame.getvalue())
 
     #matplotlib.pyplot.close()
     #matplotlib.rcdefaults()
 
     frames2Gif(frameList, target, 10)
-    for frame in frameList: frame.close
 
 
 def plotSigma(sigma, target):
@@ -460,67 +612,103 @@ def plotSigma(sigma, target):
     matplotlib.rcdefaults()
 
 
-def noiseAnalysis(source, maskNoise, maskCc, targetSnr, targetHist):
+def computeNoiseStatistics(sources, maskNoise, maskCc, numBins=40, histRange=(0, 150)):
+    """Compute the SNR of every volume and the histogram of the noise of dwi images
+
+    The masks are loaded once, then the volumes of every dwi are read one at a time
+    through the nibabel proxy, so no 4D copy is ever created. A gzip compressed dwi is
+    first decompressed into a temporary file, a volume could not be read at an offset otherwise
+
+    Args:
+        sources: a list of dwi images
+        maskNoise: a noise mask
+        maskCc: a corpus callosum mask
+        numBins: the number of bins of the histogram
+        histRange: the lower and upper range of the bins
+
+    Returns:
+        a list of tuples (snr for every volume, histogram of the noise of every volumes but the first, bins edges)
     """
+    maskNoiseData = nibabel.load(maskNoise).get_data() > 0
+    maskCcData = nibabel.load(maskCc).get_data() > 0
+    edges = numpy.linspace(histRange[0], histRange[1], numBins + 1)
+
+    statistics = []
+    for source in sources:
+        dwiData = nibabel.load(source).dataobj
+        uncompressed = __uncompressToTemporary(source) if isCompressedProxy(dwiData) else source
+        try:
+            dwiData = nibabel.load(uncompressed).dataobj
+            noiseData = __fitMaskToImage(maskNoiseData, dwiData.shape)
+            ccData = __fitMaskToImage(maskCcData, dwiData.shape)
+            volumeNumber = dwiData.shape[3]
+            snr = numpy.zeros(volumeNumber)
+            histogram = numpy.zeros(numBins, dtype=numpy.int64)
+            for index in range(volumeNumber):
+                volume = numpy.asarray(dwiData[..., index])
+                noise = volume[noiseData].astype(numpy.float64)
+                snr[index] = volume[ccData].mean() / noise.std()
+                if index > 0:
+                    histogram += numpy.histogram(noise, edges)[0]
+            statistics.append((snr, histogram, edges))
+        finally:
+            if uncompressed != source:
+                os.remove(uncompressed)
+    return statistics
+
+
+def __uncompressToTemporary(source):
+    """Decompress an image into a temporary file of the same format, the caller is responsible to remove it
+
     """
-    dwiImage = nibabel.load(source)
-    maskNoiseImage = nibabel.load(maskNoise)
-    maskCcImage = nibabel.load(maskCc)
-
-    dwiData = dwiImage.get_data()
-    maskNoiseData = maskNoiseImage.get_data()
-    maskCcData = maskCcImage.get_data()
-
-    volumeNumber = dwiData.shape[3]
-
-    if dwiData.shape[2] != maskNoiseData.shape[2]:
-        zSliceShape = dwiData.shape[:2] + (1,)
-        zMaskNoise = numpy.zeros(zSliceShape, dtype=maskNoiseData.dtype)
-        zCc = numpy.zeros(zSliceShape, dtype=maskCcData.dtype)
-        maskNoiseData = numpy.concatenate((maskNoiseData, zMaskNoise), axis=2)
-        maskCcData = numpy.concatenate((maskCcData, zCc), axis=2)
-
-    #Corpus Callossum masking
-    dwiDataMaskCc = numpy.empty(dwiData.shape)
-    maskCcData4d = numpy.tile(maskCcData,(volumeNumber,1,1,1))
-    maskCcData4d = numpy.rollaxis(maskCcData4d, 0, start=4)
-    dwiDataMaskCc = numpy.ma.masked_where(maskCcData4d == 0, dwiData)
-
-    #Noise masking
-    dwiDataMaskNoise = numpy.empty(dwiData.shape)
-    maskNoise4d = numpy.tile(maskNoiseData,(volumeNumber,1,1,1))
-    maskNoise4d = numpy.rollaxis(maskNoise4d, 0, start=4)
-    dwiDataMaskNoise = numpy.ma.masked_where(maskNoise4d == 0, dwiData)
-
-    #SNR
-    volumeSize = numpy.prod(dwiData.shape[:3])
-    mean_signal = numpy.reshape(dwiDataMaskCc, [volumeSize, volumeNumber])
-    mean_signal = numpy.mean(mean_signal, axis=0)
-    noise_std = numpy.reshape(dwiDataMaskNoise, [volumeSize, volumeNumber])
-    noise_std = numpy.std(noise_std, axis=0)
-
-    SNR = mean_signal / noise_std
-    matplotlib.pyplot.plot(SNR)
-    matplotlib.pyplot.xlabel('Volumes')
-    matplotlib.pyplot.ylabel('SNR')
-    matplotlib.pyplot.savefig(targetSnr)
-    matplotlib.pyplot.close()
-    matplotlib.rcdefaults()
+    root, extension = os.path.splitext(source)
+    suffix = '.mgh' if extension == '.mgz' else os.path.splitext(root)[1]
+    handle, target = tempfile.mkstemp(suffix=suffix)
+    with os.fdopen(handle, 'wb') as f:
+        with nibabel.openers.ImageOpener(source) as opener:
+            shutil.copyfileobj(opener.fobj, f)
+    return target
+
+
+def __fitMaskToImage(maskData, shape):
+    """Pad or crop a mask along z, so it match the grid of an image
+
+    """
+    if maskData.shape[2] == shape[2]:
+        return maskData
+    fitted = numpy.zeros(shape[:3], dtype=maskData.dtype)
+    depth = min(maskData.shape[2], shape[2])
+    fitted[..., :depth] = maskData[..., :depth]
+    return fitted
 
-    #Hist plot
-    noiseHistData = dwiDataMaskNoise[:,:,:,1:]
-    noiseHistData = numpy.reshape(
-            noiseHistData, numpy.prod(noiseHistData.shape))
-    num_bins = 40
-    #xlim = numpy.percentile(noiseHistData, 98)
-    matplotlib.pyplot.hist(
-            noiseHistData, num_bins,
-            histtype='stepfilled', facecolor='g', range=[0, 150])
-    matplotlib.pyplot.xlabel('Intensity')
-    matplotlib.pyplot.ylabel('Voxels number')
-    matplotlib.pyplot.savefig(targetHist)
-    matplotlib.pyplot.close()
-    matplotlib.rcdefaults()
+
+def noiseAnalysis(sources, maskNoise, maskCc, targets):
+    """Plot the SNR of every volume and the histogram of the noise of dwi images
+
+    Args:
+        sources: a list of dwi images
+        maskNoise: a noise mask
+        maskCc: a corpus callosum mask
+        targets: a list of tuples (SNR plot file name, histogram plot file name), one for each source
+
+    """
+    for (snr, histogram, edges), (targetSnr, targetHist) in \
+            zip(computeNoiseStatistics(sources, maskNoise, maskCc), targets):
+        matplotlib.pyplot.plot(snr)
+        matplotlib.pyplot.xlabel('Volumes')
+        matplotlib.pyplot.ylabel('SNR')
+        matplotlib.pyplot.savefig(targetSnr)
+        matplotlib.pyplot.close()
+        matplotlib.rcdefaults()
+
+        matplotlib.pyplot.hist(
+                edges[:-1], edges, weights=histogram,
+                histtype='stepfilled', facecolor='g')
+        matplotlib.pyplot.xlabel('Intensity')
+        matplotlib.pyplot.ylabel('Voxels number')
+        matplotlib.pyplot.savefig(targetHist)
+        matplotlib.pyplot.close()
+        matplotlib.rcdefaults()
 
 
 def plotReconstruction(data, mask, cc, target, model):
@@ -569,8 +757,18 @@ def plotReconstruction(data, mask, cc, target, model):
         dipy.viz.fvtk.add(ren,dipy.viz.fvtk.sphere_funcs(
             csdodfs, sphere, scale=1.3, colormap='RdYlBu', norm=False))
     elif model == 'hardi_peak':
-        peak_dirs = data.peak_dirs[xmin:xmax, ymin:ymax, zmin:zmax]
-        peak_values = data.peak_values[xmin:xmax, ymin:ymax, zmin:zmax]
+        if isinstance(data, dict):
+            #peaks are not in memory when the qa is rendered by another process, extract them on the slice only
+            data = dipy.direction.peaks_from_model(
+                    model=data['csdModel'],
+                    data=data['dwiData'][xmin:xmax, ymin:ymax, zmin:zmax],
+                    sphere=sphere, relative_peak_threshold=.5, min_separation_angle=25,
+                    return_sh=False, return_odf=False, normalize_peaks=True, npeaks=5)
+            peak_dirs = data.peak_dirs
+            peak_values = data.peak_values
+        else:
+            peak_dirs = data.peak_dirs[xmin:xmax, ymin:ymax, zmin:zmax]
+            peak_values = data.peak_values[xmin:xmax, ymin:ymax, zmin:zmax]
         fodf_peaks = dipy.viz.fvtk.peaks(peak_dirs, peak_values, scale=1.3)
         dipy.viz.fvtk.add(ren, fodf_peaks)
 
@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+import subprocess
+import pipes
+import select
+import signal
+import errno
+import time
+import os
+
+__author__ = "Mathieu Desrosiers"
+__copyright__ = "Copyright (C) 2014, TOAD"
+__credits__ = ["Mathieu Desrosiers"]
+
+
+def run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=None, inactivity=None, nice=0, callback=None,
+        env=None):
+    """Execute a program in a new process, stream its outputs and account the resources it consumed
+
+    The outputs of the child are read line by line as they are produced, so a verbose program
+    never fill the pipes. The function sleep into select until a line is produced or a timeout
+    expire, no polling is done. Once the child exit, its resources usage is collect with wait4.
+
+    Args:
+        cmd: a string representing a unix command to execute
+        stdout: subprocess.PIPE to capture the standard output, or a file object, None to inherit it
+        stderr: subprocess.PIPE to capture the standard error, or a file object, None to inherit it
+        timeout: number of seconds the command may run before being killed
+        inactivity: number of seconds the command may stay silent on its captured outputs before being killed
+        nice: run cmd with an adjusted niceness, which affects process scheduling
+        callback: a function call with the name of the stream, 'stdout' or 'stderr', and the line for every
+                  line produced. When specified, the outputs are not kept into memory
+        env: a dictionary of the environment variables of the child, the current environment if None
+
+    Returns:
+        a dictionary with the keys: command, stdout, stderr, returncode, timeout (None, 'wall' or 'inactivity'),
+        wall, user and system times in seconds, maxrss the maximum resident set size in kilobytes,
+        read_bytes and write_bytes the bytes read and written on disk
+
+    Raises
+        OSError:      the function trying to execute a non-existent file.
+        ValueError :  the command line is called with invalid arguments
+
+    """
+    start = time.time()
+
+    #a pipe inherited by the child, its end of file tell that the child exited when no output is captured
+    sentinelRead, sentinelWrite = os.pipe()
+    try:
+        #the niceness is set by the shell, preexec_fn is not safe when commands are launched from threads
+        shellCmd = "nice -n {} sh -c {}".format(int(nice), pipes.quote(cmd)) if nice else cmd
+        process = subprocess.Popen(shellCmd, stdout=stdout, stderr=stderr, shell=True, env=env)
+    except:
+        os.close(sentinelRead)
+        raise
+    finally:
+        os.close(sentinelWrite)
+
+    streams = {}
+    if process.stdout is not None:
+        streams[process.stdout.fileno()] = 'stdout'
+    if process.stderr is not None:
+        streams[process.stderr.fileno()] = 'stderr'
+    if streams:
+        os.close(sentinelRead)
+        sentinelRead = None
+    else:
+        streams[sentinelRead] = None
+
+    outputs = {'stdout': [], 'stderr': []}
+    pendings = {'stdout': '', 'stderr': ''}
+
+    def dispatch(name, line):
+        if callback is None:
+            outputs[name].append(line)
+        else:
+            callback(name, line)
+
+    expired = None
+    lastActivity = start
+    while streams:
+        now = time.time()
+        delays = []
+        if timeout is not None:
+            delays.append(start + float(timeout) - now)
+        if inactivity is not None and sentinelRead is None:
+            delays.append(lastActivity + float(inactivity) - now)
+        delay = max(0, min(delays)) if delays else None
+
+        try:
+            ready = select.select(streams.keys(), [], [], delay)[0]
+        except select.error, e:
+            if e.args[0] == errno.EINTR:
+                continue
+            raise
+
+        if not ready:
+            if timeout is not None and time.time() - start >= float(timeout):
+                expired = 'wall'
+            else:
+                expired = 'inactivity'
+            try:
+                os.kill(process.pid, signal.SIGKILL)
+            except OSError:
+                pass
+            break
+
+        lastActivity = time.time()
+        for fd in ready:
+            name = streams[fd]
+            data = os.read(fd, 65536)
+            if not data:
+                if name is not None and pendings[name]:
+                    dispatch(name, pendings[name])
+                del streams[fd]
+                continue
+            if name is None:
+                continue
+            lines = (pendings[name] + data).split('\n')
+            pendings[name] = lines.pop()
+            for line in lines:
+                dispatch(name, line + '\n')
+
+    for stream in [process.stdout, process.stderr]:
+        if stream is not None:
+            stream.close()
+    if sentinelRead is not None:
+        os.close(sentinelRead)
+
+    rusage = __wait(process)
+    result = {'command': cmd,
+              'stdout': None,
+              'stderr': None,
+              'returncode': process.returncode,
+              'timeout': expired,
+              'wall': time.time() - start,
+              'user': None,
+              'system': None,
+              'maxrss': None,
+              'read_bytes': None,
+              'write_bytes': None}
+    if rusage is not None:
+        result.update({'user': rusage.ru_utime, 'system': rusage.ru_stime, 'maxrss': rusage.ru_maxrss,
+                       'read_bytes': rusage.ru_inblock * 512, 'write_bytes': rusage.ru_oublock * 512})
+    if callback is None:
+        for name, stream in [('stdout', process.stdout), ('stderr', process.stderr)]:
+            if stream is not None:
+                result[name] = ''.join(outputs[name])
+    return result
+
+
+def __wait(process):
+    """Wait for a process to terminate and collect the resources it consumed
+
+    Args:
+        process: a subprocess.Popen object
+
+    Returns:
+        the resource usage of the process and its children, None if it could not be collected
+
+    """
+    while True:
+        try:
+            pid, status, rusage = os.wait4(process.pid, 0)
+            break
+        except OSError, e:
+            if e.errno == errno.EINTR:
+                continue
+            if e.errno == errno.ECHILD:
+                process.wait()
+                return None
+            raise
+
+    if os.WIFSIGNALED(status):
+        process.returncode = -os.WTERMSIG(status)
+    else:
+        process.returncode = os.WEXITSTATUS(status)
+    return rusage
@@ -1,20 +1,21 @@
 # -*- coding: utf-8 -*-
 import subprocess
-import datetime
+import fnmatch
 import termios
-import signal
 import shutil
-import time
-import glob
 import sys
 import re
 import os
 from string import Template
+import runner
 
 __author__ = "Mathieu Desrosiers"
 __copyright__ = "Copyright (C) 2014, TOAD"
 __credits__ = ["Mathieu Desrosiers"]
 
+#listing of directories recorded by getImages, see invalidateImagesCache
+__imagesCache = {}
+
 
 def symlink(source, targetDir, targetName=None):
     """link a file into the target directory. the link name is the same as the file
@@ -108,15 +109,16 @@ def gzip(source):
     return "{}.gz".format(source)
 
 
-def launchCommand(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=None, nice=0):
+def launchCommand(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=None, nice=0, inactivity=None):
     """Execute a program in a new process
 
     Args:
         command: a string representing a unix command to execute
         stdout: this attribute is a file object that provides output from the child process
         stderr: this attribute is a file object that provides error from the child process
-        timeout: Number of seconds before a process is consider inactive, usefull against deadlock
+        timeout: Number of seconds before the process is killed, usefull against deadlock
         nice: run cmd  with  an  adjusted  niceness, which affects process scheduling
+        inactivity: Number of seconds without any output before the process is consider inactive and killed
 
 
     Returns
@@ -127,23 +129,10 @@ def launchCommand(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=N
         ValueError :  the command line is called with invalid arguments
 
     """
-
-    start = datetime.datetime.now()
-    process = subprocess.Popen(cmd, preexec_fn=lambda: os.nice(nice), stdout=stdout, stderr=stderr, shell=True)
-
-    if timeout is None:
-        process.wait()
-    else:
-        while process.poll() is None:
-            time.sleep(0.2)
-            now = datetime.datetime.now()
-            if (now - start).seconds > timeout:
-                os.kill(process.pid, signal.SIGKILL)
-                os.waitpid(-1, os.WNOHANG)
-                return None, "Error, a timeout for this process occurred"
-    output = list(process.communicate())
-    output.insert(0,cmd)
-    return tuple(output)
+    result = runner.run(cmd, stdout, stderr, timeout, inactivity, nice)
+    if result['timeout'] is not None:
+        return cmd, result['stdout'], "Error, a timeout for this process occurred"
+    return cmd, result['stdout'], result['stderr']
 
 
 def createScript(source, text):
@@ -241,7 +230,56 @@ def arrayOfString(source):
     return __arrayOf(source, 'String')
 
 
-def getImages(config, dir, prefix, postfix=None, extension="nii.gz", subdir=None):
+def invalidateImagesCache(dir=None):
+    """Forget the content of a directory recorded by getImages
+
+    Must be call when files are created, renamed or deleted into a directory that may have been cached
+
+    Args:
+        dir: the directory to forget with all its subdirectories, every directories are forget if None
+
+    """
+    if dir is None:
+        __imagesCache.clear()
+    else:
+        dir = os.path.normpath(dir)
+        for key in __imagesCache.keys():
+            if key == dir or key.startswith(dir + os.sep):
+                del __imagesCache[key]
+
+
+def __findImages(dir, pattern, cache=False):
+    """Return the files of a directory whose name match a shell-style pattern
+
+    The listing of the directory is read once and kept in memory if cache is True,
+    see invalidateImagesCache. Like glob, hidden files are ignored
+
+    Args:
+        dir:     the directory where looking for image(s)
+        pattern: a shell-style pattern that the filename should match
+        cache:   use and record the listing of the directory
+
+    Returns:
+        A list of filenames
+
+    """
+    if not dir:
+        return []
+
+    key = os.path.normpath(dir)
+    if cache and key in __imagesCache:
+        names = __imagesCache[key]
+    else:
+        try:
+            names = [name for name in os.listdir(dir) if not name.startswith('.')]
+        except OSError:
+            names = []
+        if cache:
+            __imagesCache[key] = names
+    return [os.path.join(dir, name) for name in fnmatch.filter(names, pattern)]
+
+
+def getImages(config, dir, prefix, postfix=None, extension="nii.gz", subdir=None, cache=False):
     """A simple utility function that return an mri image given certain criteria
 
     Args:
@@ -251,6 +289,7 @@ def getImages(config, dir, prefix, postfix=None, extension="nii.gz", subdir=None
         postfix: an expression that the filename should end with (excluding the extension)
         extension:     name of the extension of the filename. defaults: nii.gz
         subdir: a subfolder where looking for image(s)
+        cache:  keep the listing of the directory in memory, see invalidateImagesCache
 
     Returns:
         A list of filenames if found, False otherwise
@@ -271,7 +310,7 @@ def getImages(config, dir, prefix, postfix=None, extension="nii.gz", subdir=None
         extension=extension.replace(".", "", 1)
 
     if postfix is None:
-        images = glob.glob("{}/{}*.{}".format(dir, config.get('prefix', prefix), extension))
+        images = __findImages(dir, "{}*.{}".format(config.get('prefix', prefix), extension), cache)
     else:
         pfixs = ""
         if isinstance(postfix, str):
@@ -285,8 +324,8 @@ def getImages(config, dir, prefix, postfix=None, extension="nii.gz", subdir=None
                     pfixs = pfixs + config.get('postfix', element)
                 else:
                     pfixs = pfixs + "_{}".format(element)
-        criterias = "{}/{}*{}.{}".format(dir, config.get('prefix',prefix), pfixs, extension)
-        images = glob.glob(criterias)
+        criterias = "{}*{}.{}".format(config.get('prefix',prefix), pfixs, extension)
+        images = __findImages(dir, criterias, cache)
 
     if len(images) > 0: # Found at least one image
         return images
@@ -294,7 +333,7 @@ def getImages(config, dir, prefix, postfix=None, extension="nii.gz", subdir=None
     return False
 
 
-def getImage(config, dir, prefix, postfix=None, extension="nii.gz", subdir=None):
+def getImage(config, dir, prefix, postfix=None, extension="nii.gz", subdir=None, cache=False):
     """A simple utility function that return an mri image given certain criteria
 
     Args:
@@ -304,13 +343,14 @@ def getImage(config, dir, prefix, postfix=None, extension="nii.gz", subdir=None)
         postfix: an expression that the filename should end with (excluding the extension)
         extension:     name of the extension of the filename. defaults: nii.gz
         subdir: a subfolder where looking for image(s)
+        cache:  keep the listing of the directory in memory, see invalidateImagesCache
 
     Returns:
         the absolute filename if found, False otherwise
 
     """
 
-    images = getImages(config, dir, prefix, postfix, extension, subdir)
+    images = getImages(config, dir, prefix, postfix, extension, subdir, cache)
     if images:
         return images.pop()
 
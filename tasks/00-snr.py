@@ -34,24 +34,10 @@ class Snr(GenericTask):
         ccMask = self.getMaskingImage('aparc_aseg', ['253','mask'])
         ccMaskDownsample = self.buildName(ccMask, 'downsample')
         cmdString = "mri_convert -voxsize {} -rl {} --input_volume {} --output_volume {}"
-        cmd = cmdString.format(" ".join(voxelSize), brainMask, ccMask, ccMaskDownsample)
+        cmd = cmdString.format(" ".join(str(size) for size in voxelSize[:3]), brainMask, ccMask, ccMaskDownsample)
         self.launchCommand(cmd)
 
 
-    def __noiseAnalysis(self, dwi, noiseMask, ccMask, qaImages, description):
-        """
-
-        """
-        snrPng = self.buildName(dwi, 'snr', 'png')
-        histPng = self.buildName(dwi, 'hist', 'png')
-        self.noiseAnalysis(dwi, noiseMask, ccMask, snrPng, histPng)
-        qaImages.extend(Images(
-            (snrPng, '{} DWI image: SNR for each volume'.format(description)),
-            (histPng, '{} DWI image: noise histogram'.format(description)),
-            ))
-        return qaImages
-
-
     def isIgnore(self):
         return True#self.get("ignore")
 
@@ -94,9 +80,13 @@ class Snr(GenericTask):
             (dwiDenoised, 'denoised'),
             (dwiCorrected, 'Corrected'),
             )
-        for dwi, description in tags:
-            if dwi:
-                qaImages = self.__noiseAnalysis(dwi, noiseMask, ccMask, qaImages, description)
+        tags = [(dwi, description) for dwi, description in tags if dwi]
+        plots = self.noiseAnalysis([dwi for dwi, description in tags], noiseMask, ccMask)
+        for (dwi, description), (snrPng, histPng) in zip(tags, plots):
+            qaImages.extend(Images(
+                (snrPng, '{} DWI image: SNR for each volume'.format(description)),
+                (histPng, '{} DWI image: noise histogram'.format(description)),
+                ))
 
         #Build qa masks images
         tags = (
@@ -1,4 +1,5 @@
 # -*- coding: utf-8 -*-
+import multiprocessing
 import os
 import random
 
@@ -219,73 +220,8 @@ class Parcellation(GenericTask):
                 verts[:] = nibabel.affines.apply_affine(surf2world, verts)
                 return verts, tris
 
-        def surf_fill_vtk(vertices, polys, mat, shape):
-            """
-
-            :param vertices:
-            :param polys:
-            :param mat:
-            :param shape:
-            :return:
-            """
-            import vtk
-            from vtk.util import numpy_support
-
-            voxverts = nibabel.affines.apply_affine(numpy.linalg.inv(mat), vertices)
-            points = vtk.vtkPoints()
-            points.SetNumberOfPoints(len(voxverts))
-            for i, pt in enumerate(voxverts):
-                points.InsertPoint(i, pt)
-
-            tris = vtk.vtkCellArray()
-            for vert in polys:
-                tris.InsertNextCell(len(vert))
-                for v in vert:
-                    tris.InsertCellPoint(v)
-
-            pd = vtk.vtkPolyData()
-            pd.SetPoints(points)
-            pd.SetPolys(tris)
-            del points, tris
-
-            whiteimg = vtk.vtkImageData()
-            whiteimg.SetDimensions(shape)
-            if vtk.VTK_MAJOR_VERSION <= 5:
-                whiteimg.SetScalarType(vtk.VTK_UNSIGNED_CHAR)
-            else:
-                info = vtk.vtkInformation()
-                whiteimg.SetPointDataActiveScalarInfo(info, vtk.VTK_UNSIGNED_CHAR, 1)
-
-            ones = numpy.ones(numpy.prod(shape), dtype=numpy.uint8)
-            whiteimg.GetPointData().SetScalars(numpy_support.numpy_to_vtk(ones))
-
-            pdtis = vtk.vtkPolyDataToImageStencil()
-            if vtk.VTK_MAJOR_VERSION <= 5:
-                pdtis.SetInput(pd)
-            else:
-                pdtis.SetInputData(pd)
-
-            pdtis.SetOutputWholeExtent(whiteimg.GetExtent())
-            pdtis.Update()
-
-            imgstenc = vtk.vtkImageStencil()
-            if vtk.VTK_MAJOR_VERSION <= 5:
-                imgstenc.SetInput(whiteimg)
-                imgstenc.SetStencil(pdtis.GetOutput())
-            else:
-                imgstenc.SetInputData(whiteimg)
-                imgstenc.SetStencilConnection(pdtis.GetOutputPort())
-            imgstenc.SetBackgroundValue(0)
-
-            imgstenc.Update()
-
-            data = numpy_support.vtk_to_numpy(
-                imgstenc.GetOutput().GetPointData().GetScalars()).reshape(shape).transpose(2, 1, 0)
-            del pd, voxverts, whiteimg, pdtis, imgstenc
-            return data
-
         def fill_hemis(lh_surf, rh_surf):
-            """
+            """Arguments of fillHemispheres for the surfaces of both hemispheres
 
             :param lh_surf:
             :param rh_surf:
@@ -294,21 +230,7 @@ class Parcellation(GenericTask):
             vertices = numpy.vstack([lh_surf[0], rh_surf[0]])
             tris = numpy.vstack([lh_surf[1],
                                 rh_surf[1]+lh_surf[0].shape[0]])
-            mat = parc.affine.dot(numpy.diag([1/float(subdiv)]*3+[1]))
-            shape = numpy.asarray(parc.shape)*subdiv
-            fill = surf_fill_vtk(vertices, tris, mat, shape)
-            pve = reduce(
-                lambda x, y: x+fill[y[0]::subdiv, y[1]::subdiv, y[2]::subdiv],
-                numpy.mgrid[:subdiv, :subdiv, :subdiv].reshape(3, -1).T, 0
-                ).astype(numpy.float32)
-            pve /= float(subdiv**3)
-            return pve
-
-        def group_rois(rois_ids):
-            m = numpy.zeros(parc.shape, dtype=numpy.bool)
-            for i in rois_ids:
-                numpy.logical_or(parc_data == i, m, m)
-            return m
+            return vertices, tris, parc.affine, parc.shape, subdiv
 
         parc = nibabel.load(aparcAseg)
         parc_data = parc.get_data()
@@ -317,98 +239,132 @@ class Parcellation(GenericTask):
         rh_wm = read_surf(rhWhite, parc)
         lh_gm = read_surf(lhPial, parc)
         rh_gm = read_surf(rhPial, parc)
-        wm_pve = fill_hemis(lh_wm, rh_wm)
-        gm_pve = fill_hemis(lh_gm, rh_gm)
-
-        gm_rois = group_rois([8,   # Left-Cerebellum-Cortex
-                              47,  # Right-Cerebellum-Cortex
-                              17,  # Left-Hippocampus
-                              18,  # Left-Amygdala
-                              53,  # Right-Hippocampus
-                              54,  # Right-Amygdala
-                              550, # Left-CA3
-                              552, # Left-CA1
-                              553, # Left-fimbria
-                              554, # Left-pre-subiculum
-                              555, # Left-fissure
-                              556, # Left-CA4
-                              557, # Left-subiculum
-                              559, # Left-para-subiculum
-                              560, # Left-GC-DC
-                              561, # Left-HATA
-                              562, # Left-molecular-layer
-                              563, # Left-Hipp-Tail
-                              500, # Right-CA3
-                              502, # Right-CA1
-                              503, # Right-fimbria
-                              504, # Right-pre-subiculum
-                              505, # Right-fissure
-                              506, # Right-CA4
-                              507, # Right-subiculum
-                              509, # Right-para-subiculum
-                              510, # Right-GC-DC
-                              511, # Right-HATA
-                              512, # Right-molecular-layer
-                              513 # Right-Hipp-Tail
-                              ]).astype(numpy.float32)
-
-        gm_smooth = scipy.ndimage.gaussian_filter(gm_rois, sigma=voxsize)
-
-        subcort_rois = group_rois([10,  # Left-Thalamus-Proper
-                                   11,  # Left-Caudate
-                                   12,  # Left-Putamen
-                                   13,  # Left-Pallidum
-                                   26,  # Left-Accumbens-area
-                                   49,  # Right-Thalamus-Proper
-                                   50,  # Right-Caudate
-                                   51,  # Right-Putamen
-                                   52,  # Right-Pallidum
-                                   58   # Right-Accumbens-area 
-                                   ]).astype(numpy.float32)
-
-        subcort_smooth = scipy.ndimage.gaussian_filter(subcort_rois, sigma=voxsize)
-
-        wm_rois = group_rois([7,   # Left-Cerebellum-White-Matter
-                              16,  # Brain-Stem
-                              173, # MidBrain
-                              174, # Pons
-                              175, # Medulla
-                              178, # SCP
-                              28,  # Left-VentralDC
-                              46,  # Right-Cerebellum-White-Matter
-                              60,  # Right-VentralDC
-                              85,  # Optic-Chiasm
-                              192, # Corpus_Callosum
-                              88,  # future_WMSA
-                              250, # Fornix
-                              251, # CC_Posterior
-                              252, # CC_Mid_Posterior
-                              253, # CC_Central
-                              254, # CC_Mid_Anterior
-                              255  # CC_Anterior
-                              ]).astype(numpy.float32)
-
-        wm_smooth = scipy.ndimage.gaussian_filter(wm_rois, sigma=voxsize)
-        bs_mask = parc_data == 16 # Brain-Stem
-        bs_vdc_dil = scipy.ndimage.morphology.binary_dilation(group_rois([16, # Brain-Stem
-                                                                          173, # MidBrain
-                                                                          174, # Pons
-                                                                          175, # Medulla
-                                                                          178, # SCP
-                                                                          60, # Right-VentralDC
-                                                                          28  # Left-VentralDC
-                                                                         ]), iterations=2)
-        bs_vdc_excl = numpy.logical_and(bs_vdc_dil, numpy.logical_not(group_rois([16, # Brain-Stem
-                                                                                  7,  # Left-Cerebellum-White-Matter
-                                                                                  46, # Right-Cerebellum-White-Matter
-                                                                                  60, # Right-VentralDC
-                                                                                  28, # Left-VentralDC
-                                                                                  10, # Left-Thalamus-Proper
-                                                                                  49, # Right-Thalamus-Proper
-                                                                                  2,  # Left-Cerebral-White-Matter
-                                                                                  41, # Right-Cerebral-White-Matter
-                                                                                  0   # Nothing
-                                                                                  ])))
+        jobs = [fill_hemis(lh_wm, rh_wm), fill_hemis(lh_gm, rh_gm)]
+        del lh_wm, rh_wm, lh_gm, rh_gm
+        if int(self.getNTreads()) > 1:
+            pool = multiprocessing.Pool(len(jobs))
+            try:
+                wm_pve, gm_pve = pool.map(fillHemispheres, jobs)
+                pool.close()
+            finally:
+                pool.terminate()
+                pool.join()
+        else:
+            wm_pve, gm_pve = map(fillHemispheres, jobs)
+        del jobs
+
+        gm_labels = [8,   # Left-Cerebellum-Cortex
+                     47,  # Right-Cerebellum-Cortex
+                     17,  # Left-Hippocampus
+                     18,  # Left-Amygdala
+                     53,  # Right-Hippocampus
+                     54,  # Right-Amygdala
+                     550, # Left-CA3
+                     552, # Left-CA1
+                     553, # Left-fimbria
+                     554, # Left-pre-subiculum
+                     555, # Left-fissure
+                     556, # Left-CA4
+                     557, # Left-subiculum
+                     559, # Left-para-subiculum
+                     560, # Left-GC-DC
+                     561, # Left-HATA
+                     562, # Left-molecular-layer
+                     563, # Left-Hipp-Tail
+                     500, # Right-CA3
+                     502, # Right-CA1
+                     503, # Right-fimbria
+                     504, # Right-pre-subiculum
+                     505, # Right-fissure
+                     506, # Right-CA4
+                     507, # Right-subiculum
+                     509, # Right-para-subiculum
+                     510, # Right-GC-DC
+                     511, # Right-HATA
+                     512, # Right-molecular-layer
+                     513 # Right-Hipp-Tail
+                     ]
+
+        subcort_labels = [10,  # Left-Thalamus-Proper
+                          11,  # Left-Caudate
+                          12,  # Left-Putamen
+                          13,  # Left-Pallidum
+                          26,  # Left-Accumbens-area
+                          49,  # Right-Thalamus-Proper
+                          50,  # Right-Caudate
+                          51,  # Right-Putamen
+                          52,  # Right-Pallidum
+                          58   # Right-Accumbens-area
+                          ]
+
+        wm_labels = [7,   # Left-Cerebellum-White-Matter
+                     16,  # Brain-Stem
+                     173, # MidBrain
+                     174, # Pons
+                     175, # Medulla
+                     178, # SCP
+                     28,  # Left-VentralDC
+                     46,  # Right-Cerebellum-White-Matter
+                     60,  # Right-VentralDC
+                     85,  # Optic-Chiasm
+                     192, # Corpus_Callosum
+                     88,  # future_WMSA
+                     250, # Fornix
+                     251, # CC_Posterior
+                     252, # CC_Mid_Posterior
+                     253, # CC_Central
+                     254, # CC_Mid_Anterior
+                     255  # CC_Anterior
+                     ]
+
+        bs_vdc_labels = [16, # Brain-Stem
+                         173, # MidBrain
+                         174, # Pons
+                         175, # Medulla
+                         178, # SCP
+                         60, # Right-VentralDC
+                         28  # Left-VentralDC
+                         ]
+
+        bs_vdc_excl_labels = [16, # Brain-Stem
+                              7,  # Left-Cerebellum-White-Matter
+                              46, # Right-Cerebellum-White-Matter
+                              60, # Right-VentralDC
+                              28, # Left-VentralDC
+                              10, # Left-Thalamus-Proper
+                              49, # Right-Thalamus-Proper
+                              2,  # Left-Cerebral-White-Matter
+                              41, # Right-Cerebral-White-Matter
+                              0   # Nothing
+                              ]
+
+        csf_labels = [4,  # Left-Lateral-Ventricle
+                      5,  # Left-Inf-Lat-Vent
+                      14, # 3rd-Ventricle
+                      15, # 4th-Ventricle
+                      24, # CSF
+                      30, # Left-vessel
+                      31, # Left-choroid-plexus
+                      43, # Right-Lateral-Ventricle
+                      44, # Right-Inf-Lat-Vent
+                      62, # Right-vessel
+                      63, # Right-choroid-plexus
+                      72  # 5th-Ventricle
+                      ]
+
+        #every group of labels is extracted within a single lookup over the parcellation
+        gm_rois, subcort_rois, wm_rois, bs_vdc_rois, bs_vdc_excl_rois, csf_rois, bs_mask = \
+            mriutil.getLabelsMasks(parc_data, [gm_labels, subcort_labels, wm_labels, bs_vdc_labels,
+                                               bs_vdc_excl_labels, csf_labels,
+                                               [16]]) # Brain-Stem
+
+        gm_smooth = scipy.ndimage.gaussian_filter(gm_rois.astype(numpy.float32), sigma=voxsize)
+
+        subcort_smooth = scipy.ndimage.gaussian_filter(subcort_rois.astype(numpy.float32), sigma=voxsize)
+
+        wm_smooth = scipy.ndimage.gaussian_filter(wm_rois.astype(numpy.float32), sigma=voxsize)
+        bs_vdc_dil = scipy.ndimage.morphology.binary_dilation(bs_vdc_rois, iterations=2)
+        bs_vdc_excl = numpy.logical_and(bs_vdc_dil, numpy.logical_not(bs_vdc_excl_rois))
 
         lbs = numpy.where((bs_mask).any(-1).any(0))[0][-1]-3
 
@@ -417,20 +373,6 @@ class Parcellation(GenericTask):
             numpy.logical_not(parc_data_mask),
             scipy.ndimage.morphology.binary_dilation(parc_data_mask))
 
-        csf_rois = group_rois([4,  # Left-Lateral-Ventricle
-                               5,  # Left-Inf-Lat-Vent
-                               14, # 3rd-Ventricle
-                               15, # 4th-Ventricle
-                               24, # CSF
-                               30, # Left-vessel
-                               31, # Left-choroid-plexus
-                               43, # Right-Lateral-Ventricle
-                               44, # Right-Inf-Lat-Vent
-                               62, # Right-vessel
-                               63, # Right-choroid-plexus
-                               72  # 5th-Ventricle
-                            ])
-
         csf_smooth = scipy.ndimage.gaussian_filter(
             numpy.logical_or(csf_rois, outer_csf).astype(numpy.float32),
             sigma=voxsize)
@@ -444,7 +386,6 @@ class Parcellation(GenericTask):
         csf_smooth[bs_vdc_excl] += gm_smooth[bs_vdc_excl]
         gm_smooth[bs_vdc_excl] = 0
 
-        mask88 = parc_data == 88 # future_WMSA
         wm = wm_pve+wm_smooth-csf_smooth-subcort_smooth
         wm[wm > 1] = 1
         wm[wm < 0] = 0
@@ -576,3 +517,16 @@ class Parcellation(GenericTask):
             )
 
         return qaImages
+
+
+def fillHemispheres(arguments):
+    """Compute the partial volume inside the surfaces of both hemispheres, Parcellation use it across a pool of processes
+
+    Args:
+        arguments: a tuple (vertices, triangles, affine, shape, subdiv)
+
+    Returns:
+        the partial volume as float32
+    """
+    vertices, triangles, affine, shape, subdiv = arguments
+    return mriutil.computeSurfacePartialVolume(vertices, triangles, affine, shape, subdiv)
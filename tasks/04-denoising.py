@@ -1,4 +1,6 @@
 # -*- coding: utf-8 -*-
+import itertools
+import multiprocessing
 import os
 
 import numpy
@@ -21,9 +23,6 @@ class Denoising(GenericTask):
 
     def __init__(self, subject):
         GenericTask.__init__(self, subject,'preparation', 'parcellation', 'qa')
-        self.matlabWarning = False
-        self.sigmaVector = None
-        self.algorithm = None
 
 
     def implement(self):
@@ -53,32 +52,13 @@ class Denoising(GenericTask):
         if self.get("algorithm") == "mp-pca":
             targetNoise = self.buildName(dwi, "noise")
 
-            self.algorithm = "mp-pca"
             #cmd = "dwidenoise {} {} -mask {} -noise {} -extent {} -nthreads {} -quiet".format(dwi, target, mask, targetNoise, self.get('extent'), self.getNTreadsMrtrix())
             cmd = "dwidenoise {} {} -noise {} -extent {} -nthreads {} -quiet".format(dwi, target, targetNoise, self.get('extent'), self.getNTreadsMrtrix())
             self.launchCommand(cmd)
 
         elif self.get("algorithm") == "nlmeans":
 
-            self.algorithm = "nlmeans"
-            dwiImage = nibabel.load(dwi)
-            dwiData  = dwiImage.get_data()
-            #if self.get('number_array_coil') == "32":
-
-            noiseMask = mriutil.computeNoiseMask(mask, self.buildName(mask, 'noise_mask'))
-            noiseMaskImage = nibabel.load(noiseMask)
-            noiseMaskData  = noiseMaskImage.get_data()
-            sigma = numpy.std(dwiData[noiseMaskData > 0])
-            self.info("sigma value that will be apply into nlmeans = {}".format(sigma))
-            denoisingData = dipy.denoise.nlmeans.nlmeans(dwiData, sigma)
-
-            #else:
-                #self.sigmaVector, sigma, piesnoNoiseMask = self.__computeSigmaAndNoiseMask(dwiData)
-                #self.info("sigma value that will be apply into nlmeans = {}".format(sigma))
-                #denoisingData = dipy.denoise.nlmeans.nlmeans(dwiData, sigma)
-                #nibabel.save(nibabel.Nifti1Image(piesnoNoiseMask.astype(numpy.float32),dwiImage.get_affine()), self.buildName(target, "piesno_noise_mask"))
-
-            nibabel.save(nibabel.Nifti1Image(denoisingData.astype(numpy.float32), dwiImage.get_affine()), target)
+            self.__nlmeans(dwi, mask, target)
 
         elif self.get('general', 'matlab_available'):
             dwiUncompress = self.uncompressImage(dwi)
@@ -95,11 +75,95 @@ class Denoising(GenericTask):
                 self.info("Removing redundant image {}".format(dwiUncompress))
                 os.remove(dwiUncompress)
         else:
-            self.matlabWarning = True
             self.warning("Algorithm {} is set but matlab is not available for this server.\n"
                          "Please configure matlab or set denoising algorithm to nlmeans or none"
                          .format(self.get("algorithm")))
 
+    def __nlmeans(self, source, mask, target):
+        """Denoise every volume of a dwi with nlmeans across a pool of processes
+
+        The volumes are read one at a time from an uncompressed copy of the dwi, so only the
+        denoised output is hold in memory. The number of processes is bounded by getNTreadsDenoise
+
+        Args:
+            source: the dwi image
+            mask: the brain mask of the dwi, use to compute the noise mask
+            target: the denoised output image
+
+        """
+        dwi = self.uncompressImage(source) if source.endswith('.gz') else source
+        dwiImage = nibabel.load(dwi)
+        shape = dwiImage.shape
+        sigmas = self.__computeSigmas(dwi, mask, target)
+
+        nbProcesses = min(int(self.getNTreadsDenoise()), shape[3])
+        self.info("Denoising {} volumes with nlmeans using {} processes".format(shape[3], nbProcesses))
+        denoisingData = numpy.zeros(shape, dtype=numpy.float32)
+        jobs = [(dwi, index, sigmas[index]) for index in range(shape[3])]
+        pool = multiprocessing.Pool(nbProcesses) if nbProcesses > 1 else None
+        try:
+            results = pool.imap_unordered(denoiseVolume, jobs) if pool else itertools.imap(denoiseVolume, jobs)
+            for index, volume in results:
+                denoisingData[..., index] = volume
+            if pool:
+                pool.close()
+        finally:
+            if pool:
+                pool.terminate()
+                pool.join()
+
+        nibabel.save(nibabel.Nifti1Image(denoisingData, dwiImage.get_affine()), target)
+        if dwi != source:
+            os.remove(dwi)
+
+
+    def __computeSigmas(self, dwi, mask, target):
+        """Estimate the sigma of the noise of every volume as configured by nlmeans_sigma
+
+        Args:
+            dwi: the dwi image
+            mask: the brain mask of the dwi, use to compute the noise mask
+            target: the denoised output image, use to name the piesno noise mask
+
+        Returns:
+            a list of sigma for every volume, a float or a vector of sigma for every z slices.
+            Only the vector of piesno is written into sigma_filename for the qa, it is plot by z slices
+        """
+        method = self.get("nlmeans_sigma")
+        dwiData = nibabel.load(dwi).dataobj
+        nbVolumes = dwiData.shape[3]
+
+        if method == "piesno":
+            sigmaVector, piesnoNoiseMask = self.__computeSigmaAndNoiseMask(dwiData)
+            numpy.savetxt(os.path.join(self.workingDir, self.get("sigma_filename")), sigmaVector)
+            nibabel.save(nibabel.Nifti1Image(piesnoNoiseMask.astype(numpy.float32), nibabel.load(dwi).get_affine()),
+                         self.buildName(target, "piesno_noise_mask"))
+            self.info("sigma values for every slices that will be apply into nlmeans = {}".format(sigmaVector))
+            return [sigmaVector] * nbVolumes
+
+        noiseMask = mriutil.computeNoiseMask(mask, self.buildName(mask, 'noise_mask'))
+        noiseMaskData = nibabel.load(noiseMask).get_data() > 0
+
+        #the sum and the sum of squares of the noise are accumulated volume by volume
+        sums = numpy.zeros(nbVolumes)
+        squares = numpy.zeros(nbVolumes)
+        count = noiseMaskData.sum()
+        for index in range(nbVolumes):
+            noise = numpy.asarray(dwiData[..., index])[noiseMaskData].astype(numpy.float64)
+            sums[index] = noise.sum()
+            squares[index] = numpy.dot(noise, noise)
+
+        if method == "volume":
+            sigmas = numpy.sqrt(numpy.maximum(squares / count - (sums / count) ** 2, 0))
+            self.info("sigma values for every volumes that will be apply into nlmeans = {}".format(sigmas))
+            return list(sigmas)
+
+        total = count * nbVolumes
+        sigma = numpy.sqrt(max(squares.sum() / total - (sums.sum() / total) ** 2, 0))
+        self.info("sigma value that will be apply into nlmeans = {}".format(sigma))
+        return [sigma] * nbVolumes
+
+
     def __createMatlabScript(self, source, target):
 
         scriptName = os.path.join(self.workingDir, "{}.m".format(self.get("script_name")))
@@ -112,10 +176,8 @@ class Denoising(GenericTask):
                'nbthreads': self.getNTreadsDenoise()}
 
         if self.get("algorithm") == "aonlm":
-            self.algorithm = "aonlm"
             template = self.parseTemplate(tags, os.path.join(self.toadDir, "templates", "files", "denoise_aonlm.tpl"))
         else:
-            self.algorithm = "lpca"
             template = self.parseTemplate(tags, os.path.join(self.toadDir, "templates", "files", "denoise_lpca.tpl"))
 
         util.createScript(scriptName, template)
@@ -131,12 +193,14 @@ class Denoising(GenericTask):
     def __computeSigmaAndNoiseMask(self, data):
         """Use piesno algorithm to estimate sigma and noise
 
+        piesno estimate every z slices independently from all the volumes, so the image is read
+        one z slice at a time and the whole 4D image is never hold in memory
+
         Args:
-            data: A dMRI 4D matrix
+            data: A dMRI 4D matrix or nibabel array proxy
 
         Returns:
-            a list of float representing sigmas for each z slices
-            a float representing sigma "The estimated standard deviation of the gaussian noise"
+            a vector of float representing sigmas for each z slices
             and a mask identyfing all the pure noise voxel that were found.
         """
 
@@ -144,10 +208,16 @@ class Denoising(GenericTask):
             numberArrayCoil = int(self.get("number_array_coil"))
         except ValueError:
             numberArrayCoil = 1
-        sigmaVector = numpy.zeros(data.shape[2], dtype=numpy.float32)
 
-        sigmaMatrix, maskNoise = dipy.denoise.noise_estimate.piesno(data, N=numberArrayCoil, return_mask=True)
-        return sigmaVector, sigmaMatrix, maskNoise
+        nbSlices = data.shape[2]
+        sigmaVector = numpy.zeros(nbSlices, dtype=numpy.float32)
+        maskNoise = numpy.zeros(data.shape[:3], dtype=bool)
+        for index in range(nbSlices):
+            slab = numpy.asarray(data[:, :, index:index + 1, :])
+            sigma, mask = dipy.denoise.noise_estimate.piesno(slab, N=numberArrayCoil, return_mask=True)
+            sigmaVector[index] = sigma[0]
+            maskNoise[:, :, index] = mask[:, :, 0]
+        return sigmaVector, maskNoise
 
 
     def isIgnore(self):
@@ -173,9 +243,10 @@ class Denoising(GenericTask):
         qaImages = Images()
 
         #Information on denoising algorithm
-        information = 'Denoising was done using the {} algorithm'.format(self.algorithm)
+        algorithm = self.get("algorithm")
+        information = 'Denoising was done using the {} algorithm'.format(algorithm)
 
-        if self.matlabWarning:
+        if algorithm not in ["mp-pca", "nlmeans"] and not self.get('general', 'matlab_available'):
             information = "Algorithm `aonlm` or `lpca` was set for the " \
                     "denoising, but Matlab is not available for this server. "\
                     "Please install and configure Matlab or set `ignore: True`"\
@@ -201,9 +272,10 @@ class Denoising(GenericTask):
                     dwi, dwiDenoised, fov=brainMask)
             qaImages.append((dwiCompareQa, 'Before and after denoising'))
 
-            if self.algorithm == "nlmeans":
-                if self.sigmaVector != None:
-                    sigmaQa = self.plotSigma(self.sigmaVector, dwiDenoised)
+            if algorithm == "nlmeans":
+                sigmaFile = os.path.join(self.workingDir, self.get("sigma_filename"))
+                if os.path.exists(sigmaFile):
+                    sigmaQa = self.plotSigma(numpy.atleast_1d(numpy.loadtxt(sigmaFile)), dwiDenoised)
                     qaImages.append(
                             (sigmaQa, 'Sigmas from the nlmeans algorithm'))
 
@@ -214,3 +286,20 @@ class Denoising(GenericTask):
                             (noiseMaskQa, 'Noise mask from the nlmeans algorithm'))
 
         return qaImages
+
+
+def denoiseVolume(arguments):
+    """Denoise a single volume of a dwi with nlmeans, Denoising use it across a pool of processes
+
+    Args:
+        arguments: a tuple (dwi filename, index of the volume, sigma as a float or a vector for every z slices)
+
+    Returns:
+        the index of the volume and the denoised volume as float32
+    """
+    source, index, sigma = arguments
+    volume = numpy.asarray(nibabel.load(source).dataobj[..., index]).astype(numpy.float64)
+    if numpy.ndim(sigma) == 1:
+        sigma = numpy.ones(volume.shape) * numpy.asarray(sigma, dtype=numpy.float64)[numpy.newaxis, numpy.newaxis, :]
+    #the pool already use the threads budget, nlmeans must not start its own threads
+    return index, dipy.denoise.nlmeans.nlmeans(volume, sigma, num_threads=1).astype(numpy.float32)
@@ -1,12 +1,13 @@
 # -*- coding: utf-8 -*-
 import os
 import math
+import nibabel
 
 import matplotlib
 
 from core.toad.generictask import GenericTask
 from lib.images import Images
-from lib import util, mriutil
+from lib import util, mriutil, gradienttable
 
 __author__ = "Mathieu Desrosiers"
 __copyright__ = "Copyright (C) 2014, TOAD"
@@ -101,11 +102,13 @@ class Correction(GenericTask):
 
         if eddyParameterFiles:
             self.info("Apply eddy movement correction to gradient encodings directions")
-            bEnc = mriutil.applyGradientCorrection(bEnc, eddyParameterFiles, self.buildName(outputImage, None, 'b'))
-            self.info(mriutil.mrtrixToFslEncoding(outputImage,
-                                                  bEnc,
-                                                  self.buildName(outputImage, None, 'bvecs'),
-                                                  self.buildName(outputImage, None, 'bvals')))
+            table = gradienttable.rotate(gradienttable.readMrtrixEncoding(bEnc),
+                                         gradienttable.readEddyParameters(eddyParameterFiles))
+            bEnc = gradienttable.writeMrtrixEncoding(table, self.buildName(outputImage, None, 'b'))
+            gradienttable.writeFslEncoding(table,
+                                           nibabel.load(outputImage).get_affine(),
+                                           self.buildName(outputImage, None, 'bvecs'),
+                                           self.buildName(outputImage, None, 'bvals'))
         # Proceed with fieldmap if provided
         if mag and phase and not self.__topupCorrection:
             # OutputImage is now used for fieldmap correction
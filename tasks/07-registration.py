@@ -1,4 +1,7 @@
 # -*- coding: utf-8 -*-
+import multiprocessing.pool
+import os
+
 from core.toad.generictask import GenericTask
 from lib.images import Images
 from lib import mriutil
@@ -32,28 +35,13 @@ class Registration(GenericTask):
             extraArgs += " -usesqform "
 
         freesurferToDWIMatrix = self.__freesurferToDWITransformation(b0, norm, extraArgs)
-        mriutil.applyResampleFsl(anat, b0, freesurferToDWIMatrix, self.buildName(anat, "resample"))
         mrtrixMatrix = self.__transformFslToMrtrixMatrix(anat, b0, freesurferToDWIMatrix)
 
-        """ Grey matter parcellation """
-        mriutil.applyRegistrationMrtrix(aparcAsegFile, mrtrixMatrix, self.buildName(aparcAsegFile, "register"))
-        mriutil.applyResampleFsl(aparcAsegFile, b0, freesurferToDWIMatrix, self.buildName(aparcAsegFile, "resample"), True)
-
-        """ White matter parcellation """
-        mriutil.applyRegistrationMrtrix(wmparcFile, mrtrixMatrix, self.buildName(wmparcFile, "register"))
-        mriutil.applyResampleFsl(wmparcFile, b0, freesurferToDWIMatrix, self.buildName(wmparcFile, "resample"), True)
-
-        lhRibbonRegister = mriutil.applyRegistrationMrtrix(lhRibbon, mrtrixMatrix, self.buildName(lhRibbon, "register"))
-        rhRibbonRegister = mriutil.applyRegistrationMrtrix(rhRibbon, mrtrixMatrix, self.buildName(rhRibbon, "register"))
-        tt5Register = mriutil.applyRegistrationMrtrix(tt5, mrtrixMatrix, self.buildName(tt5, "register"))
-        maskRegister = mriutil.applyRegistrationMrtrix(mask, mrtrixMatrix, self.buildName(mask, "register"))
-        normRegister = mriutil.applyRegistrationMrtrix(norm, mrtrixMatrix, self.buildName(norm, "register"))
-
-        mriutil.applyResampleFsl(lhRibbon, b0, freesurferToDWIMatrix, self.buildName(lhRibbon, "resample"),True)
-        mriutil.applyResampleFsl(rhRibbon, b0, freesurferToDWIMatrix, self.buildName(rhRibbon, "resample"),True)
-        mriutil.applyResampleFsl(tt5, b0, freesurferToDWIMatrix, self.buildName(tt5, "resample"),True)
-        mriutil.applyResampleFsl(mask, b0, freesurferToDWIMatrix, self.buildName(mask, "resample"),True)
-        mriutil.applyResampleFsl(norm, b0, freesurferToDWIMatrix, self.buildName(norm, "resample"),True)
+        jobs = [(anat, "trilinear", self.buildName(anat, "resample"))]
+        for image in [aparcAsegFile, wmparcFile, lhRibbon, rhRibbon, tt5, mask, norm]:
+            jobs.append((image, "register", self.buildName(image, "register")))
+            jobs.append((image, "nearestneighbour", self.buildName(image, "resample")))
+        self.__applyTransformations(jobs, b0, freesurferToDWIMatrix, mrtrixMatrix)
 
         #brodmannLRegister =  self.buildName(brodmannRegister, "left_hemisphere")
         #brodmannRRegister =  self.buildName(brodmannRegister, "right_hemisphere")
@@ -69,6 +57,51 @@ class Registration(GenericTask):
         return target
 
 
+    def __applyTransformations(self, jobs, reference, fslMatrix, mrtrixMatrix):
+        """Apply the freesurfer to dwi transformation to several images concurrently
+
+        Every job is a single threaded command, as many jobs as the number of threads
+        suggested by the load run at the same time
+
+        Args:
+            jobs: a list of tuples (image, interpolation, target). interpolation 'register' apply mrtrixMatrix
+                  and keep the grid of the image, 'trilinear' or 'nearestneighbour' resample the image into
+                  the grid of reference with flirt
+            reference: the image defining the grid of the resampled images
+            fslMatrix: the flirt transformation matrix
+            mrtrixMatrix: the same transformation converted for mrtrix
+
+        Returns:
+            the list of targets
+        """
+        def launch(job):
+            source, interpolation, target = job
+            if interpolation == "register":
+                cmd = "mrtransform {} -linear {} {} -nthreads 1 -quiet".format(source, mrtrixMatrix, target)
+            else:
+                cmd = "flirt -in {} -ref {} -applyxfm -init {} -out {} -interp {}"\
+                    .format(source, reference, fslMatrix, target, interpolation)
+            try:
+                self.launchCommand(cmd)
+            except (Exception, SystemExit), exception:
+                self.warning("Transformation of {} failed: {}".format(source, exception))
+
+        nbThreads = max(1, min(len(jobs), int(self.getNTreads())))
+        self.info("Apply the transformation to {} images using {} threads".format(len(jobs), nbThreads))
+        pool = multiprocessing.pool.ThreadPool(nbThreads)
+        try:
+            pool.map(launch, jobs)
+        finally:
+            pool.close()
+            pool.join()
+
+        targets = [target for source, interpolation, target in jobs]
+        missing = [target for target in targets if not os.path.exists(target)]
+        if missing:
+            raise RuntimeError("Transformations {} were not produced".format(", ".join(missing)))
+        return targets
+
+
     def __freesurferToDWITransformation(self, source, reference, extraArgs):
         dwiToFreesurferMatrix = "dwiToFreesurfer_transformation.mat"
         freesurferToDWIMatrix = "freesurferToDWI_transformation.mat"
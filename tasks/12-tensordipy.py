@@ -1,4 +1,7 @@
 # -*- coding: utf-8 -*-
+import itertools
+import multiprocessing
+import os
 import numpy
 import nibabel
 import dipy.core.gradients
@@ -8,6 +11,7 @@ import dipy.reconst.dti
 
 from core.toad.generictask import GenericTask
 from lib.images import Images
+from lib.mriutil import getSlabs
 
 
 __author__ = "Mathieu Desrosiers, Arnaud Bore"
@@ -28,7 +32,10 @@ class TensorDipy(GenericTask):
 
         fitMethod = self.get('fitMethod')  # Can be WLS, LS, NLLS or RT
 
-        self.__fit = self.__produceTensors(dwi, bValsFile, bVecsFile, mask, fitMethod)
+        if self.get('streaming'):
+            self.__fit = self.__produceTensorsBySlabs(dwi, bValsFile, bVecsFile, mask, fitMethod)
+        else:
+            self.__fit = self.__produceTensors(dwi, bValsFile, bVecsFile, mask, fitMethod)
 
     def __produceTensors(self, source, bValsFile, bVecsFile, mask, fitMethod):
         self.info("Starting tensors creation from dipy on {}".format(source))
@@ -42,7 +49,7 @@ class TensorDipy(GenericTask):
         self.info('WARNING: We need to flip the x direction due to MRtrix new way to extract bvecs')
         gradientTable.bvecs = gradientTable.bvecs * numpy.array([-1,1,1])
 
-        if fitMethod.lower() is ('restore' or 'rt'):
+        if fitMethod.lower() in ('restore', 'rt'):
             import dipy.denoise.noise_estimate as noise_estimate
             sigma = noise_estimate.estimate_sigma(dwiData)
             model = dipy.reconst.dti.TensorModel(gradientTable, fit_method=fitMethod, sigma=sigma)
@@ -71,15 +78,15 @@ class TensorDipy(GenericTask):
                                          dwiImage.get_affine()),
                                             self.buildName(source, "md"))
 
-        nibabel.save(nibabel.Nifti1Image(fit.evecs[0].astype(numpy.float32),
+        nibabel.save(nibabel.Nifti1Image(fit.evecs[..., 0].astype(numpy.float32),
                                          dwiImage.get_affine()),
                                              self.buildName(source, "v1"))
 
-        nibabel.save(nibabel.Nifti1Image(fit.evecs[1].astype(numpy.float32),
+        nibabel.save(nibabel.Nifti1Image(fit.evecs[..., 1].astype(numpy.float32),
                                          dwiImage.get_affine()),
                                             self.buildName(source, "v2"))
 
-        nibabel.save(nibabel.Nifti1Image(fit.evecs[2].astype(numpy.float32),
+        nibabel.save(nibabel.Nifti1Image(fit.evecs[..., 2].astype(numpy.float32),
                                          dwiImage.get_affine()),
                                             self.buildName(source, "v3"))
 
@@ -90,6 +97,161 @@ class TensorDipy(GenericTask):
                                             self.buildName(source, "tensor_rgb"))
         return fit
 
+    def __estimateSigma(self, source, maskData):
+        """Estimate the sigma of the noise of every volume of the masked diffusion image for RESTORE
+
+        The volumes are read one at a time through the nibabel proxy, the result is the same
+        as estimate_sigma on the whole masked image
+
+        Args:
+            source: an uncompressed diffusion image
+            maskData: the brain mask
+
+        Returns:
+            a numpy array of sigma, one for every volume
+
+        """
+        import dipy.denoise.noise_estimate as noise_estimate
+        dwiData = nibabel.load(source).dataobj
+        sigma = numpy.zeros(dwiData.shape[3])
+        for index in range(dwiData.shape[3]):
+            volume = dipy.segment.mask.applymask(numpy.asarray(dwiData[..., index]), maskData)
+            sigma[index] = noise_estimate.estimate_sigma(volume[..., numpy.newaxis])[0]
+        return sigma
+
+    def __produceTensorsBySlabs(self, source, bValsFile, bVecsFile, mask, fitMethod):
+        """Fit the tensors on the masked voxels, slab by slab along the z axis, across a pool of processes
+
+        Every process read its own slab of the diffusion image and fit its masked voxels by blocks
+        of block_size voxels. The parameters of the fit are written into an array allocated once,
+        then every map is computed slab by slab into its own array. Those arrays are memory mapped
+        into the working directory if memory_map is True
+
+        Args:
+            source: the upsampled diffusion image
+            bValsFile: the gradient value bvals encoding file
+            bVecsFile: the gradient vector bvecs encoding file
+            mask: the brain mask filename
+            fitMethod: the dipy fit method
+
+        Returns:
+            a dipy TensorFit of the whole volume
+
+        """
+        self.info("Starting tensors creation from dipy on {} by slabs".format(source))
+        dwiImage = nibabel.load(source)
+        maskData = nibabel.load(mask).get_data()
+        affine = dwiImage.get_affine()
+        shape = dwiImage.shape[:3]
+
+        gradientTable = dipy.core.gradients.gradient_table(numpy.loadtxt(bValsFile), numpy.loadtxt(bVecsFile))
+        self.info('WARNING: We need to flip the x direction due to MRtrix new way to extract bvecs')
+        gradientTable.bvecs = gradientTable.bvecs * numpy.array([-1,1,1])
+
+        if source.endswith('.gz'):
+            dwi = self.uncompressImage(source)
+        else:
+            dwi = source
+
+        if fitMethod.lower() in ('restore', 'rt'):
+            sigma = self.__estimateSigma(dwi, maskData)
+            model = dipy.reconst.dti.TensorModel(gradientTable, fit_method=fitMethod, sigma=sigma)
+        else:
+            model = dipy.reconst.dti.TensorModel(gradientTable, fit_method=fitMethod)
+
+        temporaries = []
+        params = self.__allocate(shape + (12,), numpy.float32, 'params', temporaries)
+
+        slabs = [(start, stop) for start, stop in getSlabs(shape[2], int(self.get('slab_size')))
+                 if maskData[:, :, start:stop].any()]
+        nbProcesses = min(int(self.getNTreads()), max(1, len(slabs)))
+        self.info('Fitting tensors on {} slabs of {} slices using {} processes'
+                  .format(len(slabs), self.get('slab_size'), nbProcesses))
+
+        jobs = [(model, dwi, mask, start, stop, int(self.get('block_size'))) for start, stop in slabs]
+        pool = multiprocessing.Pool(nbProcesses) if nbProcesses > 1 else None
+        try:
+            results = pool.imap_unordered(fitTensorSlab, jobs) if pool else itertools.imap(fitTensorSlab, jobs)
+            for start, stop, values in results:
+                slab = params[:, :, start:stop]
+                slab[maskData[:, :, start:stop] > 0] = values
+            if pool:
+                pool.close()
+        finally:
+            if pool:
+                pool.terminate()
+                pool.join()
+
+        if dwi != source:
+            os.remove(dwi)
+
+        maps = [("tensor", shape + (6,), numpy.float32),
+                ("fa", shape, numpy.float32),
+                ("ad", shape, numpy.float32),
+                ("rd", shape, numpy.float32),
+                ("md", shape, numpy.float32),
+                ("v1", shape + (3,), numpy.float32),
+                ("v2", shape + (3,), numpy.float32),
+                ("v3", shape + (3,), numpy.float32),
+                ("tensor_rgb", shape + (3,), numpy.uint8)]
+        outputs = {}
+        for postfix, mapShape, dtype in maps:
+            outputs[postfix] = self.__allocate(mapShape, dtype, postfix, temporaries)
+
+        correctOrder = [0, 1, 3, 2, 4, 5]
+        for start, stop in slabs:
+            fit = dipy.reconst.dti.TensorFit(model, params[:, :, start:stop])
+            outputs["tensor"][:, :, start:stop] = dipy.reconst.dti.lower_triangular(fit.quadratic_form)[..., correctOrder]
+            outputs["fa"][:, :, start:stop] = fit.fa
+            outputs["ad"][:, :, start:stop] = fit.ad
+            outputs["rd"][:, :, start:stop] = fit.rd
+            outputs["md"][:, :, start:stop] = fit.md
+            for index in range(3):
+                outputs["v{}".format(index + 1)][:, :, start:stop] = fit.evecs[..., index]
+            rgb = dipy.reconst.dti.color_fa(numpy.clip(fit.fa, 0, 1), fit.evecs)
+            outputs["tensor_rgb"][:, :, start:stop] = numpy.array(255 * rgb, 'uint8')
+
+        for postfix, mapShape, dtype in maps:
+            nibabel.save(nibabel.Nifti1Image(outputs[postfix], affine), self.buildName(source, postfix))
+        del outputs
+
+        #a memory map stay valid once its file is removed, the qa still have access to the parameters
+        for temporary in temporaries:
+            os.remove(temporary)
+        return dipy.reconst.dti.TensorFit(model, params)
+
+    def __allocate(self, shape, dtype, name, temporaries):
+        """Allocate an array filled with zeros, memory mapped into the working directory if memory_map is True
+
+        Args:
+            shape: the shape of the array
+            dtype: the type of the elements of the array
+            name: a name use to build the memory map filename
+            temporaries: a list where the memory map filename is added
+
+        Returns:
+            a numpy array or memmap
+        """
+        if not self.get('memory_map'):
+            return numpy.zeros(shape, dtype=dtype)
+        filename = os.path.join(self.workingDir, "{}.mmap".format(name))
+        temporaries.append(filename)
+        return numpy.memmap(filename, dtype=dtype, mode='w+', shape=shape)
+
+    def __loadFit(self, source):
+        """Rebuild the tensors fit from the tensor image, when the qa is rendered by another process
+
+        Args:
+            source: the tensor image, lower triangular in mrtrix order
+
+        Returns:
+            a dipy TensorFit without model, only evals and evecs are available
+        """
+        tensors = nibabel.load(source).get_data()[..., [0, 1, 3, 2, 4, 5]]
+        evals, evecs = dipy.reconst.dti.decompose_tensor(dipy.reconst.dti.from_lower_triangular(tensors))
+        params = numpy.concatenate((evals, evecs.reshape(evals.shape[:3] + (9,))), axis=-1)
+        return dipy.reconst.dti.TensorFit(None, params)
+
     def isIgnore(self):
         return self.get("ignore")
 
@@ -128,6 +290,8 @@ class TensorDipy(GenericTask):
         #  Produce tensor ellipsoids image
         dwi = self.getUpsamplingImage('dwi', 'upsample')
         cc = self.getMaskingImage('aparc_aseg', ['253','mask'])
+        if self.__fit is None:
+            self.__fit = self.__loadFit(self.getImage('dwi', 'tensor'))
         ellipsoidsQa = self.plotReconstruction(
                 self.__fit, mask, cc, 'tensor', dwi)
         qaImages.append((
@@ -152,3 +316,24 @@ class TensorDipy(GenericTask):
                 qaImages.append((imageQa, description))
 
         return qaImages
+
+
+def fitTensorSlab(arguments):
+    """Fit a tensor model on the masked voxels of a slab of axial slices, TensorDipy use it across a pool of processes
+
+    Args:
+        arguments: a tuple (model, dwi filename, mask filename, first slice, last slice, number of voxels per block)
+
+    Returns:
+        the first and last slices of the slab and the parameters of the fit for each masked voxels of the slab
+
+    """
+    model, source, mask, start, stop, blockSize = arguments
+    maskData = nibabel.load(mask).get_data()[:, :, start:stop] > 0
+    voxels = numpy.asarray(nibabel.load(source).dataobj[:, :, start:stop])[maskData]
+
+    values = numpy.zeros((voxels.shape[0], 12), dtype=numpy.float32)
+    blockSize = max(1, blockSize)
+    for first in range(0, voxels.shape[0], blockSize):
+        values[first:first + blockSize] = model.fit(voxels[first:first + blockSize]).model_params
+    return start, stop, values
@@ -1,4 +1,7 @@
 # -*- coding: utf-8 -*-
+import itertools
+import multiprocessing
+import os
 import numpy
 import nibabel
 import dipy
@@ -7,7 +10,7 @@ import dipy.reconst.csdeconv
 
 from core.toad.generictask import GenericTask
 from lib.images import Images
-from lib.mriutil import getlmax
+from lib.mriutil import getlmax, computePeaksMetrics, getSlabs
 
 __author__ = "Mathieu Desrosiers"
 __copyright__ = "Copyright (C) 2014, TOAD"
@@ -43,70 +46,57 @@ class HardiDipy(GenericTask):
 
         dwiImage = nibabel.load(source)
         maskImage = nibabel.load(mask)
-
-        dwiData  = dwiImage.get_data()
         maskData = maskImage.get_data()
-        dwiData = dipy.segment.mask.applymask(dwiData, maskData)
 
-        gradientTable = dipy.core.gradients.gradient_table(
-                numpy.loadtxt(bValsFile), numpy.loadtxt(bVecsFile)
-                )
+        gradientTable = self.__createGradientTable(bValsFile, bVecsFile)
         self.info('WARNING: We need to flip the x direction due to MRtrix new way to extract bvecs')
-        gradientTable.gradients = gradientTable.gradients * numpy.array([-1,1,1])
 
         sphere = dipy.data.get_sphere(self.get("triangulated_spheres"))
 
-        response, ratio = dipy.reconst.csdeconv.auto_response(
-                gradientTable, dwiData, roi_radius=10, fa_thr=0.7
-                )
-        csdModel = dipy.reconst.csdeconv.ConstrainedSphericalDeconvModel(
-                gradientTable, response
+        if self.get('chunked'):
+            csdModel, csdPeaks = self.__fitSlabs(source, gradientTable, sphere, maskData)
+            dwiData = None
+        else:
+            dwiData = dwiImage.get_data()
+            dwiData = dipy.segment.mask.applymask(dwiData, maskData)
+
+            csdModel = self.__createModel(gradientTable, dwiData, maskData)
+            self.info('Start fODF computation')
+
+            csdPeaks = dipy.direction.peaks_from_model(
+                model=csdModel,
+                data=dwiData,
+                sphere=sphere,
+                relative_peak_threshold=.5,
+                min_separation_angle=25,
+                mask=maskData,
+                return_sh=True,
+                return_odf=False,
+                normalize_peaks=True,
+                npeaks=5,
+                parallel=False,
                 )
-        self.info('Start fODF computation')
-
-        csdPeaks = dipy.direction.peaks_from_model(
-            model=csdModel,
-            data=dwiData,
-            sphere=sphere,
-            relative_peak_threshold=.5,
-            min_separation_angle=25,
-            mask=maskData,
-            return_sh=True,
-            return_odf=False,
-            normalize_peaks=True,
-            npeaks=5,
-            parallel=False,
-            #nbr_processes=int(self.getNTreads()),
-            )
 
         #CSD
         target = self.buildName(source, 'csd')
         csdCoeff = csdPeaks.shm_coeff
         csdCoeffImage = nibabel.Nifti1Image(
-                csdCoeff.astype(numpy.double), dwiImage.get_affine()
+                csdCoeff.astype(numpy.float32, copy=False), dwiImage.get_affine()
                 )
         nibabel.save(csdCoeffImage, target)
 
 
         #GFA
         target = self.buildName(source,'gfa')
-        gfa = csdPeaks.gfa
-        gfa[numpy.isnan(gfa)] = 0
-        csdCoeffImage = nibabel.Nifti1Image(
-                gfa.astype(numpy.float32), dwiImage.get_affine()
-                )
+        gfa = numpy.nan_to_num(csdPeaks.gfa).astype(numpy.float32)
+        csdCoeffImage = nibabel.Nifti1Image(gfa, dwiImage.get_affine())
         nibabel.save(csdCoeffImage, target)
 
 
         #NUFO
         target = self.buildName(source, 'nufo')
-        nuDirs = gfa
-        for x in range(gfa.shape[0]):
-            for y in range(gfa.shape[1]):
-                for z in range(gfa.shape[2]):
-                    nuDirs[x,y,z] = numpy.count_nonzero(csdPeaks.peak_dirs[x,y,z]!=0)/3
-
-        numDirsImage = nibabel.Nifti1Image(nuDirs.astype(numpy.float32), dwiImage.get_affine())
+        nuDirs = computePeaksMetrics(csdPeaks.peak_dirs)['nufo']
+        numDirsImage = nibabel.Nifti1Image(nuDirs, dwiImage.get_affine())
         nibabel.save(numDirsImage, target)
 
         #Data for qa
@@ -115,6 +105,103 @@ class HardiDipy(GenericTask):
         self.__csdPeaks = csdPeaks
 
 
+    def __fitSlabs(self, source, gradientTable, sphere, maskData):
+        """Fit the csd model slab by slab along the z axis across a pool of processes
+
+        The diffusion image is uncompressed into the working directory so every process
+        could read its own slab without decompressing the whole image. The outputs are allocated once as
+        float32 and filled as slabs are completed, so only the slabs currently fitted are hold in memory
+
+        Args:
+            source: the upsampled diffusion image
+            gradientTable: the dipy gradient table of the diffusion image
+            sphere: the sphere use to extract the peaks
+            maskData: the brain mask
+
+        Returns:
+            the csd model and a dipy PeaksAndMetrics holding csd, gfa and peaks of the whole volume
+
+        """
+        if source.endswith('.gz'):
+            dwi = self.uncompressImage(source)
+        else:
+            dwi = source
+        dwiData = nibabel.load(dwi).dataobj
+        csdModel = self.__createModel(gradientTable, dwiData, maskData)
+
+        shape = dwiData.shape[:3]
+        slabs = [(start, stop) for start, stop in getSlabs(shape[2], int(self.get('slab_size')))
+                 if maskData[:, :, start:stop].any()]
+        nbProcesses = min(int(self.getNTreads()), max(1, len(slabs)))
+        self.info('Start fODF computation on {} slabs of {} slices using {} processes'
+                  .format(len(slabs), self.get('slab_size'), nbProcesses))
+
+        csdPeaks = dipy.direction.peaks.PeaksAndMetrics()
+        csdPeaks.shm_coeff = None
+        csdPeaks.gfa = numpy.zeros(shape, dtype=numpy.float32)
+        csdPeaks.peak_dirs = numpy.zeros(shape + (5, 3), dtype=numpy.float32)
+        csdPeaks.peak_values = numpy.zeros(shape + (5,), dtype=numpy.float32)
+
+        jobs = [(csdModel, sphere, dwi, maskData[:, :, start:stop], start, stop) for start, stop in slabs]
+        pool = multiprocessing.Pool(nbProcesses) if nbProcesses > 1 else None
+        try:
+            results = pool.imap_unordered(fitSlab, jobs) if pool else itertools.imap(fitSlab, jobs)
+            for start, shmCoeff, gfa, peakDirs, peakValues in results:
+                stop = start + gfa.shape[2]
+                if csdPeaks.shm_coeff is None:
+                    csdPeaks.shm_coeff = numpy.zeros(shape + shmCoeff.shape[-1:], dtype=numpy.float32)
+                csdPeaks.shm_coeff[:, :, start:stop] = shmCoeff
+                csdPeaks.gfa[:, :, start:stop] = gfa
+                csdPeaks.peak_dirs[:, :, start:stop] = peakDirs
+                csdPeaks.peak_values[:, :, start:stop] = peakValues
+            if pool:
+                pool.close()
+        finally:
+            if pool:
+                pool.terminate()
+                pool.join()
+
+        if dwi != source:
+            os.remove(dwi)
+        return csdModel, csdPeaks
+
+
+    def __createGradientTable(self, bValsFile, bVecsFile):
+        """Create the dipy gradient table, the x direction is flipped due to MRtrix new way to extract bvecs
+
+        """
+        gradientTable = dipy.core.gradients.gradient_table(
+                numpy.loadtxt(bValsFile), numpy.loadtxt(bVecsFile)
+                )
+        gradientTable.gradients = gradientTable.gradients * numpy.array([-1,1,1])
+        return gradientTable
+
+
+    def __createModel(self, gradientTable, dwiData, maskData):
+        """Create the csd model with a response estimated at the center of the volume
+
+        Args:
+            gradientTable: the dipy gradient table of the diffusion image
+            dwiData: the diffusion data, an array or a nibabel array proxy
+            maskData: the brain mask
+
+        Returns:
+            a dipy ConstrainedSphericalDeconvModel
+
+        """
+        #auto_response look only at the center of the volume, use the same region
+        center = numpy.array(dwiData.shape[:3]) // 2
+        roi = tuple(slice(max(0, value - 10), value + 10) for value in center)
+        response, ratio = dipy.reconst.csdeconv.auto_response(
+                gradientTable,
+                dipy.segment.mask.applymask(numpy.asarray(dwiData[roi]), maskData[roi]),
+                roi_radius=10, fa_thr=0.7
+                )
+        return dipy.reconst.csdeconv.ConstrainedSphericalDeconvModel(
+                gradientTable, response
+                )
+
+
     def isIgnore(self):
         return self.get("ignore")
 
@@ -145,14 +232,25 @@ class HardiDipy(GenericTask):
         mask = self.getRegistrationImage('mask', 'resample')
 
         #Produce hardi odfs image
+        if self.__dwiData is None:
+            self.__dwiData = dipy.segment.mask.applymask(
+                    nibabel.load(dwi).get_data(), nibabel.load(mask).get_data())
+        if self.__csdModel is None:
+            #the qa is rendered by another process, rebuild the model
+            gradientTable = self.__createGradientTable(
+                    self.getUpsamplingImage('grad', None, 'bvals'),
+                    self.getUpsamplingImage('grad', None, 'bvecs'))
+            self.__csdModel = self.__createModel(
+                    gradientTable, self.__dwiData, nibabel.load(mask).get_data())
         data = {'dwiData':self.__dwiData, 'csdModel':self.__csdModel}
         odfsQa = self.plotReconstruction(data, mask, cc, 'hardi_odf', dwi)
         qaImages.append((
             odfsQa, 'Coronal slice of hardi CSD ODFs in the Corpus Callosum'))
 
         #Produce hardi peaks image
+        peaks = self.__csdPeaks if self.__csdPeaks is not None else data
         peaksQa = self.plotReconstruction(
-                self.__csdPeaks, mask, cc, 'hardi_peak', dwi)
+                peaks, mask, cc, 'hardi_peak', dwi)
         qaImages.append((
             peaksQa, "Coronal slice of hardi CSD Peaks in the Corpus Callosum"))
 
@@ -171,3 +269,34 @@ class HardiDipy(GenericTask):
                 qaImages.append((imageQa, description))
 
         return qaImages
+
+
+def fitSlab(arguments):
+    """Fit a csd model on a slab of axial slices, HardiDipy use it across a pool of processes
+
+    Args:
+        arguments: a tuple (csdModel, sphere, uncompressed dwi filename, mask of the slab, first slice, last slice)
+
+    Returns:
+        the first slice of the slab, the sh coefficients, the gfa, the peaks directions and values of the slab
+
+    """
+    csdModel, sphere, source, maskData, start, stop = arguments
+    dwiData = numpy.asarray(nibabel.load(source).dataobj[:, :, start:stop])
+    dwiData = dipy.segment.mask.applymask(dwiData, maskData)
+
+    csdPeaks = dipy.direction.peaks_from_model(
+        model=csdModel,
+        data=dwiData,
+        sphere=sphere,
+        relative_peak_threshold=.5,
+        min_separation_angle=25,
+        mask=maskData,
+        return_sh=True,
+        return_odf=False,
+        normalize_peaks=True,
+        npeaks=5,
+        parallel=False,
+        )
+    return (start, csdPeaks.shm_coeff.astype(numpy.float32), numpy.nan_to_num(csdPeaks.gfa),
+            csdPeaks.peak_dirs, csdPeaks.peak_values)
@@ -1,7 +1,10 @@
 # -*- coding: utf-8 -*-
-import numpy
+import multiprocessing.pool
+import re
+import shutil
 import os
 from core.toad.generictask import GenericTask
+from lib import connectome
 from lib import mriutil
 from lib.images import Images
 
@@ -22,8 +25,12 @@ class TractographyMrtrix(GenericTask):
         self.__tckgenRoiTrk = None
         self.__tcksiftRoiTrk = None
         self.__nbDirections = None
+        self.__resubmitted = False
+        #the working directory is cleaned by __cleanupAttempt, so tckgen chunks survive a resubmission
+        self.setCleanupBeforeImplement(False)
 
     def implement(self):
+        self.__cleanupAttempt()
 
         tt5 = self.getRegistrationImage("tt5", "register")
         seed_gmwmi = self.getMaskingImage("tt5", ["register", "5tt2gmwmi"])
@@ -53,12 +60,7 @@ class TractographyMrtrix(GenericTask):
                 tckDet = self.__tckgenTensor(
                         dwi, self.buildName(dwi, 'tensor_det', 'tck'),
                         mask, tt5, seed_gmwmi, bFile, 'Tensor_Det')
-                tckDetTrk = mriutil.tck2trk(
-                        tckDet, norm, self.buildName(tckDet, None, 'trk'))
-                tckDetRoi = self.__tckedit(
-                        tckDet, mask253, self.buildName(tckDet, 'roi', 'tck'))
-                tckDetRoiTrk = mriutil.tck2trk(
-                        tckDetRoi, norm, self.buildName(tckDetRoi, None, 'trk'))
+                tckDetTrk, tckDetRoiTrk = self.__tck2trk(tckDet, norm, mask253)
                 self.__tckDetRoiTrk = tckDetRoiTrk
 
                 self.set('algorithm', 'Determinist')  # Set Method tractography Det
@@ -67,12 +69,7 @@ class TractographyMrtrix(GenericTask):
                 tckProb = self.__tckgenTensor(
                         dwi, self.buildName(dwi, 'tensor_prob', 'tck'),
                         mask, tt5, seed_gmwmi, bFile, 'Tensor_Prob')
-                tckProbTrk = mriutil.tck2trk(
-                        tckProb, norm , self.buildName(tckProb, None, 'trk'))
-                tckProbRoi = self.__tckedit(
-                        tckProb, mask253, self.buildName(tckProb, 'roi', 'tck'))
-                tckProbRoiTrk = mriutil.tck2trk(
-                        tckProbRoi, norm , self.buildName(tckProbRoi, None, 'trk'))
+                tckProbTrk, tckProbRoiTrk = self.__tck2trk(tckProb, norm, mask253)
                 self.__tckProbRoiTrk = tckProbRoiTrk
 
                 self.set('algorithm', 'Probabilist')  # Set Method tractography Prob
@@ -81,12 +78,7 @@ class TractographyMrtrix(GenericTask):
             csd =  self.getHardimrtrixImage('dwi', 'csd')
             hardiTck = self.__tckgenHardi(
                     csd, self.buildName(csd, 'hardi_prob', 'tck'), tt5)
-            hardiTrk = mriutil.tck2trk(
-                    hardiTck, norm, self.buildName(hardiTck, None, 'trk'))
-            hardiTckRoi = self.__tckedit(
-                    hardiTck, mask253, self.buildName(hardiTck, 'roi', 'tck'))
-            tckgenRoiTrk = mriutil.tck2trk(
-                    hardiTckRoi, norm , self.buildName(hardiTckRoi, None, 'trk'))
+            hardiTrk, tckgenRoiTrk = self.__tck2trk(hardiTck, norm, mask253)
             self.__tckgenRoiTrk = tckgenRoiTrk
 
             self.set('methodReconstruction', 'hardi')
@@ -94,34 +86,37 @@ class TractographyMrtrix(GenericTask):
 
             if self.get('sift'):
                 tcksift = self.__tcksift(hardiTck, csd)
-                tcksiftTrk = mriutil.tck2trk(
-                    tcksift, norm, self.buildName(tcksift, None, 'trk'))
-                tcksiftRoi = self.__tckedit(
-                    tcksift, mask253, self.buildName(tcksift, 'roi', 'tck'))
-                tcksiftRoiTrk = mriutil.tck2trk(
-                    tcksiftRoi, norm , self.buildName(tcksiftRoi, None, 'trk'))
+                tcksiftTrk, tcksiftRoiTrk = self.__tck2trk(tcksift, norm, mask253)
                 self.__tcksiftRoiTrk = tcksiftRoiTrk
 
-    def __tckedit(self, source, roi, target, downsample=2):
-        """ perform various editing operations on track files.
+    def __tck2trk(self, source, anatomy, roi, downsample=2):
+        """ convert a tractogram into trackvis format, with the streamlines crossing a region of interest
+
+        The whole tractogram and the streamlines crossing roi, downsampled, are written within a
+        single pass over the source. When roi_masking is True, the start, stop and exclude masks
+        produced by masking also apply to the streamlines crossing roi
 
         Args:
-            source: the input track file(s)
-            roi:    specify an inclusion region of interest, as either a binary mask image, or as a sphere
-                    using 4 comma-separared values (x,y,z,radius)
-            target: the output track file
-            downsample: increase the density of points along the length of the streamline by some factor
+            source: the input track file
+            anatomy: a high resolution image
+            roi: a binary mask image, a streamline is kept when one of its points is inside
+            downsample: keep one point every downsample points of the streamlines crossing roi
 
         Returns:
-            the output track file
+            the trackvis files of the whole tractogram and of the streamlines crossing roi
         """
-        self.info("Starting tckedit creation from mrtrix on {}".format(source))
-        tmp0 = self.buildName(source, "tmp0", "tck")
-        tmp1 = self.buildName(source, "tmp1", "tck")
-        self.launchCommand(mriutil.tckedit(source, roi, tmp0, False))
-        self.launchCommand(mriutil.tckresample(tmp0, downsample, tmp1, False))
-        os.remove(tmp0)
-        return self.rename(tmp1, target)
+        self.info("Starting tck2trk conversion on {}".format(source))
+        target = self.buildName(source, None, 'trk')
+        roiTarget = self.buildName(self.buildName(source, 'roi', 'tck'), None, 'trk')
+        masks = {}
+        if self.get('roi_masking'):
+            for operand in ['start', 'stop', 'exclude']:
+                masks[operand] = self.getMaskingImage('aparc_aseg', ['resample', operand, 'extract', 'mask'])
+        roiFilter = mriutil.StreamlinesFilter(
+                include=roi, exclude=masks.get('exclude'),
+                start=masks.get('start'), stop=masks.get('stop'), downsample=downsample)
+        mriutil.tck2trk(source, anatomy, target, variants=[(roiTarget, roiFilter)])
+        return target, roiTarget
 
     def __tckgenTensor(self, source, target, mask=None, act=None , seed_gmwmi=None, bFile=None, algorithm="iFOD2"):
         """ perform streamlines tractography.
@@ -148,17 +143,18 @@ class TractographyMrtrix(GenericTask):
 
         """
         self.info("Starting tckgen creation from mrtrix on {}".format(source))
-        tmp = self.buildName(source, "tmp", "tck")
-        cmd = "tckgen {} {} -mask {} -act {} -seed_gmwmi {} \
-                -number {} -algorithm {} -downsample {} -nthreads {} -quiet"\
-                    .format(source, tmp, mask,  act, seed_gmwmi,
-                            self.get('numbertracks'), algorithm, self.get('downsample'), self.getNTreadsMrtrix())
 
-        if bFile is not None:
-            cmd += " -grad {}".format(bFile)
+        def command(output, number, nthreads):
+            cmd = "tckgen {} {} -mask {} -act {} -seed_gmwmi {} \
+                    -number {} -algorithm {} -downsample {} -nthreads {} -quiet"\
+                        .format(source, output, mask,  act, seed_gmwmi,
+                                number, algorithm, self.get('downsample'), nthreads)
 
-        self.launchCommand(cmd)
-        return self.rename(tmp, target)
+            if bFile is not None:
+                cmd += " -grad {}".format(bFile)
+            return cmd
+
+        return self.__launchTckgen(command, source, target)
 
     def __tckgenHardi(self, source, target, act=None, bFile=None, algorithm="iFOD2"):
         """
@@ -185,23 +181,104 @@ class TractographyMrtrix(GenericTask):
         """
 
         self.info("Starting tckgen creation from mrtrix on {}".format(source))
-        tmp = self.buildName(source, "tmp", "tck")
-        cmd = "tckgen {} {} -act {}".format(source, tmp, act)
-        cmd += " -seed_dynamic {} -step {}".format(source, self.get('step'))
-        cmd += " -maxlength {}".format(self.get('maxlength'))
-        cmd += " -number {}".format(self.get('numbertracks'))
-        cmd += " -algorithm {}".format(algorithm)
-        cmd += " -downsample {}".format(self.get('downsample'))
-        cmd += " -nthreads {} -quiet".format(self.getNTreadsMrtrix())
 
-        if self.get('backtrack'):
-            cmd += ' -backtrack'
+        def command(output, number, nthreads):
+            cmd = "tckgen {} {} -act {}".format(source, output, act)
+            cmd += " -seed_dynamic {} -step {}".format(source, self.get('step'))
+            cmd += " -maxlength {}".format(self.get('maxlength'))
+            cmd += " -number {}".format(number)
+            cmd += " -algorithm {}".format(algorithm)
+            cmd += " -downsample {}".format(self.get('downsample'))
+            cmd += " -nthreads {} -quiet".format(nthreads)
 
-        if bFile is not None:
-            cmd += " -grad {}".format(bFile)
+            if self.get('backtrack'):
+                cmd += ' -backtrack'
 
-        self.launchCommand(cmd)
-        return self.rename(tmp, target)
+            if bFile is not None:
+                cmd += " -grad {}".format(bFile)
+            return cmd
+
+        return self.__launchTckgen(command, source, target)
+
+
+    def __cleanupAttempt(self):
+        """Remove the files produced by a previous attempt of this task
+
+        The tckgen chunks are kept when run resubmit the task, so only the missing ones are launched.
+        They are removed at the first attempt, they may come from another execution with different inputs
+
+        """
+        for name in os.listdir(self.workingDir):
+            path = os.path.join(self.workingDir, name)
+            if os.path.islink(path) or (self.__resubmitted and re.search(r'_chunk\d+\.tck$', name)):
+                continue
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+        self.__resubmitted = True
+
+
+    def __launchTckgen(self, command, source, target):
+        """ launch tckgen, split into independent chunks when tckgen_chunks is greater than 1
+
+        Every chunk generate its share of the streamlines with its own random seed, the chunks
+        run concurrently and their outputs are concatenated into target. A chunk completed is
+        kept into the working directory, so when a chunk fail the task is resubmitted by run and
+        only the missing chunks are launched, see __cleanupAttempt.
+
+        Args:
+            command: a function that receive the output file, the number of streamlines and
+                     the number of threads and return the tckgen command line
+            source: the image containing the source data
+            target: the output file containing the tracks generated
+
+        Returns:
+            The resulting streamlines tractography filename generated
+        """
+        nbChunks = int(self.get('tckgen_chunks'))
+        if nbChunks < 2:
+            tmp = self.buildName(source, "tmp", "tck")
+            self.launchCommand(command(tmp, self.get('numbertracks'), self.getNTreadsMrtrix()))
+            return self.rename(tmp, target)
+
+        numberTracks = int(self.get('numbertracks'))
+        nbThreads = max(1, int(self.getNTreadsMrtrix()) / nbChunks)
+        chunks = []
+        for index in range(nbChunks):
+            number = numberTracks / nbChunks + (1 if index < numberTracks % nbChunks else 0)
+            chunks.append((index, number, self.buildName(target, "chunk{}".format(index), "tck")))
+
+        def launch(chunk):
+            index, number, output = chunk
+            if os.path.exists(output):
+                self.info("Chunk {} already produced, skip it".format(output))
+                return
+            tmp = self.buildName(output, "tmp", "tck")
+            try:
+                self.launchCommand(command(tmp, number, nbThreads),
+                                   env={'MRTRIX_RNG_SEED': str(index + 1)})
+                self.rename(tmp, output)
+            except (Exception, SystemExit), exception:
+                self.warning("Chunk {} failed: {}".format(output, exception))
+
+        self.info("Launch tckgen as {} chunks of {} threads".format(nbChunks, nbThreads))
+        pool = multiprocessing.pool.ThreadPool(nbChunks)
+        try:
+            pool.map(launch, chunks)
+        finally:
+            pool.close()
+            pool.join()
+
+        outputs = [chunk[2] for chunk in chunks]
+        missing = [output for output in outputs if not os.path.exists(output)]
+        if missing:
+            raise RuntimeError("tckgen chunks {} were not produced".format(", ".join(missing)))
+
+        mriutil.concatenate_mrtrix_tracks(outputs, target)
+        for output in outputs:
+            os.remove(output)
+        return target
 
 
     def __tcksift(self, source, csd):
@@ -246,8 +323,8 @@ class TractographyMrtrix(GenericTask):
             self.info('Atlas file: {}'.format(atlas))
             self.info('Lut file location: {}'.format(lutFile))
 
-        connectome = self.__tck2connectome(source, atlas, self.buildName(source, [ prefix , 'connectome'], 'csv'))
-        connectomeNormalize = self.__normalizeConnectome(connectome, self.buildName(connectome, 'normalize', 'csv'))
+        connectomeRaw = self.__tck2connectome(source, atlas, self.buildName(source, [ prefix , 'connectome'], 'csv'))
+        connectomeNormalize = self.__normalizeConnectome(connectomeRaw, self.buildName(connectomeRaw, 'normalize', 'csv'))
         pngImage = mriutil.plotConnectome(connectomeNormalize, self.buildName(connectomeNormalize, None, "png"), lutFile)
         return pngImage
 
@@ -282,19 +359,10 @@ class TractographyMrtrix(GenericTask):
             target: the output .csv file containing normalize results
 
         Returns:
-            The resulting .cvs file name
+            The resulting .npz file name, a binary copy of target with the graph summaries
 
         """
-        matrix = numpy.genfromtxt(source, delimiter=' ')
-        matrix = numpy.add(matrix, numpy.matrix.transpose(matrix))
-
-        with numpy.errstate(invalid='ignore'):
-            for index, row in enumerate(matrix):
-                    matrix[index] = numpy.divide(row, row.sum())
-
-        matrix[numpy.isnan(matrix)] = 0.0
-        numpy.savetxt(target, matrix, delimiter=' ', fmt='%0.4f')
-        return target
+        return connectome.save(connectome.normalize(connectome.load(source)), target)
 
 
     def isIgnore(self):
@@ -369,6 +437,10 @@ class TractographyMrtrix(GenericTask):
         norm = self.getRegistrationImage("norm", "resample")
         mask253 = self.getMaskingImage('aparc_aseg',['253','mask'])
 
+        #the qa is rendered by another process, find back the streamlines
+        if self.__nbDirections is None:
+            self.__findRoiTrk()
+
         #images production
         if self.__nbDirections <= 45 and not self.get('forceHardi'):
             tags = (
@@ -391,3 +463,23 @@ class TractographyMrtrix(GenericTask):
                 qaImages.append((imageQa, description))
 
         return qaImages
+
+
+    def __findRoiTrk(self):
+        """Find the streamlines crossing area 253 produced by implement, following the same names
+
+        """
+        dwi = self.getUpsamplingImage('dwi', 'upsample')
+        self.__nbDirections = mriutil.getNbDirectionsFromDWI(dwi)
+
+        def roiTrk(tck):
+            trk = self.buildName(self.buildName(tck, 'roi', 'tck'), None, 'trk')
+            return trk if os.path.exists(trk) else None
+
+        self.__tckDetRoiTrk = roiTrk(self.buildName(dwi, 'tensor_det', 'tck'))
+        self.__tckProbRoiTrk = roiTrk(self.buildName(dwi, 'tensor_prob', 'tck'))
+        csd = self.getHardimrtrixImage('dwi', 'csd')
+        if csd:
+            hardiTck = self.buildName(csd, 'hardi_prob', 'tck')
+            self.__tckgenRoiTrk = roiTrk(hardiTck)
+            self.__tcksiftRoiTrk = roiTrk(self.buildName(hardiTck, 'tcksift', '.tck'))
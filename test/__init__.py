@@ -0,0 +1,4 @@
+# -*- coding: utf-8 -*-
+__author__ = "Mathieu Desrosiers"
+__copyright__ = "Copyright (C) 2014, TOAD"
+__credits__ = ["Mathieu Desrosiers"]
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+import ConfigParser
+import shutil
+import tempfile
+import time
+import unittest
+import os
+
+from core.toad.tasksmanager import TasksManager
+
+__author__ = "Mathieu Desrosiers"
+__copyright__ = "Copyright (C) 2014, TOAD"
+__credits__ = ["Mathieu Desrosiers"]
+
+
+class FakeSubject(object):
+
+    def __init__(self, directory, stopBeforeTask):
+        self.directory = directory
+        self.config = ConfigParser.RawConfigParser()
+        for section in ['general', 'arguments', 'qa']:
+            self.config.add_section(section)
+        self.config.set('general', 'parallel_tasks', 'True')
+        self.config.set('general', 'nb_parallel_tasks', '4')
+        self.config.set('general', 'nb_threads', '1')
+        self.config.set('general', 'nb_subjects', '1')
+        self.config.set('general', 'server', 'local')
+        self.config.set('arguments', 'stop_before_task', stopBeforeTask)
+        self.config.set('qa', 'mode', 'immediate')
+
+    def getConfig(self):
+        return self.config
+
+    def getDir(self):
+        return self.directory
+
+    def setRunningTask(self, name, running=True):
+        pass
+
+    def writeConfigRunning(self, target):
+        pass
+
+    def info(self, message):
+        pass
+
+    def warning(self, message):
+        pass
+
+    def error(self, message):
+        raise AssertionError(message)
+
+
+class FakeTask(object):
+
+    def __init__(self, subject, name, order, dependencies=None, duration=0):
+        self.config = subject.getConfig()
+        self.directory = subject.getDir()
+        self.name = name
+        self.order = order
+        self.dependencies = dependencies or []
+        self.duration = duration
+        self.stopped = False
+
+    def getName(self):
+        return self.name
+
+    def getOrder(self):
+        return self.order
+
+    def getDependencies(self):
+        return self.dependencies
+
+    def isStopBeforeTask(self):
+        return self.config.get('arguments', 'stop_before_task') == self.name
+
+    def stopBeforeTask(self):
+        self.stopped = True
+
+    def run(self):
+        time.sleep(self.duration)
+        open(os.path.join(self.directory, self.name), 'w').close()
+
+    def __lt__(self, other):
+        return self.order < other.order
+
+    def __str__(self):
+        return self.name
+
+
+class TestRunConcurrently(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def __run(self, subject, tasks):
+        manager = TasksManager.__new__(TasksManager)
+        manager._TasksManager__subject = subject
+        manager._TasksManager__runnableTasks = tasks
+        manager.run()
+        return sorted(os.listdir(self.directory))
+
+    def testStopBeforeTaskSkipLaterIndependentTasks(self):
+        subject = FakeSubject(self.directory, 'registration')
+        preparation = FakeTask(subject, 'preparation', 0, duration=0.5)
+        registration = FakeTask(subject, 'registration', 1, ['preparation'])
+        atlas = FakeTask(subject, 'atlas', 2)
+        tasks = [preparation, registration, atlas]
+
+        self.assertEqual(self.__run(subject, tasks), ['preparation'])
+        self.assertTrue(registration.stopped)
+
+    def testStopBeforeTaskRunEarlierIndependentTasks(self):
+        subject = FakeSubject(self.directory, 'registration')
+        preparation = FakeTask(subject, 'preparation', 0, duration=0.5)
+        atlas = FakeTask(subject, 'atlas', 1)
+        registration = FakeTask(subject, 'registration', 2, ['preparation'])
+        tasks = [preparation, atlas, registration]
+
+        self.assertEqual(self.__run(subject, tasks), ['atlas', 'preparation'])
+        self.assertTrue(registration.stopped)
+
+
+if __name__ == '__main__':
+    unittest.main()